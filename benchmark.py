@@ -0,0 +1,260 @@
+import time
+import json
+import click
+import numpy as np
+import pandas as pd
+from text2knowledge.ann import ExactIndex, QuantizedIndex
+from text2knowledge.embedding_store import EmbeddingStore, load_ontology_embeddings
+from text2knowledge.inference import InferenceProfile
+from text2knowledge.model_registry import ModelRegistry
+
+cli = click.Group()
+
+
+def load_vectors(store_dir: str | None, model_name: str | None, embedding_file: str | None) -> np.ndarray:
+    if store_dir and model_name:
+        return EmbeddingStore(store_dir, model_name).vectors
+    elif embedding_file:
+        _, vectors = load_ontology_embeddings(embedding_file)
+        return vectors
+    else:
+        raise click.UsageError("Please specify either --store-dir and --model-name or --embedding-file.")
+
+
+def recall(truth: np.ndarray, found: np.ndarray) -> float:
+    hits = [len(set(t[t >= 0]) & set(f[f >= 0])) / max(1, (t >= 0).sum()) for t, f in zip(truth, found)]
+    return float(np.mean(hits))
+
+
+@cli.command(help="Report the recall and the memory of the quantized embedding indexes against the exact search.")
+@click.option("--store-dir", type=click.Path(exists=True, file_okay=False, dir_okay=True), help="A pubtext embedding store, such as the pubtext_embeddings directory next to the text chunks file.")
+@click.option("--model-name", "-m", type=str, help="Embedding model name, only used with --store-dir.")
+@click.option("--embedding-file", "-e", type=click.Path(exists=True, file_okay=True, dir_okay=False), help="An ontology embedding file which is generated by the generate-embeddings command.")
+@click.option("--num-queries", "-q", default=100, help="Number of queries, which are sampled from the embeddings.", type=int)
+@click.option("--topk", "-k", default=10, help="Number of items per query.", type=int)
+@click.option("--rescore", "-r", default=100, help="Number of candidates re-scored with the full-precision embeddings.", type=int)
+@click.option("--output-file", "-o", default=None, help="Save the report as a tsv file.", type=click.Path(exists=False, file_okay=True, dir_okay=False))
+def quantization(store_dir, model_name, embedding_file, num_queries, topk, rescore, output_file):
+    vectors = load_vectors(store_dir, model_name, embedding_file)
+    print(f"Loaded {vectors.shape[0]} embeddings with {vectors.shape[1]} dimensions.")
+
+    rng = np.random.default_rng(0)
+    queries = np.asarray(vectors[np.sort(rng.choice(len(vectors), min(num_queries, len(vectors)), replace=False))])
+
+    exact = ExactIndex(vectors)
+    start = time.perf_counter()
+    _, truth = exact.search(queries, topk)
+    exact_latency = (time.perf_counter() - start) / len(queries)
+
+    report = [
+        {
+            "method": "float32",
+            "rescore": 0,
+            "bytes_per_vector": vectors.shape[1] * 4,
+            "resident_mb": vectors.nbytes / 1024**2,
+            f"recall@{topk}": 1.0,
+            "latency_ms": exact_latency * 1000,
+        }
+    ]
+
+    for method in ["sq8", "pq"]:
+        print(f"Build the {method} index...")
+        index = QuantizedIndex.build(vectors, method=method)
+        # rescore == topk means the ranking only comes from the codes.
+        for shortlist in sorted(set([topk, rescore])):
+            index.rescore = shortlist
+            start = time.perf_counter()
+            _, found = index.search(queries, topk)
+            latency = (time.perf_counter() - start) / len(queries)
+            report.append(
+                {
+                    "method": method,
+                    "rescore": shortlist,
+                    "bytes_per_vector": index.quantizer.code_size,
+                    "resident_mb": index.memory_usage / 1024**2,
+                    f"recall@{topk}": recall(truth, found),
+                    "latency_ms": latency * 1000,
+                }
+            )
+
+    report_df = pd.DataFrame(report)
+    print(report_df.to_string(index=False))
+    if output_file:
+        report_df.to_csv(output_file, sep="\t", index=False)
+
+
+@cli.command(help="Report the embedding throughput of each inference profile against the default forward pass.")
+@click.option("--input-file", "-i", required=True, type=click.Path(exists=True, file_okay=True, dir_okay=False), help="A tsv file with a name column (such as the input of generate-embeddings) or a text chunks json file with a text column.")
+@click.option("--model-name", "-m", required=True, type=str, help="Embedding model name.")
+@click.option("--profile", "-p", "profiles", multiple=True, default=["default", "cpu", "cpu-int8", "onnx"], type=click.Choice(["default", "cpu", "cpu-int8", "onnx"]), help="Inference profiles to compare, can be given several times.")
+@click.option("--num-texts", "-n", default=512, help="Number of texts to embed.", type=int)
+@click.option("--batch-size", "-b", default=32, help="Number of texts per forward pass.", type=int)
+@click.option("--num-threads", default=None, help="Number of intra-op threads for the cpu profiles.", type=int)
+@click.option("--output-file", "-o", default=None, help="Save the report as a tsv file.", type=click.Path(exists=False, file_okay=True, dir_okay=False))
+def embedding_inference(input_file, model_name, profiles, num_texts, batch_size, num_threads, output_file):
+    # Imported here, the quantization benchmark doesn't need transformers.
+    from text2knowledge.utils import EmbeddingGenerator
+
+    if input_file.endswith(".json"):
+        texts = pd.read_json(input_file)["text"].tolist()
+    else:
+        texts = pd.read_csv(input_file, sep="\t")["name"].astype(str).tolist()
+    texts = texts[:num_texts]
+    print(f"Embed {len(texts)} texts with {model_name}.")
+
+    report = []
+    baseline = None
+    for name in profiles:
+        try:
+            profile = InferenceProfile.from_name(name, num_threads)
+            # A fresh registry per profile, so the load time is measured and the previous model is released.
+            generator = EmbeddingGenerator(model_name, device="cpu", cache=False, profile=profile, registry=ModelRegistry())
+        except ImportError as e:
+            print(f"Skip the {name} profile: {e}")
+            continue
+
+        # Warm up, the first batches pay for the lazy initializations.
+        generator.gen_text_embeddings(texts[:batch_size], batch_size=batch_size)
+        start = time.perf_counter()
+        embeddings = generator.gen_text_embeddings(texts, batch_size=batch_size).numpy()
+        elapsed = time.perf_counter() - start
+
+        embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        if baseline is None:
+            baseline = embeddings
+        report.append(
+            {
+                "profile": name,
+                "threads": profile.num_threads or torch_threads(),
+                "bf16": profile.bf16,
+                "texts_per_second": len(texts) / elapsed,
+                "speedup": 0.0,
+                # Cosine similarity with the embeddings of the first profile.
+                "min_cosine": float((embeddings * baseline).sum(axis=1).min()),
+            }
+        )
+
+    report_df = pd.DataFrame(report)
+    if len(report_df) > 0:
+        report_df["speedup"] = report_df["texts_per_second"] / report_df["texts_per_second"].iloc[0]
+    print(report_df.to_string(index=False))
+    if output_file:
+        report_df.to_csv(output_file, sep="\t", index=False)
+
+
+@cli.command(help="Report the parse-failure rate and the generated tokens per item of the classification, with and without the structured output.")
+@click.option("--input-file", "-i", default="classfication/example.json", type=click.Path(exists=True, file_okay=True, dir_okay=False), help="A json file with a list of {title, abstract} items, such as the input of classify-article.")
+@click.option("--model-name", "-m", default="mistral-openorca:latest", type=str, help="Ollama model name.")
+@click.option("--num-items", "-n", default=50, help="Number of items.", type=int)
+@click.option("--output-file", "-o", default=None, help="Save the report as a tsv file.", type=click.Path(exists=False, file_okay=True, dir_okay=False))
+def json_mode(input_file, model_name, num_items, output_file):
+    import text2knowledge.ollama.client as client
+    from text2knowledge.ollama.client import OllamaError
+    from text2knowledge.prompt_template import make_classification_prompt
+    from text2knowledge.strategy1 import generation_kwargs, make_task_prompt, parse_output
+
+    with open(input_file) as f:
+        items = json.load(f)[:num_items]
+
+    report = []
+    for structured_output in [False, True]:
+        failures, errors, tokens, latencies = 0, 0, [], []
+        for item in items:
+            text = f"{item.get('title', '')}\n{item.get('abstract') or 'No abstract found.'}"
+            prompt = make_task_prompt(make_classification_prompt(text), "classification", structured_output)
+            try:
+                # The stream stops early, so eval_count is the number of received tokens.
+                response, _, stats = client.generate(
+                    model_name,
+                    prompt,
+                    use_cache=False,
+                    stop_on_json=True,
+                    **generation_kwargs("classification", {"temperature": 0}, structured_output),
+                )
+            except OllamaError as e:
+                print(f"The request failed: {e}")
+                errors += 1
+                continue
+
+            latencies.append(stats.wall_time)
+            tokens.append(stats.eval_count)
+            try:
+                parse_output(response, "classification", structured_output)
+            except ValueError:
+                failures += 1
+
+        answered = max(1, len(items) - errors)
+        report.append(
+            {
+                "mode": "structured" if structured_output else "free text",
+                "items": len(items),
+                "request_errors": errors,
+                "parse_failure_rate": failures / answered,
+                "tokens_per_item": float(np.mean(tokens)) if tokens else 0.0,
+                "seconds_per_item": float(np.mean(latencies)) if latencies else 0.0,
+            }
+        )
+
+    report_df = pd.DataFrame(report)
+    print(report_df.to_string(index=False))
+    if output_file:
+        report_df.to_csv(output_file, sep="\t", index=False)
+
+
+@cli.command(help="Report the prompt evaluation of the entity extraction and its review, with the single-prompt layout against the system-prefix layout and the review continuing from the extraction context.")
+@click.option("--input-file", "-i", default="classfication/example.json", type=click.Path(exists=True, file_okay=True, dir_okay=False), help="A json file with a list of {title, abstract} items, such as the input of classify-article.")
+@click.option("--model-name", "-m", default="mistral-openorca:latest", type=str, help="Ollama model name.")
+@click.option("--num-items", "-n", default=20, help="Number of items.", type=int)
+@click.option("--output-file", "-o", default=None, help="Save the report as a tsv file.", type=click.Path(exists=False, file_okay=True, dir_okay=False))
+def prompt_cache(input_file, model_name, num_items, output_file):
+    import text2knowledge.ollama.client as client
+    from text2knowledge.prompt_template import (
+        make_entity_extraction_prompt,
+        make_entity_extraction_review_prompt,
+        make_user_prompt,
+    )
+    from text2knowledge.strategy1 import extract_json
+
+    def run(step, **kwargs):
+        response, context, stats = client.generate(model_name, use_cache=False, options={"temperature": 0}, **kwargs)
+        rows.append(
+            {
+                "step": step,
+                "prompt_eval_count": stats.prompt_eval_count,
+                "prompt_eval_ms": stats.prompt_eval_duration / 1e6,
+                "total_ms": stats.total_duration / 1e6,
+            }
+        )
+        return response, context
+
+    with open(input_file) as f:
+        items = [item for item in json.load(f) if item.get("abstract")][:num_items]
+
+    rows = []
+    for item in items:
+        text = f"{item.get('title', '')}\n{item['abstract']}"
+        # The layouts are interleaved, so the prompt cache of one layout is evicted by the other one, like documents of different tasks.
+        run("extraction, single prompt", prompt=make_entity_extraction_prompt(text))
+        response, context = run(
+            "extraction, system prefix",
+            system=make_entity_extraction_prompt(None),
+            prompt=make_user_prompt(text),
+        )
+        entities = extract_json(str(response), is_list=True) or []
+        run("review, text sent again", prompt=make_entity_extraction_review_prompt(text, entities))
+        run("review, extraction context", prompt=make_entity_extraction_review_prompt(None, entities), context=context)
+
+    report_df = pd.DataFrame(rows).groupby("step", sort=False).mean().reset_index()
+    print(report_df.to_string(index=False))
+    if output_file:
+        report_df.to_csv(output_file, sep="\t", index=False)
+
+
+def torch_threads() -> int:
+    import torch
+
+    return torch.get_num_threads()
+
+
+if __name__ == "__main__":
+    cli()
@@ -5,6 +5,7 @@ import pandas as pd
 import json
 import click
 from text2knowledge.pdf import list_pdfs, extract_fulltext, extract_figures
+from text2knowledge.dedup import NearDuplicateDetector, deduplicate, save_duplicates
 
 cli = click.Group()
 
@@ -26,7 +27,31 @@ def extract_abstract(input_file: str, output_dir: str):
                 file.write(abstract)
 
 
-def extract_sentences(input_dir: str, output_file: str, sentence_size: int):
+def save_text_chunks(text_chunks: list, output_file: str, dedup_threshold: float | None = None, dedup_mode: str = "tag"):
+    """Save the text chunks, after the near-duplicate detection if dedup_threshold is set.
+
+    In the tag mode every chunk gets a duplicate_of field, the name of its canonical chunk or None.
+    In the drop mode the duplicates are not saved, and their canonical chunks are saved to
+    <output_file without the extension>.duplicates.json.
+    """
+    if dedup_threshold is not None:
+        total = len(text_chunks)
+        detector = NearDuplicateDetector(threshold=dedup_threshold)
+        text_chunks = list(deduplicate(text_chunks, detector, mode=dedup_mode))
+        print(
+            f"Found {len(detector.duplicates)} near-duplicate chunks of {total} "
+            f"(Jaccard similarity >= {dedup_threshold}), mode: {dedup_mode}."
+        )
+        if dedup_mode == "drop":
+            save_duplicates(detector.duplicates, f"{os.path.splitext(output_file)[0]}.duplicates.json")
+
+    # A .jsonl output is a corpus of `text2knowledge.py extract-entities --text-file`, one chunk per line.
+    lines = output_file.endswith(".jsonl")
+    df = pd.DataFrame(text_chunks)
+    df.to_json(output_file, orient="records", lines=lines, force_ascii=False)
+
+
+def extract_sentences(input_dir: str, output_file: str, sentence_size: int, **dedup):
     print(f"Extracting sentences with size {sentence_size}...")
     pmids = os.listdir(input_dir)
     text_chunks = []
@@ -68,11 +93,10 @@ def extract_sentences(input_dir: str, output_file: str, sentence_size: int):
             )
 
     print(f"Saving sentences to {output_file}...")
-    df = pd.DataFrame(text_chunks)
-    df.to_json(output_file, orient="records", lines=False, force_ascii=False)
+    save_text_chunks(text_chunks, output_file, **dedup)
 
 
-def extract_chunks(input_dir: str, output_file: str, chunk_size: int):
+def extract_chunks(input_dir: str, output_file: str, chunk_size: int, **dedup):
     pmids = os.listdir(input_dir)
     text_chunks = []
 
@@ -105,11 +129,10 @@ def extract_chunks(input_dir: str, output_file: str, chunk_size: int):
                 }
             )
 
-    df = pd.DataFrame(text_chunks)
-    df.to_json(output_file, orient="records", lines=False, force_ascii=False)
+    save_text_chunks(text_chunks, output_file, **dedup)
 
 
-def extract_sections(input_dir: str, output_file: str):
+def extract_sections(input_dir: str, output_file: str, **dedup):
     pmids = os.listdir(input_dir)
     text_chunks = []
 
@@ -138,8 +161,7 @@ def extract_sections(input_dir: str, output_file: str):
                 }
             )
 
-    df = pd.DataFrame(text_chunks)
-    df.to_json(output_file, orient="records", lines=False, force_ascii=False)
+    save_text_chunks(text_chunks, output_file, **dedup)
 
 
 @cli.command(
@@ -159,16 +181,20 @@ def abstract(input_file, output_dir):
 @click.option("--chunk-type", default="sections", help="Chunk type.", type=click.Choice(["sections", "chunks", "sentences"]))
 @click.option("--chunk-size", default=1000, help="Chunk size, only used when chunk-type is chunks.", type=int)
 @click.option("--sentence-size", default=5, help="Sentence size, only used when chunk-type is sentences.", type=int)
-def text_chunks(input_dir, output_file, chunk_type, chunk_size, sentence_size):
+@click.option("--dedup", is_flag=True, default=False, help="Detect the near-duplicate chunks (such as funding statements, license text or a preprint next to its published version) with MinHash, so they are not embedded and extracted again.")
+@click.option("--dedup-threshold", default=0.8, help="The lowest Jaccard similarity (of the word 5-grams) of a near-duplicate chunk, only used with --dedup.", type=click.FloatRange(min=0, max=1, min_open=True))
+@click.option("--dedup-mode", default="tag", help="tag adds a duplicate_of field (the name of the canonical chunk) to every chunk, drop removes the duplicates and saves their canonical chunks to <output file>.duplicates.json. Only used with --dedup.", type=click.Choice(["tag", "drop"]))
+def text_chunks(input_dir, output_file, chunk_type, chunk_size, sentence_size, dedup, dedup_threshold, dedup_mode):
+    dedup = {"dedup_threshold": dedup_threshold, "dedup_mode": dedup_mode} if dedup else {}
     if chunk_type == "sections":
         print("Extracting sections...")
-        extract_sections(input_dir, output_file)
+        extract_sections(input_dir, output_file, **dedup)
     elif chunk_type == "chunks":
         print(f"Extracting chunks with size {chunk_size}...")
-        extract_chunks(input_dir, output_file, chunk_size)
+        extract_chunks(input_dir, output_file, chunk_size, **dedup)
     elif chunk_type == "sentences":
         print(f"Extracting sentences with size {sentence_size}...")
-        extract_sentences(input_dir, output_file, sentence_size)
+        extract_sentences(input_dir, output_file, sentence_size, **dedup)
 
 
 @cli.command(help="Extract figures and fulltext from pdfs.")
@@ -65,6 +65,27 @@ import pandas as pd
     default=None,
     type=click.Path(exists=True, file_okay=False, dir_okay=True),
 )
+@click.option(
+    "--index-backend",
+    help="The index for searching the text chunks, which is saved next to the embeddings. `exact` means a brute-force search, `sq8` and `pq` search on quantized embeddings and re-score the best candidates with the full-precision embeddings.",
+    required=False,
+    default="auto",
+    type=click.Choice(["auto", "faiss", "ivf", "sq8", "pq", "exact"]),
+)
+@click.option(
+    "--nprobe",
+    help="Number of index clusters scanned per query, a larger value gives a higher recall but a higher latency.",
+    required=False,
+    default=16,
+    type=int,
+)
+@click.option(
+    "--rescore",
+    help="Number of candidates re-scored with the full-precision embeddings, only used by the sq8 and pq indexes.",
+    required=False,
+    default=100,
+    type=int,
+)
 def find_topn_chunks(
     question: str,
     text_chunks: str,
@@ -74,10 +95,13 @@ def find_topn_chunks(
     min_score: float = 0.0,
     use_cohere: bool = False,
     pdf_dir: str | None = None,
+    index_backend: str = "auto",
+    nprobe: int = 16,
+    rescore: int = 100,
 ):
     print("Finding top N text chunks...")
     results = find_topn_text_chunks(
-        question, text_chunks, model_name=model_name, topn=topn, min_score=min_score, use_cohere=use_cohere, use_vectorized=True
+        question, text_chunks, model_name=model_name, topn=topn, min_score=min_score, use_cohere=use_cohere, use_vectorized=True, index_backend=index_backend, nprobe=nprobe, rescore=rescore
     )
     results = pd.DataFrame(results)
     results.sort_values(by="score", ascending=False, inplace=True)
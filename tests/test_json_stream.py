@@ -0,0 +1,29 @@
+from text2knowledge.ollama.json_stream import JsonStreamParser
+
+
+def test_skips_citation_before_answer():
+    parser = JsonStreamParser()
+    found = parser.feed('See ref [1]. Here: [{"a": 1}]')
+    assert parser.done
+    assert parser.value == [{"a": 1}]
+    assert found[-1] == {"a": 1}
+
+
+def test_skips_empty_object_before_answer():
+    parser = JsonStreamParser()
+    for piece in ['Text {} then ', '[{"category": ', '"Other"}] and more']:
+        parser.feed(piece)
+    assert parser.value == [{"category": "Other"}]
+
+
+def test_accept_checks_the_expected_keys():
+    parser = JsonStreamParser(accept=lambda value: isinstance(value, dict) and "entities" in value)
+    parser.feed('Example: {"b": 2}. Answer: {"entities": []}')
+    assert parser.value == {"entities": []}
+
+
+def test_streams_any_array_without_keep_value():
+    parser = JsonStreamParser(keep_value=False)
+    found = parser.feed('[{"id": 1}, {"id": 2}]')
+    assert found == [{"id": 1}, {"id": 2}]
+    assert parser.done
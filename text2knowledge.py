@@ -1,35 +1,149 @@
 import click
 import os
+import asyncio
 import json
 import logging
 import pandas as pd
 from text2knowledge.utils import init_logger, EmbeddingGenerator
+from text2knowledge.ann import open_index
+from text2knowledge.inference import InferenceProfile
+from text2knowledge.chunking import TokenCounter, chunk_text
+from text2knowledge.corpus import Journal, compact, is_corpus, iter_records, output_path as corpus_output_path, run_corpus
+from text2knowledge.embedding_store import (
+    has_ontology_embeddings,
+    load_ontology_embeddings,
+    ontology_prefix,
+    save_ontology_embeddings,
+)
 from text2knowledge.strategy1 import (
     extract_entities as extract_entities_from_text,
     extract_relations as extract_relations_from_text,
-    classify_article as classify_article_from_text,
+    extract_knowledge as extract_knowledge_from_text,
+    extract_in_windows,
+    aclassify_article,
+    aclassify_article_cascade,
     correct_extracted_entities,
 )
+from text2knowledge.ollama.async_client import AsyncOllamaClient, ordered_map
+from text2knowledge.ollama.cache import configure_response_cache
+from text2knowledge.ollama.client import configure as configure_ollama
+from text2knowledge.ollama.stats import get_stats_collector
+from text2knowledge.prompt_template import ARTICLE_CATEGORIES
 
 logging.basicConfig(level=logging.WARNING)
 logger = init_logger(__name__)
 
 cli = click.Group()
 
+
+def make_options(temperature: float | None = None) -> dict:
+    """Ollama options of the generate requests, the model defaults are used for the missing options."""
+    return {"temperature": temperature} if temperature is not None else {}
+
+
+def report_stats(stats_file: str | None = None):
+    """Print the summary of the generation stats of the run, and export them if stats_file is given."""
+    collector = get_stats_collector()
+    if not len(collector):
+        return
+
+    print(collector.format_summary())
+    if stats_file:
+        collector.export(stats_file)
+        print(f"The generation stats are saved to {stats_file}.")
+
+
+def chunking_options(func):
+    """The options of the commands which split long texts into windows."""
+    options = [
+        click.option(
+            "--chunk-tokens",
+            help="Token budget of a window of the text, such as 1024. A longer text (such as a full-text paper of `extract.py pdf2text`) is split into windows on the sentence boundaries, which are sent concurrently, and the results are merged. The merged output has no top-level response, prompt and context, so it can't be reviewed with the context of --keep-context. 0 sends the whole text in one request. Default: 0",
+            default=0,
+            type=click.IntRange(min=0),
+        ),
+        click.option(
+            "--chunk-overlap",
+            help="Number of sentences shared by consecutive windows. Default: 1",
+            default=1,
+            type=click.IntRange(min=0),
+        ),
+        click.option(
+            "--tokenizer",
+            help="A Hugging Face tokenizer of the model family, which counts the tokens of the windows, such as mistralai/Mistral-7B-v0.1 for the mistral models. Default: an estimate from the number of characters",
+            default=None,
+        ),
+        click.option(
+            "--concurrency",
+            "-c",
+            help="Number of windows in flight, or of documents in flight for a corpus. Default: 4",
+            default=4,
+            type=click.IntRange(min=1),
+        ),
+    ]
+    for option in reversed(options):
+        func = option(func)
+    return func
+
+
+def system_prompt_option(func):
+    """The option of the commands which send the static part of the task prompt as the system prompt."""
+    return click.option(
+        "--system-prompt/--no-system-prompt",
+        help="Send the static instructions and examples of the task as the system prompt and only the text as the prompt, so the requests of all texts start with the same tokens, which the Ollama server reuses from its prompt cache. --no-system-prompt sends them as a single prompt. Default: --system-prompt",
+        default=True,
+    )(func)
+
+
+def merge_metadata(metadata, document_metadata: dict) -> dict:
+    """The metadata of a corpus document, the fields of the --metadata file apply to every document."""
+    if isinstance(metadata, str):
+        try:
+            metadata = json.loads(metadata)
+        except json.JSONDecodeError:
+            metadata = {}
+
+    return {**(metadata if isinstance(metadata, dict) else {}), **document_metadata}
+
+
+def corpus_status(result: dict, key: str) -> str:
+    """The manifest status of a processed document, the failed requests are retried by the next run."""
+    if result.get("error") and not result.get(key):
+        return "error"
+
+    return "done" if result.get(key) else "empty"
+
+
+def check_ontology_embeddings(ontology_embedding_file: str):
+    """Fail when the ontology embeddings of --ontology-embedding-file can't be loaded, instead of skipping the mapping."""
+    if not has_ontology_embeddings(ontology_embedding_file):
+        raise click.ClickException(
+            f"No ontology embeddings at {ontology_embedding_file} (or {ontology_prefix(ontology_embedding_file)}.npy), "
+            "generate them with the generate-embeddings command first."
+        )
+
+
+def split_windows(text: str, chunk_tokens: int, chunk_overlap: int, tokenizer: str | None = None) -> list:
+    if not chunk_tokens:
+        return [text]
+
+    return chunk_text(text, chunk_tokens, chunk_overlap, TokenCounter(tokenizer))
+
+
 @cli.command(help="Extract biomedical entities from a given text or a set of texts.")
 @click.option(
     "--text-file",
     "-i",
-    help="Text file.",
+    help="Text file, or a corpus: a directory of .txt files or a JSONL file with one {id, text, ...} document per line. A corpus is processed in one process, the outputs are saved to the --output-file directory as <id>.json, and the run resumes from the manifest.jsonl file of the directory.",
     required=True,
-    type=click.Path(exists=True, file_okay=True, dir_okay=False),
+    type=click.Path(exists=True, file_okay=True, dir_okay=True),
 )
 @click.option(
     "--output-file",
     "-o",
-    help="Output file.",
+    help="Output file, or the output directory of a corpus.",
     required=True,
-    type=click.Path(exists=False, file_okay=True, dir_okay=False),
+    type=click.Path(exists=False, file_okay=True, dir_okay=True),
 )
 @click.option(
     "--model-name",
@@ -53,7 +167,7 @@ cli = click.Group()
     "--ontology-embedding-file",
     "-e",
     type=click.Path(exists=False, file_okay=True, dir_okay=False),
-    help="A file which contains ontology embeddings, which is a biomedgps-format file but with an embedding column.",
+    help="A file which contains ontology embeddings, which is generated by the generate-embeddings command (its --output-file, or the .npy or .parquet file). A legacy biomedgps-format tsv file with an embedding column is also supported, it will be converted to the binary format once.",
 )
 @click.option(
     "--embedding-model-name",
@@ -61,29 +175,107 @@ cli = click.Group()
     help="Embedding model name. Default: mistralai/Mistral-7B-v0.1",
     default="mistralai/Mistral-7B-v0.1",
 )
-def extract_entities(text_file: str, output_file: str, model_name: str, metadata: str, review: bool = False, ontology_embedding_file: str | None = None, embedding_model_name: str = "mistralai/Mistral-7B-v0.1"):
+@click.option(
+    "--index-backend",
+    help="The index for mapping entities to the ontology embeddings. The index is saved next to the ontology embedding file, `exact` means a brute-force search, `sq8` and `pq` search on quantized embeddings and re-score the best candidates with the full-precision embeddings. Default: auto (faiss if it is installed, otherwise ivf)",
+    default="auto",
+    type=click.Choice(["auto", "faiss", "ivf", "sq8", "pq", "exact"]),
+)
+@click.option(
+    "--nprobe",
+    help="Number of index clusters scanned per entity, a larger value gives a higher recall but a higher latency. Default: 16",
+    default=16,
+    type=int,
+)
+@click.option(
+    "--rescore",
+    help="Number of candidates re-scored with the full-precision embeddings, only used by the sq8 and pq indexes. Default: 100",
+    default=100,
+    type=int,
+)
+@click.option(
+    "--temperature",
+    "-t",
+    help="Sampling temperature of the model. The requests with temperature 0 are served from the response cache when they are sent again. Default: the model default",
+    default=None,
+    type=float,
+)
+@click.option(
+    "--no-cache",
+    is_flag=True,
+    help="Don't read or write the response cache, which is at ~/.cache/text2knowledge/responses.sqlite (the TEXT2KNOWLEDGE_CACHE_DIR environment variable changes the directory).",
+)
+@click.option(
+    "--verbose",
+    "-v",
+    is_flag=True,
+    help="Print the tokens of the model responses as they arrive.",
+)
+@click.option(
+    "--structured-output",
+    is_flag=True,
+    help="Constrain the model responses to the JSON schema of the task (the `format` parameter of Ollama, it needs Ollama 0.5 or later), and cap the number of generated tokens per task. The responses are validated against the schema instead of being searched for JSON.",
+)
+@click.option(
+    "--keep-context",
+    is_flag=True,
+    help="Keep the model context in the output file, so a later --review run with the same model continues from it instead of sending the text again.",
+)
+@click.option(
+    "--stats-file",
+    help="Save the generation stats of the run, a summary in the Prometheus text format for a .prom file, otherwise one JSON line per request (tokens, durations, time to first token).",
+    default=None,
+    type=click.Path(exists=False, file_okay=True, dir_okay=False),
+)
+@chunking_options
+@system_prompt_option
+def extract_entities(text_file: str, output_file: str, model_name: str, metadata: str, review: bool = False, ontology_embedding_file: str | None = None, embedding_model_name: str = "mistralai/Mistral-7B-v0.1", index_backend: str = "auto", nprobe: int = 16, rescore: int = 100, temperature: float | None = None, no_cache: bool = False, verbose: bool = False, structured_output: bool = False, keep_context: bool = False, stats_file: str | None = None, chunk_tokens: int = 0, chunk_overlap: int = 1, tokenizer: str | None = None, concurrency: int = 4, system_prompt: bool = True):
     print("Extracting entities using the model %s..." % model_name)
+    configure_response_cache(enabled=not no_cache)
+    if verbose:
+        configure_ollama(verbose=True)
+    options = make_options(temperature)
     if metadata and os.path.exists(metadata):
         with open(metadata, "r") as f:
             metadata = f.read()
     else:
         metadata = {} # type: ignore
 
-    def extract(text):
-        if os.path.exists(output_file):
+    # Loaded once, a corpus run maps the entities of all documents with the same index.
+    if not review and ontology_embedding_file:
+        check_ontology_embeddings(ontology_embedding_file)
+        df, vectors = load_ontology_embeddings(ontology_embedding_file)
+        index = open_index(
+            ontology_prefix(ontology_embedding_file),
+            vectors,
+            backend=index_backend,
+            nprobe=nprobe,
+            rescore=rescore,
+        )
+    else:
+        df = None
+        index = None
+
+    def extract(text, text_file, output_file, metadata, concurrency, skip_existing=True):
+        if os.path.exists(output_file) and (review or skip_existing):
             if review:
-                entities = json.load(open(output_file))
+                previous = json.load(open(output_file))
 
-                if entities:
+                if previous and previous.get("entities"):
                     print(
                         f"Entities found in the {text_file} file, so we will review them."
                     )
+                    # The context is only valid for the model which generated it.
+                    context = previous.get("context") if previous.get("model") == model_name else None
                     entities = correct_extracted_entities(
                         text=text,
                         model=model_name,
                         metadata=metadata,
-                        entities=entities,
+                        entities=previous["entities"],
                         is_list=True,
+                        options=options,
+                        structured_output=structured_output,
+                        context=context,
                     )
                 else:
                     print(
@@ -96,46 +288,176 @@ def extract_entities(text_file: str, output_file: str, model_name: str, metadata
                 )
                 return
         else:
-            if ontology_embedding_file and os.path.exists(ontology_embedding_file):
-                df = pd.read_csv(ontology_embedding_file, sep="\t")
-                df["embedding"] = df["embedding"].apply(
-                    lambda x: [float(i) for i in x.split("|")]
-                )
-            else:
-                df = None
-
-            entities = extract_entities_from_text(
+            entities = extract_in_windows(
+                extract_entities_from_text,
                 text,
+                split_windows(text, chunk_tokens, chunk_overlap, tokenizer),
+                concurrency=concurrency,
                 model=model_name,
                 metadata=metadata,
                 embeddings=df,
                 embedding_model_name=embedding_model_name,
+                index=index,
+                options=options,
+                structured_output=structured_output,
+                keep_context=keep_context,
+                use_system=system_prompt,
             )
 
         return entities
 
-    if os.path.dirname(output_file) and not os.path.exists(os.path.dirname(output_file)):
-        os.makedirs(os.path.dirname(output_file))
-
-    with open(text_file, "r") as f:
-        text = f.read()
-
-    entities = extract(text)
-
-    if entities:
+    def save(entities, output_file):
         output_file = output_file if not review else output_file.replace(".json", "_reviewed.json")
         with open(output_file, "w") as f:
             entities_str = json.dumps(entities, indent=4)
             f.write(entities_str)
+        return output_file
+
+    if is_corpus(text_file):
+
+        def process(doc):
+            document_file = corpus_output_path(output_file, doc["id"])
+            # The documents are in flight concurrently, so the windows of a document are sent one by one.
+            # The manifest tells which documents are done, the outputs of the failed documents are overwritten.
+            entities = extract(doc["text"], doc["id"], document_file, merge_metadata(metadata, doc["metadata"]), 1, skip_existing=False)
+            if not entities:
+                # The review has no extraction to review yet.
+                return "error", None
+            return corpus_status(entities, "entities"), save(entities, document_file)
+
+        counts = run_corpus(text_file, output_file, process, concurrency, "manifest_reviewed.jsonl" if review else "manifest.jsonl")
+        print(f"Processed the documents of {text_file}: {counts}")
     else:
-        print(f"No entities found for the {text_file} file.")
+        if os.path.dirname(output_file) and not os.path.exists(os.path.dirname(output_file)):
+            os.makedirs(os.path.dirname(output_file))
+
+        with open(text_file, "r") as f:
+            text = f.read()
+
+        entities = extract(text, text_file, output_file, metadata, concurrency)
+
+        if entities:
+            save(entities, output_file)
+        else:
+            print(f"No entities found for the {text_file} file.")
+
+    report_stats(stats_file)
 
 
 @cli.command(help="Extract relationships between biomedical entities from a given text using strategy 1.")
 @click.option(
     "--text-file",
     "-a",
-    help="Text file which contains a paragraph.",
+    help="Text file which contains a paragraph, or a corpus: a directory of .txt files or a JSONL file with one {id, text, ...} document per line. A corpus is processed in one process, the outputs are saved to the --output-file directory as <id>.json, and the run resumes from the manifest.jsonl file of the directory.",
+    required=True,
+    type=click.Path(exists=True, file_okay=True, dir_okay=True),
+)
+@click.option(
+    "--output-file",
+    "-o",
+    help="Output file, or the output directory of a corpus.",
+    required=True,
+    type=click.Path(exists=False, file_okay=True, dir_okay=True),
+)
+@click.option(
+    "--model-name",
+    "-m",
+    help="Model name. You can use any model which supported by ollama.ai. If you don't know which models are available, you can use the command `ollama list` to list all installed models or visit https://ollama.ai/library. Default: mistral-openorca:latest",
+    default="mistral-openorca:latest",
+)
+@click.option(
+    "--metadata",
+    "-d",
+    type=click.Path(exists=False, file_okay=False, dir_okay=False),
+    help="A metadata file which contains a json object. Such as {'source': 'pubmed', 'pmid': '123456', 'type': 'abstract', ...}, you can specify any key-value pairs you want.",
+)
+@click.option(
+    "--temperature",
+    "-t",
+    help="Sampling temperature of the model. The requests with temperature 0 are served from the response cache when they are sent again. Default: the model default",
+    default=None,
+    type=float,
+)
+@click.option(
+    "--no-cache",
+    is_flag=True,
+    help="Don't read or write the response cache, which is at ~/.cache/text2knowledge/responses.sqlite (the TEXT2KNOWLEDGE_CACHE_DIR environment variable changes the directory).",
+)
+@click.option(
+    "--verbose",
+    "-v",
+    is_flag=True,
+    help="Print the tokens of the model responses as they arrive.",
+)
+@click.option(
+    "--structured-output",
+    is_flag=True,
+    help="Constrain the model responses to the JSON schema of the task (the `format` parameter of Ollama, it needs Ollama 0.5 or later), and cap the number of generated tokens per task. The responses are validated against the schema instead of being searched for JSON.",
+)
+@click.option(
+    "--stats-file",
+    help="Save the generation stats of the run, a summary in the Prometheus text format for a .prom file, otherwise one JSON line per request (tokens, durations, time to first token).",
+    default=None,
+    type=click.Path(exists=False, file_okay=True, dir_okay=False),
+)
+@chunking_options
+@system_prompt_option
+def extract_relations(text_file: str, model_name: str, metadata: str, output_file: str, temperature: float | None = None, no_cache: bool = False, verbose: bool = False, structured_output: bool = False, stats_file: str | None = None, chunk_tokens: int = 0, chunk_overlap: int = 1, tokenizer: str | None = None, concurrency: int = 4, system_prompt: bool = True):
+    configure_response_cache(enabled=not no_cache)
+    if verbose:
+        configure_ollama(verbose=True)
+    if metadata and os.path.exists(metadata):
+        with open(metadata, "r") as f:
+            metadata = f.read()
+    else:
+        metadata = {} # type: ignore
+
+    def extract(text, metadata, concurrency):
+        return extract_in_windows(
+            extract_relations_from_text,
+            text,
+            split_windows(text, chunk_tokens, chunk_overlap, tokenizer),
+            concurrency=concurrency,
+            model=model_name,
+            metadata=metadata,
+            options=make_options(temperature),
+            structured_output=structured_output,
+            use_system=system_prompt,
+        )
+
+    def save(relations, output_file):
+        with open(output_file, "w") as f:
+            relations_str = json.dumps(relations, indent=4)
+            f.write(relations_str)
+        return output_file
+
+    if is_corpus(text_file):
+
+        def process(doc):
+            # The documents are in flight concurrently, so the windows of a document are sent one by one.
+            relations = extract(doc["text"], merge_metadata(metadata, doc["metadata"]), 1)
+            return corpus_status(relations, "relations"), save(relations, corpus_output_path(output_file, doc["id"]))
+
+        counts = run_corpus(text_file, output_file, process, concurrency)
+        print(f"Processed the documents of {text_file}: {counts}")
+    else:
+        with open(text_file, "r") as f:
+            text = f.read()
+            relations = extract(text, metadata, concurrency)
+
+        if relations:
+            save(relations, output_file)
+        else:
+            print(f"No relations found for the {text_file} file.")
+
+    report_stats(stats_file)
+
+
+@cli.command(help="Extract biomedical entities and the relations between them from a given text in a single request. The relations reference the entities by id, it costs one model pass per text instead of the two or three passes of extract-entities (with --review) and extract-relations.")
+@click.option(
+    "--text-file",
+    "-i",
+    help="Text file.",
     required=True,
     type=click.Path(exists=True, file_okay=True, dir_okay=False),
 )
@@ -158,25 +480,101 @@ def extract_entities(text_file: str, output_file: str, model_name: str, metadata
     type=click.Path(exists=False, file_okay=False, dir_okay=False),
     help="A metadata file which contains a json object. Such as {'source': 'pubmed', 'pmid': '123456', 'type': 'abstract', ...}, you can specify any key-value pairs you want.",
 )
-def extract_relations(text_file: str, model_name: str, metadata: str, output_file: str):
+@click.option(
+    "--ontology-embedding-file",
+    "-e",
+    type=click.Path(exists=False, file_okay=True, dir_okay=False),
+    help="A file which contains ontology embeddings, which is generated by the generate-embeddings command (its --output-file, or the .npy or .parquet file). The entities are mapped to the ontology items like extract-entities.",
+)
+@click.option(
+    "--embedding-model-name",
+    "-n",
+    help="Embedding model name. Default: mistralai/Mistral-7B-v0.1",
+    default="mistralai/Mistral-7B-v0.1",
+)
+@click.option(
+    "--index-backend",
+    help="The index for mapping entities to the ontology embeddings, see extract-entities. Default: auto",
+    default="auto",
+    type=click.Choice(["auto", "faiss", "ivf", "sq8", "pq", "exact"]),
+)
+@click.option(
+    "--temperature",
+    "-t",
+    help="Sampling temperature of the model. The requests with temperature 0 are served from the response cache when they are sent again. Default: the model default",
+    default=None,
+    type=float,
+)
+@click.option(
+    "--no-cache",
+    is_flag=True,
+    help="Don't read or write the response cache, which is at ~/.cache/text2knowledge/responses.sqlite (the TEXT2KNOWLEDGE_CACHE_DIR environment variable changes the directory).",
+)
+@click.option(
+    "--verbose",
+    "-v",
+    is_flag=True,
+    help="Print the tokens of the model responses as they arrive.",
+)
+@click.option(
+    "--structured-output",
+    is_flag=True,
+    help="Constrain the model responses to the JSON schema of the task (the `format` parameter of Ollama, it needs Ollama 0.5 or later), and cap the number of generated tokens per task. The responses are validated against the schema instead of being searched for JSON.",
+)
+@click.option(
+    "--stats-file",
+    help="Save the generation stats of the run, a summary in the Prometheus text format for a .prom file, otherwise one JSON line per request (tokens, durations, time to first token).",
+    default=None,
+    type=click.Path(exists=False, file_okay=True, dir_okay=False),
+)
+@chunking_options
+@system_prompt_option
+def extract_knowledge(text_file: str, output_file: str, model_name: str, metadata: str, ontology_embedding_file: str | None = None, embedding_model_name: str = "mistralai/Mistral-7B-v0.1", index_backend: str = "auto", temperature: float | None = None, no_cache: bool = False, verbose: bool = False, structured_output: bool = False, stats_file: str | None = None, chunk_tokens: int = 0, chunk_overlap: int = 1, tokenizer: str | None = None, concurrency: int = 4, system_prompt: bool = True):
+    configure_response_cache(enabled=not no_cache)
+    if verbose:
+        configure_ollama(verbose=True)
     if metadata and os.path.exists(metadata):
         with open(metadata, "r") as f:
             metadata = f.read()
     else:
         metadata = {} # type: ignore
 
+    if ontology_embedding_file:
+        check_ontology_embeddings(ontology_embedding_file)
+        df, vectors = load_ontology_embeddings(ontology_embedding_file)
+        index = open_index(ontology_prefix(ontology_embedding_file), vectors, backend=index_backend)
+    else:
+        df = None
+        index = None
+
     with open(text_file, "r") as f:
         text = f.read()
-        relations = extract_relations_from_text(
-            text, model=model_name, metadata=metadata
-        )
 
-    if relations:
+    knowledge = extract_in_windows(
+        extract_knowledge_from_text,
+        text,
+        split_windows(text, chunk_tokens, chunk_overlap, tokenizer),
+        concurrency=concurrency,
+        model=model_name,
+        metadata=metadata,
+        embeddings=df,
+        embedding_model_name=embedding_model_name,
+        index=index,
+        options=make_options(temperature),
+        structured_output=structured_output,
+        use_system=system_prompt,
+    )
+
+    if knowledge.get("entities") or knowledge.get("relations"):
+        if os.path.dirname(output_file) and not os.path.exists(os.path.dirname(output_file)):
+            os.makedirs(os.path.dirname(output_file))
+
         with open(output_file, "w") as f:
-            relations_str = json.dumps(relations, indent=4)
-            f.write(relations_str)
+            f.write(json.dumps(knowledge, indent=4))
     else:
-        print(f"No relations found for the {text_file} file.")
+        print(f"No entities or relations found for the {text_file} file.")
+
+    report_stats(stats_file)
 
 
 @cli.command(
@@ -185,14 +583,14 @@ def extract_relations(text_file: str, model_name: str, metadata: str, output_fil
 @click.option(
     "--input-file",
     "-i",
-    help="A json file which contains a list of texts.",
+    help="A json file which contains a list of texts (a list of {title, abstract} objects), or a JSONL file with one object per line. It is read as a stream.",
     required=True,
     type=click.Path(exists=True, file_okay=True, dir_okay=False),
 )
 @click.option(
     "--output-file",
     "-o",
-    help="Output file.",
+    help="Output file. The outputs are appended to a JSONL journal next to it (the same name with the .jsonl extension), and an interrupted run resumes from the journal. Use --compact-output to write the JSON list to the output file.",
     required=True,
     type=click.Path(exists=False, file_okay=True, dir_okay=False),
 )
@@ -202,43 +600,210 @@ def extract_relations(text_file: str, model_name: str, metadata: str, output_fil
     help="Model name. You can use any model which supported by ollama.ai. If you don't know which models are available, you can use the command `ollama list` to list all installed models or visit https://ollama.ai/library. Default: mistral-openorca:latest",
     default="mistral-openorca:latest",
 )
-def classify_article(input_file: str, output_file: str, model_name: str):
+@click.option(
+    "--concurrency",
+    "-c",
+    help="Number of requests in flight. It should match OLLAMA_NUM_PARALLEL of the Ollama server, a larger value only makes the requests wait in its queue. The results are written in the input order. Default: 1",
+    default=1,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--temperature",
+    "-t",
+    help="Sampling temperature of the model. The requests with temperature 0 are served from the response cache when they are sent again. Default: the model default",
+    default=None,
+    type=float,
+)
+@click.option(
+    "--no-cache",
+    is_flag=True,
+    help="Don't read or write the response cache, which is at ~/.cache/text2knowledge/responses.sqlite (the TEXT2KNOWLEDGE_CACHE_DIR environment variable changes the directory).",
+)
+@click.option(
+    "--verbose",
+    "-v",
+    is_flag=True,
+    help="Print the tokens of the model responses as they arrive.",
+)
+@click.option(
+    "--structured-output",
+    is_flag=True,
+    help="Constrain the model responses to the JSON schema of the task (the `format` parameter of Ollama, it needs Ollama 0.5 or later), and cap the number of generated tokens per task. The responses are validated against the schema instead of being searched for JSON.",
+)
+@click.option(
+    "--stats-file",
+    help="Save the generation stats of the run, a summary in the Prometheus text format for a .prom file, otherwise one JSON line per request (tokens, durations, time to first token).",
+    default=None,
+    type=click.Path(exists=False, file_okay=True, dir_okay=False),
+)
+@click.option(
+    "--checkpoint-every",
+    help="Number of outputs between two checkpoints of the journal. An interrupted run resumes from the last checkpoint. Default: 100",
+    default=100,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--compact-output",
+    is_flag=True,
+    help="Write the outputs of the journal to the output file as a JSON list after the run.",
+)
+@click.option(
+    "--escalate-to",
+    multiple=True,
+    help="A larger model for the doubtful classifications, it can be repeated to build a cascade from the cheapest to the largest model. The --model-name model answers first, and a text is escalated to the next model on a parse failure, an Unknown category or a low self-reported confidence. Default: no cascade",
+)
+@click.option(
+    "--min-confidence",
+    help="The lowest self-reported confidence (1 to 5) which is accepted without escalation, only used with --escalate-to. Default: 4",
+    default=4,
+    type=click.IntRange(min=1, max=5),
+)
+@click.option(
+    "--escalate-unknown/--no-escalate-unknown",
+    help="Escalate the texts which are classified as Unknown, only used with --escalate-to. Default: escalate",
+    default=True,
+)
+@click.option(
+    "--knn-store",
+    help="A directory of labelled articles for the kNN pre-classifier. A text gets the category of its nearest labelled articles when they agree and are similar enough, otherwise the model classifies it and the text is added to the store, so the next texts and runs need fewer model calls. Default: no pre-classifier",
+    default=None,
+    type=click.Path(exists=False, file_okay=False, dir_okay=True),
+)
+@click.option(
+    "--knn-seed",
+    multiple=True,
+    help="A classify-article output file (such as classfication/results/mixtral_8x22b.json) whose labelled articles are added to the --knn-store, it can be repeated. The articles which are in the store already are skipped.",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False),
+)
+@click.option(
+    "--knn-embedding-model",
+    help="Embedding model of the --knn-store. Default: mistralai/Mistral-7B-v0.1",
+    default="mistralai/Mistral-7B-v0.1",
+)
+@click.option(
+    "--knn-k",
+    help="Number of neighbours of the kNN pre-classifier. Default: the value saved in the --knn-store, or 5",
+    default=None,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--knn-min-similarity",
+    help="The lowest mean cosine similarity of the agreeing neighbours. Default: the value calibrated on a held-out fifth of the --knn-seed articles (the lowest one with a precision of 95%), the value saved in the --knn-store, or 0.9",
+    default=None,
+    type=click.FloatRange(min=-1, max=1),
+)
+@click.option(
+    "--knn-min-agreement",
+    help="The lowest fraction of the neighbours which agree on the category. Default: the value saved in the --knn-store, or 0.8",
+    default=None,
+    type=click.FloatRange(min=0, max=1),
+)
+@system_prompt_option
+def classify_article(input_file: str, output_file: str, model_name: str, concurrency: int = 1, temperature: float | None = None, no_cache: bool = False, verbose: bool = False, structured_output: bool = False, stats_file: str | None = None, checkpoint_every: int = 100, compact_output: bool = False, escalate_to: tuple = (), min_confidence: int = 4, escalate_unknown: bool = True, knn_store: str | None = None, knn_seed: tuple = (), knn_embedding_model: str = "mistralai/Mistral-7B-v0.1", knn_k: int | None = None, knn_min_similarity: float | None = None, knn_min_agreement: float | None = None, system_prompt: bool = True):
+    configure_response_cache(enabled=not no_cache)
+    if verbose:
+        configure_ollama(verbose=True)
     if not os.path.exists(input_file):
         raise FileNotFoundError(f"The {input_file} file does not exist.")
 
-    if os.path.exists(output_file):
-        logger.info("The output file exists, so we will load the previous outputs.")
-        with open(output_file, "r") as f:
-            outputs = json.load(f)
-    else:
-        outputs = []
+    # The outputs are appended to a JSONL journal, the JSON output file is written by the compaction.
+    journal_file = output_file if output_file.endswith(".jsonl") else os.path.splitext(output_file)[0] + ".jsonl"
+    if journal_file != output_file and os.path.exists(output_file) and not os.path.exists(journal_file):
+        logger.warning(f"The {output_file} file has no {journal_file} journal to resume from, it is overwritten by --compact-output.")
+    if os.path.dirname(journal_file) and not os.path.exists(os.path.dirname(journal_file)):
+        os.makedirs(os.path.dirname(journal_file))
 
-    processed_titles = set([o.get("title") for o in outputs])
-    with open(input_file, "r") as f:
-        data = json.load(f)
-        for idx, d in enumerate(data):
-            title = d.get("title", "")
+    try:
+        journal = Journal(journal_file, checkpoint_every=checkpoint_every)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    if journal.offset:
+        logger.info(f"Resume after the {journal.offset} texts of the previous run.")
 
-            if title in processed_titles:
-                logger.info(f"Classifying the {idx + 1}th / {len(data)} text: {title} has been processed, so we skip it.")
-                continue
+    knn = None
+    if knn_store:
+        # Imported here, it loads the embedding model.
+        from text2knowledge.knn_classifier import KnnClassifier
+
+        knn = KnnClassifier(knn_store, knn_embedding_model, k=knn_k, min_similarity=knn_min_similarity, min_agreement=knn_min_agreement)
+        print(f"The kNN label store has {knn.seed(list(knn_seed))} labelled articles.")
+        if knn.calibration is not None and knn.calibration["precision"] is not None and not knn.min_similarity_given:
+            print(
+                f"The kNN min similarity is {knn.min_similarity:.4f}, {knn.calibration['precision']:.1%} of its predictions of "
+                f"{knn.calibration['holdout']} held-out articles are right and it labels {knn.calibration['coverage']:.1%} of them."
+            )
 
+    def todo():
+        for idx, d in enumerate(journal.skip(iter_records(input_file)), start=journal.offset):
+            title = d.get("title", "")
             abstract = d.get("abstract", "")
-            text = f"{title}\n{abstract or 'No abstract found.'}"
-            logger.info(f"Classifying the {idx + 1}th / {len(data)} text: {title}")
-            outputs.append(classify_article_from_text(text, model=model_name))
+            yield idx, d, f"{title}\n{abstract or 'No abstract found.'}"
 
-            if idx > 0 and idx % 10 == 0:
-                with open(output_file, "w") as f:
-                    outputs_str = json.dumps(outputs, indent=4)
-                    f.write(outputs_str)
+    async def classify(item):
+        idx, d, text = item
+        logger.info(f"Classifying the {idx + 1}th text: {d.get('title', '')}")
+        vector = None
+        if knn is not None:
+            prediction, vector = await aclient.run(knn.predict, text)
+            if prediction is not None:
+                reason = f"{prediction['agreement']:.0%} of the nearest labelled articles are in this category, with a mean similarity of {prediction['similarity']:.3f}."
+                return d, {"category": prediction["category"], "text": text, "reason": reason, "model": "knn", "knn": prediction}, None
 
-    if outputs:
-        with open(output_file, "w") as f:
-            outputs_str = json.dumps(outputs, indent=4)
-            f.write(outputs_str)
-    else:
+        if escalate_to:
+            output = await aclassify_article_cascade(
+                aclient,
+                text,
+                models=[model_name, *escalate_to],
+                options=make_options(temperature),
+                structured_output=structured_output,
+                min_confidence=min_confidence,
+                escalate_unknown=escalate_unknown,
+                use_system=system_prompt,
+            )
+        else:
+            output = await aclassify_article(aclient, text, model=model_name, options=make_options(temperature), structured_output=structured_output, use_system=system_prompt)
+        return d, output, vector
+
+    counts = {"classified": 0, "escalated": 0, "knn": 0}
+
+    async def run():
+        async for d, output, vector in ordered_map(classify, todo(), window=concurrency * 4):
+            journal.append(d, output)
+            counts["classified"] += 1
+            counts["escalated"] += bool(output.get("escalated"))
+            counts["knn"] += output.get("model") == "knn"
+            # The model labels grow the kNN label store, the kNN labels don't.
+            if vector is not None and not output.get("error") and output.get("category") in ARTICLE_CATEGORIES and output["category"] != "Unknown":
+                knn.add([output["text"]], [output["category"]], vector[None], source=output.get("model", model_name))
+
+    aclient = AsyncOllamaClient(concurrency=concurrency)
+    try:
+        asyncio.run(run())
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    finally:
+        aclient.close()
+        journal.close()
+
+    if knn is not None and counts["classified"]:
+        print(
+            f"The kNN pre-classifier labelled {counts['knn']} of the {counts['classified']} texts of the run "
+            f"({counts['knn'] / counts['classified']:.1%}), the label store has {len(knn)} articles."
+        )
+
+    if escalate_to and counts["classified"]:
+        print(
+            f"Escalated {counts['escalated']} of the {counts['classified']} texts of the run "
+            f"({counts['escalated'] / counts['classified']:.1%}) from {model_name}."
+        )
+
+    if not journal.offset:
         logger.info(f"No valid outputs found for the {input_file} file.")
+    elif compact_output and journal_file != output_file:
+        compact(journal_file, output_file)
+        print(f"The outputs are compacted to {output_file}.")
+
+    report_stats(stats_file)
 
 
 @cli.command(
@@ -264,17 +829,49 @@ def classify_article(input_file: str, output_file: str, model_name: str):
     help="Model name.",
     default="mistralai/Mistral-7B-v0.1",
 )
-def generate_embeddings(input_file: str, output_file: str, model_name: str):
+@click.option(
+    "--batch-size",
+    "-b",
+    help="Number of entities per forward pass. Default: 32",
+    default=32,
+    type=int,
+)
+@click.option(
+    "--output-format",
+    "-f",
+    help="Output format. binary: an embedding matrix (<output-file prefix>.npy) and the entities (<output-file prefix>.parquet), which can be memory-mapped. tsv: the legacy tsv file with a '|'-joined embedding column. Default: binary",
+    default="binary",
+    type=click.Choice(["binary", "tsv"]),
+)
+@click.option(
+    "--inference-profile",
+    "-p",
+    help="How the model runs on the cpu. default: the plain fp32 forward pass. cpu: all cores and bf16 autocast if the cpu supports it. cpu-int8: cpu plus int8 dynamic quantization of the Linear layers. onnx: ONNX Runtime, which needs optimum[onnxruntime]. Default: the TEXT2KNOWLEDGE_INFERENCE_PROFILE environment variable or default",
+    default=None,
+    type=click.Choice(["default", "cpu", "cpu-int8", "onnx"]),
+)
+@click.option(
+    "--num-threads",
+    help="Number of intra-op threads. Default: the number of cpus for the cpu profiles",
+    default=None,
+    type=int,
+)
+def generate_embeddings(input_file: str, output_file: str, model_name: str, batch_size: int = 32, output_format: str = "binary", inference_profile: str | None = None, num_threads: int | None = None):
     if not os.path.exists(input_file):
         raise FileNotFoundError(f"The {input_file} file does not exist.")
 
     with open(input_file, "r") as f:
         entities_df = pd.read_csv(f, sep="\t")
-        embedding_generator = EmbeddingGenerator(model_name=model_name)
-        entities_df["embedding"] = entities_df["name"].apply(lambda x: embedding_generator.gen_text_embedding(x).tolist())
-        entities_df["embedding"] = entities_df["embedding"].apply(lambda x: "|".join([str(i) for i in x]))
+        embedding_generator = EmbeddingGenerator(
+            model_name=model_name, profile=InferenceProfile.from_name(inference_profile, num_threads)
+        )
+        embeddings = embedding_generator.gen_text_embeddings(entities_df["name"].tolist(), batch_size=batch_size)
 
-    if entities_df is not None:
+    if output_format == "binary":
+        vectors_file, metadata_file = save_ontology_embeddings(entities_df, embeddings, ontology_prefix(output_file))
+        print(f"Embeddings are saved in the {vectors_file} and {metadata_file} files.")
+    else:
+        entities_df["embedding"] = ["|".join([str(i) for i in x]) for x in embeddings.tolist()]
         entities_df.to_csv(output_file, sep="\t", index=False)
 
 if __name__ == "__main__":
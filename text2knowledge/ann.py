@@ -0,0 +1,550 @@
+import os
+import hashlib
+import logging
+import numpy as np
+from typing import Optional, Tuple
+from text2knowledge.quantization import QUANTIZERS
+
+try:
+    import faiss  # type: ignore
+except ImportError:
+    faiss = None
+
+logger = logging.getLogger(__name__)
+
+# Below this number of vectors, a brute-force scan is as fast as an index lookup.
+MIN_INDEX_SIZE = 10000
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """L2-normalize the rows of a matrix (or a single vector)."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def row_norms(vectors: np.ndarray, block_size: int = 65536) -> np.ndarray:
+    """L2 norms of the rows, computed block by block so a memmap is not loaded at once."""
+    norms = np.empty(len(vectors), dtype=np.float32)
+    for start in range(0, len(vectors), block_size):
+        block = np.asarray(vectors[start : start + block_size], dtype=np.float32)
+        norms[start : start + len(block)] = np.linalg.norm(block, axis=1)
+
+    return np.maximum(norms, 1e-12)
+
+
+def topk(scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Select the k largest scores of each row without sorting the whole row.
+
+    Args:
+        scores (np.ndarray): Scores with shape (num_queries, num_candidates).
+        k (int): Number of items.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Scores and column indexes with shape (num_queries, k), sorted by score in descending order. Missing items are padded with -inf and -1.
+    """
+    num_queries, num_candidates = scores.shape
+    top_scores = np.full((num_queries, k), -np.inf, dtype=np.float32)
+    top_indexes = np.full((num_queries, k), -1, dtype=np.int64)
+    n = min(k, num_candidates)
+    if n == 0:
+        return top_scores, top_indexes
+
+    if n < num_candidates:
+        indexes = np.argpartition(-scores, n - 1, axis=1)[:, :n]
+    else:
+        indexes = np.tile(np.arange(num_candidates), (num_queries, 1))
+
+    selected = np.take_along_axis(scores, indexes, axis=1)
+    order = np.argsort(-selected, axis=1)
+    top_scores[:, :n] = np.take_along_axis(selected, order, axis=1)
+    top_indexes[:, :n] = np.take_along_axis(indexes, order, axis=1)
+    return top_scores, top_indexes
+
+
+def fingerprint(vectors: np.ndarray, ntotal: int) -> str:
+    """Fingerprint of the first ntotal rows, used to detect a regenerated embedding file."""
+    h = hashlib.sha1(str((ntotal, vectors.shape[1])).encode())
+    if ntotal > 0:
+        h.update(np.asarray(vectors[0], dtype=np.float32).tobytes())
+        h.update(np.asarray(vectors[ntotal - 1], dtype=np.float32).tobytes())
+
+    return h.hexdigest()
+
+
+class ExactIndex:
+    """Brute-force cosine search, the exact fallback of the approximate indexes."""
+
+    kind = "exact"
+
+    def __init__(self, vectors: np.ndarray, block_size: int = 65536):
+        self.vectors = vectors
+        self.block_size = block_size
+        self.norms = row_norms(vectors, block_size)
+
+    @property
+    def ntotal(self) -> int:
+        return len(self.vectors)
+
+    def extend(self, vectors: np.ndarray):
+        """Add the rows of `vectors` which are not indexed yet, such as the new rows of an embedding store."""
+        start = self.ntotal
+        if len(vectors) > start:
+            # The norms are extended before the vectors, so a concurrent search always has the norms of its rows.
+            self.norms = np.concatenate([self.norms, row_norms(vectors[start:], self.block_size)])
+        self.vectors = vectors
+
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Search the k most similar vectors of each query.
+
+        Args:
+            queries (np.ndarray): Queries with shape (num_queries, dim).
+            k (int): Number of items.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Cosine similarities and row numbers with shape (num_queries, k).
+        """
+        vectors, norms = self.vectors, self.norms
+        queries = normalize(np.atleast_2d(queries))
+        top_scores, top_indexes = topk(np.zeros((len(queries), 0), dtype=np.float32), k)
+        for start in range(0, len(vectors), self.block_size):
+            block = np.asarray(vectors[start : start + self.block_size], dtype=np.float32)
+            end = start + len(block)
+            block_scores, block_indexes = topk((queries @ block.T) / norms[start:end], k)
+            # Merge the running top k with the top k of the block, so the memory is bounded by the block size.
+            merged_scores = np.concatenate([top_scores, block_scores], axis=1)
+            merged_indexes = np.concatenate(
+                [top_indexes, np.where(block_indexes >= 0, block_indexes + start, -1)], axis=1
+            )
+            top_scores, positions = topk(merged_scores, k)
+            top_indexes = np.take_along_axis(merged_indexes, positions, axis=1)
+
+        return top_scores, top_indexes
+
+
+class IVFIndex:
+    """Inverted file index in pure NumPy.
+
+    The vectors are clustered with spherical k-means, and a query only scans the vectors
+    of the `nprobe` clusters whose centroids are the most similar to it. A larger `nprobe`
+    gives a higher recall and a higher latency, `nprobe >= nlist` is an exact search.
+
+    The index only keeps the centroids and the inverted lists, the vectors are read from
+    the (memory-mapped) embedding matrix which the index is built from.
+    """
+
+    kind = "ivf"
+
+    def __init__(
+        self,
+        vectors: np.ndarray,
+        centroids: np.ndarray,
+        list_offsets: np.ndarray,
+        list_ids: np.ndarray,
+        norms: np.ndarray,
+        nprobe: int = 16,
+    ):
+        self.vectors = vectors
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_ids = list_ids
+        self.norms = norms
+        self.nprobe = nprobe
+
+    @property
+    def ntotal(self) -> int:
+        return len(self.list_ids)
+
+    @property
+    def nlist(self) -> int:
+        return len(self.centroids)
+
+    @staticmethod
+    def assign(
+        vectors: np.ndarray, centroids: np.ndarray, block_size: int = 65536
+    ) -> np.ndarray:
+        """Assign each vector to the most similar centroid."""
+        assignments = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), block_size):
+            block = normalize(vectors[start : start + block_size])
+            assignments[start : start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+
+        return assignments
+
+    @staticmethod
+    def train(
+        vectors: np.ndarray,
+        nlist: int,
+        niter: int = 10,
+        sample_size: int = 65536,
+        seed: int = 0,
+    ) -> np.ndarray:
+        """Train the centroids with spherical k-means on a sample of the vectors."""
+        rng = np.random.default_rng(seed)
+        sample_ids = np.sort(rng.choice(len(vectors), min(sample_size, len(vectors)), replace=False))
+        sample = normalize(vectors[sample_ids])
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+
+        for _ in range(niter):
+            assignments = IVFIndex.assign(sample, centroids)
+            order = np.argsort(assignments, kind="stable")
+            counts = np.bincount(assignments, minlength=nlist)
+            non_empty = np.flatnonzero(counts)
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[non_empty]
+            # Keep the previous centroid of an empty cluster.
+            sums = centroids.copy()
+            sums[non_empty] = np.add.reduceat(sample[order], starts, axis=0)
+            centroids = normalize(sums)
+
+        return centroids
+
+    @classmethod
+    def build(
+        cls,
+        vectors: np.ndarray,
+        nlist: Optional[int] = None,
+        nprobe: int = 16,
+        niter: int = 10,
+    ) -> "IVFIndex":
+        """Build the index.
+
+        Args:
+            vectors (np.ndarray): Embedding matrix with shape (num_vectors, dim).
+            nlist (int): Number of clusters, defaults to 4 * sqrt(num_vectors).
+            nprobe (int): Number of clusters scanned per query.
+            niter (int): Number of k-means iterations.
+
+        Returns:
+            IVFIndex: Index.
+        """
+        nlist = nlist or int(4 * np.sqrt(len(vectors)))
+        nlist = max(1, min(nlist, len(vectors)))
+        logger.info("Build an IVF index with %s lists for %s vectors." % (nlist, len(vectors)))
+
+        centroids = cls.train(vectors, nlist, niter=niter)
+        list_offsets, list_ids = cls._inverted_lists(cls.assign(vectors, centroids), nlist)
+        return cls(vectors, centroids, list_offsets, list_ids, row_norms(vectors), nprobe)
+
+    @staticmethod
+    def _inverted_lists(
+        assignments: np.ndarray, nlist: int, ids: Optional[np.ndarray] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        ids = np.arange(len(assignments)) if ids is None else ids
+        order = np.argsort(assignments, kind="stable")
+        list_offsets = np.zeros(nlist + 1, dtype=np.int64)
+        list_offsets[1:] = np.cumsum(np.bincount(assignments, minlength=nlist))
+        return list_offsets, ids[order]
+
+    def extend(self, vectors: np.ndarray):
+        """Add the rows of `vectors` which are not indexed yet, such as the new rows of an embedding store."""
+        start = self.ntotal
+        if len(vectors) <= start:
+            self.vectors = vectors
+            return
+
+        new_assignments = self.assign(vectors[start:], self.centroids)
+        old_assignments = np.repeat(np.arange(self.nlist), np.diff(self.list_offsets))
+        self.list_offsets, self.list_ids = self._inverted_lists(
+            np.concatenate([old_assignments, new_assignments]),
+            self.nlist,
+            np.concatenate([self.list_ids, np.arange(start, len(vectors))]),
+        )
+        self.norms = np.concatenate([self.norms, row_norms(vectors[start:])])
+        self.vectors = vectors
+
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Search the k most similar vectors of each query.
+
+        Args:
+            queries (np.ndarray): Queries with shape (num_queries, dim).
+            k (int): Number of items.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Cosine similarities and row numbers with shape (num_queries, k).
+        """
+        queries = normalize(np.atleast_2d(queries))
+        nprobe = max(1, min(self.nprobe, self.nlist))
+        _, probes = topk(queries @ self.centroids.T, nprobe)
+
+        all_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        all_indexes = np.full((len(queries), k), -1, dtype=np.int64)
+        for i, query in enumerate(queries):
+            candidates = np.concatenate(
+                [self.list_ids[self.list_offsets[p] : self.list_offsets[p + 1]] for p in probes[i]]
+            )
+            # Sorted ids make the reads from a memmap sequential.
+            candidates.sort()
+            block = np.asarray(self.vectors[candidates], dtype=np.float32)
+            scores = (block @ query) / self.norms[candidates]
+            top_scores, top_positions = topk(scores[None, :], k)
+            all_scores[i] = top_scores[0]
+            valid = top_positions[0] >= 0
+            all_indexes[i, valid] = candidates[top_positions[0][valid]]
+
+        return all_scores, all_indexes
+
+    def save(self, filepath: str, vectors_fingerprint: str):
+        with open(filepath, "wb") as f:
+            np.savez(
+                f,
+                centroids=self.centroids,
+                list_offsets=self.list_offsets,
+                list_ids=self.list_ids,
+                norms=self.norms,
+                fingerprint=np.array(vectors_fingerprint),
+            )
+
+    @classmethod
+    def load(cls, filepath: str, vectors: np.ndarray, nprobe: int = 16) -> Tuple["IVFIndex", str]:
+        data = np.load(filepath)
+        index = cls(
+            vectors,
+            data["centroids"],
+            data["list_offsets"],
+            data["list_ids"],
+            data["norms"],
+            nprobe,
+        )
+        return index, str(data["fingerprint"])
+
+
+class FaissIndex:
+    """IVF index backed by faiss-cpu, which is an optional dependency."""
+
+    kind = "faiss"
+
+    def __init__(self, index, nprobe: int = 16):
+        self.index = index
+        self.nprobe = nprobe
+
+    @property
+    def ntotal(self) -> int:
+        return int(self.index.ntotal)
+
+    @classmethod
+    def build(
+        cls, vectors: np.ndarray, nlist: Optional[int] = None, nprobe: int = 16
+    ) -> "FaissIndex":
+        nlist = nlist or int(4 * np.sqrt(len(vectors)))
+        nlist = max(1, min(nlist, len(vectors)))
+        logger.info("Build a faiss IVF index with %s lists for %s vectors." % (nlist, len(vectors)))
+
+        dim = vectors.shape[1]
+        quantizer = faiss.IndexFlatIP(dim)
+        index = faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT)
+        rng = np.random.default_rng(0)
+        sample_ids = np.sort(rng.choice(len(vectors), min(65536, len(vectors)), replace=False))
+        index.train(normalize(vectors[sample_ids]))
+
+        faiss_index = cls(index, nprobe)
+        faiss_index.extend(vectors)
+        return faiss_index
+
+    def extend(self, vectors: np.ndarray, block_size: int = 65536):
+        for start in range(self.ntotal, len(vectors), block_size):
+            self.index.add(normalize(vectors[start : start + block_size]))
+
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        self.index.nprobe = self.nprobe
+        scores, indexes = self.index.search(normalize(np.atleast_2d(queries)), k)
+        scores[indexes < 0] = -np.inf
+        return scores, indexes
+
+    def save(self, filepath: str, vectors_fingerprint: str):
+        faiss.write_index(self.index, filepath)
+        with open(filepath + ".fingerprint", "w") as f:
+            f.write(vectors_fingerprint)
+
+    @classmethod
+    def load(cls, filepath: str, vectors: np.ndarray, nprobe: int = 16) -> Tuple["FaissIndex", str]:
+        with open(filepath + ".fingerprint", "r") as f:
+            vectors_fingerprint = f.read()
+
+        return cls(faiss.read_index(filepath), nprobe), vectors_fingerprint
+
+
+class QuantizedIndex:
+    """Search on compressed codes, then re-score a shortlist with the full-precision vectors.
+
+    The codes (one byte per dimension for sq8, m bytes for pq) are kept in memory, and the
+    full-precision vectors are only read for the `rescore` best candidates of each query,
+    so the (memory-mapped) embedding matrix doesn't need to be resident in RAM.
+    """
+
+    kind = "quantized"
+
+    def __init__(self, vectors: np.ndarray, quantizer, codes: np.ndarray, rescore: int = 100):
+        self.vectors = vectors
+        self.quantizer = quantizer
+        self.codes = codes
+        self.rescore = rescore
+        self._saved = 0
+
+    @property
+    def ntotal(self) -> int:
+        return len(self.codes)
+
+    @property
+    def memory_usage(self) -> int:
+        """Number of bytes used by the codes."""
+        return int(self.codes.nbytes)
+
+    @classmethod
+    def build(
+        cls, vectors: np.ndarray, method: str = "sq8", rescore: int = 100, **kwargs
+    ) -> "QuantizedIndex":
+        """Build the index.
+
+        Args:
+            vectors (np.ndarray): Embedding matrix with shape (num_vectors, dim).
+            method (str): sq8 (8-bit scalar quantization) or pq (product quantization).
+            rescore (int): Number of candidates re-scored with the full-precision vectors per query.
+
+        Returns:
+            QuantizedIndex: Index.
+        """
+        logger.info("Build a %s index for %s vectors." % (method, len(vectors)))
+        quantizer = QUANTIZERS[method].train(vectors, **kwargs)
+        index = cls(vectors, quantizer, np.zeros((0, quantizer.code_size), dtype=np.uint8), rescore)
+        index.extend(vectors)
+        return index
+
+    def extend(self, vectors: np.ndarray, block_size: int = 65536):
+        """Encode the rows of `vectors` which are not indexed yet."""
+        new_codes = [
+            self.quantizer.encode(vectors[start : start + block_size])
+            for start in range(self.ntotal, len(vectors), block_size)
+        ]
+        if new_codes:
+            self.codes = np.concatenate([self.codes] + new_codes)
+
+        self.vectors = vectors
+
+    def search(self, queries: np.ndarray, k: int, block_size: int = 65536) -> Tuple[np.ndarray, np.ndarray]:
+        """Search the k most similar vectors of each query.
+
+        Args:
+            queries (np.ndarray): Queries with shape (num_queries, dim).
+            k (int): Number of items.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Cosine similarities (re-scored with the full-precision vectors) and row numbers with shape (num_queries, k).
+        """
+        queries = normalize(np.atleast_2d(queries))
+        shortlist = max(k, self.rescore)
+        top_scores, top_indexes = topk(np.zeros((len(queries), 0), dtype=np.float32), shortlist)
+        for start in range(0, self.ntotal, block_size):
+            block_scores, block_indexes = topk(
+                self.quantizer.scores(self.codes[start : start + block_size], queries), shortlist
+            )
+            merged_scores = np.concatenate([top_scores, block_scores], axis=1)
+            merged_indexes = np.concatenate(
+                [top_indexes, np.where(block_indexes >= 0, block_indexes + start, -1)], axis=1
+            )
+            top_scores, positions = topk(merged_scores, shortlist)
+            top_indexes = np.take_along_axis(merged_indexes, positions, axis=1)
+
+        all_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        all_indexes = np.full((len(queries), k), -1, dtype=np.int64)
+        for i, query in enumerate(queries):
+            candidates = np.sort(top_indexes[i][top_indexes[i] >= 0])
+            block = np.asarray(self.vectors[candidates], dtype=np.float32)
+            scores = (block @ query) / np.maximum(np.linalg.norm(block, axis=1), 1e-12)
+            rescored, positions = topk(scores[None, :], k)
+            all_scores[i] = rescored[0]
+            valid = positions[0] >= 0
+            all_indexes[i, valid] = candidates[positions[0][valid]]
+
+        return all_scores, all_indexes
+
+    def save(self, filepath: str, vectors_fingerprint: str):
+        codes_file = filepath + ".codes"
+        with open(filepath, "wb") as f:
+            np.savez(f, fingerprint=np.array(vectors_fingerprint), **self.quantizer.state())
+
+        # The codes are append-only, only the rows which are not saved yet are written.
+        saved = self._saved if os.path.exists(codes_file) else 0
+        with open(codes_file, "r+b" if saved else "wb") as f:
+            f.seek(saved * self.quantizer.code_size)
+            f.truncate()
+            f.write(np.ascontiguousarray(self.codes[saved:]).tobytes())
+
+        self._saved = self.ntotal
+
+    @classmethod
+    def load(
+        cls, filepath: str, vectors: np.ndarray, rescore: int = 100, **kwargs
+    ) -> Tuple["QuantizedIndex", str]:
+        state = np.load(filepath)
+        quantizer = QUANTIZERS[str(state["method"])].from_state(state)
+        codes = np.fromfile(filepath + ".codes", dtype=np.uint8).reshape(-1, quantizer.code_size)
+        index = cls(vectors, quantizer, codes, rescore)
+        index._saved = index.ntotal
+        return index, str(state["fingerprint"])
+
+
+def open_index(
+    prefix: str,
+    vectors: np.ndarray,
+    backend: str = "auto",
+    nprobe: int = 16,
+    nlist: Optional[int] = None,
+    min_size: int = MIN_INDEX_SIZE,
+    rescore: int = 100,
+):
+    """Load the index persisted next to an embedding matrix, or build and persist it.
+
+    The index is extended with the rows which were appended after it was saved, and
+    rebuilt if the embedding matrix was regenerated.
+
+    Args:
+        prefix (str): Path prefix of the index file, such as the path of the embedding file.
+        vectors (np.ndarray): Embedding matrix with shape (num_vectors, dim).
+        backend (str): One of auto, faiss, ivf, sq8, pq and exact. auto picks faiss if it is installed, otherwise ivf. sq8 and pq search on quantized codes and re-score a shortlist with the full-precision vectors.
+        nprobe (int): Number of clusters scanned per query, trades recall for latency.
+        nlist (int): Number of clusters when the index is built.
+        min_size (int): Use the exact search when there are fewer vectors than this.
+        rescore (int): Shortlist size of the sq8 and pq backends, trades recall for latency.
+
+    Returns:
+        ExactIndex | IVFIndex | FaissIndex | QuantizedIndex: Index.
+    """
+    if backend not in ("auto", "faiss", "ivf", "sq8", "pq", "exact"):
+        raise ValueError("Unknown index backend: %s" % backend)
+
+    if backend == "exact" or len(vectors) < min_size:
+        return ExactIndex(vectors)
+
+    if backend == "auto":
+        backend = "faiss" if faiss is not None else "ivf"
+    elif backend == "faiss" and faiss is None:
+        raise ImportError("faiss is not installed, please install faiss-cpu or use the ivf backend.")
+
+    if backend in QUANTIZERS:
+        filepath = prefix + ".%s.npz" % backend
+        load = lambda: QuantizedIndex.load(filepath, vectors, rescore=rescore)
+        build = lambda: QuantizedIndex.build(vectors, method=backend, rescore=rescore)
+    else:
+        index_class = FaissIndex if backend == "faiss" else IVFIndex
+        filepath = prefix + (".faiss" if backend == "faiss" else ".ivf.npz")
+        load = lambda: index_class.load(filepath, vectors, nprobe=nprobe)
+        build = lambda: index_class.build(vectors, nlist=nlist, nprobe=nprobe)
+
+    index = None
+    if os.path.exists(filepath):
+        index, saved_fingerprint = load()
+        if index.ntotal > len(vectors) or saved_fingerprint != fingerprint(vectors, index.ntotal):
+            logger.info("The embeddings of %s have changed, rebuild the index." % filepath)
+            index = None
+        elif index.ntotal < len(vectors):
+            logger.info("Add %s new vectors to %s." % (len(vectors) - index.ntotal, filepath))
+            index.extend(vectors)
+            index.save(filepath, fingerprint(vectors, index.ntotal))
+        else:
+            index.extend(vectors)
+
+    if index is None:
+        index = build()
+        index.save(filepath, fingerprint(vectors, index.ntotal))
+
+    return index
@@ -0,0 +1,222 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+import unicodedata
+import numpy as np
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def default_cache_dir() -> str:
+    """Cache directory, read from the TEXT2KNOWLEDGE_CACHE_DIR environment variable."""
+    return os.environ.get(
+        "TEXT2KNOWLEDGE_CACHE_DIR",
+        os.path.join(os.path.expanduser("~"), ".cache", "text2knowledge"),
+    )
+
+
+def env_flag(name: str, default: bool = True) -> bool:
+    value = os.environ.get(name)
+    if value is None:
+        return default
+
+    return value.strip().lower() not in ("0", "false", "no", "off", "")
+
+
+def env_bytes(name: str, default_gb: float) -> int:
+    """Read a size in GB from an environment variable."""
+    return int(float(os.environ.get(name, default_gb)) * 1024**3)
+
+
+class DiskCache:
+    """Key-value cache in a SQLite file, with a size cap and LRU eviction.
+
+    Several processes can use the same file at once: SQLite serializes the writers,
+    and the WAL journal lets the readers run while a writer is active. The total size of
+    the values is kept in the cache_meta table by triggers, so a write doesn't scan the cache.
+    """
+
+    def __init__(self, path: str, max_bytes: Optional[int] = None, timeout: float = 60):
+        """Open (or create) the cache.
+
+        Args:
+            path (str): Path of the SQLite file.
+            max_bytes (int): Size cap of the values, the least recently used entries are evicted beyond it. None means no limit.
+            timeout (float): Seconds to wait for the lock of another process.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS cache_meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            # A cache of an older version has no total yet, it is computed once.
+            self._conn.execute(
+                "INSERT OR IGNORE INTO cache_meta (name, value) SELECT 'size', COALESCE(SUM(size), 0) FROM cache"
+            )
+            self._conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS cache_size_insert AFTER INSERT ON cache BEGIN "
+                "UPDATE cache_meta SET value = value + new.size WHERE name = 'size'; END"
+            )
+            self._conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS cache_size_delete AFTER DELETE ON cache BEGIN "
+                "UPDATE cache_meta SET value = value - old.size WHERE name = 'size'; END"
+            )
+            self._conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS cache_size_update AFTER UPDATE OF size ON cache BEGIN "
+                "UPDATE cache_meta SET value = value + new.size - old.size WHERE name = 'size'; END"
+            )
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    @property
+    def size(self) -> int:
+        """Number of bytes of all values."""
+        with self._lock:
+            return self._total()
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys: List[str], chunk_size: int = 500) -> Dict[str, bytes]:
+        """Get the values of the keys which are in the cache, and mark them as recently used."""
+        found: Dict[str, bytes] = {}
+        keys = list(dict.fromkeys(keys))
+        with self._lock, self._conn:
+            for start in range(0, len(keys), chunk_size):
+                chunk = keys[start : start + chunk_size]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    "SELECT key, value FROM cache WHERE key IN (%s)" % placeholders, chunk
+                ).fetchall()
+                found.update(rows)
+
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE cache SET accessed = ? WHERE key = ?", [(now, k) for k in found]
+                )
+
+        return found
+
+    def set(self, key: str, value: bytes):
+        self.set_many([(key, value)])
+
+    def set_many(self, items: Iterable[Tuple[str, bytes]]):
+        now = time.time()
+        rows = [(k, sqlite3.Binary(v), len(v), now) for k, v in items]
+        if not rows:
+            return
+
+        with self._lock, self._conn:
+            # An upsert instead of INSERT OR REPLACE, the delete triggers don't fire on a replace.
+            self._conn.executemany(
+                "INSERT INTO cache (key, value, size, accessed) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET value = excluded.value, size = excluded.size, accessed = excluded.accessed",
+                rows,
+            )
+            self._evict()
+
+    def _total(self) -> int:
+        return self._conn.execute("SELECT value FROM cache_meta WHERE name = 'size'").fetchone()[0]
+
+    def _evict(self):
+        if self.max_bytes is None:
+            return
+
+        excess = self._total() - self.max_bytes
+        if excess <= 0:
+            return
+
+        keys = []
+        for key, size in self._conn.execute("SELECT key, size FROM cache ORDER BY accessed"):
+            keys.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+
+        logger.info("Evict %s entries from %s." % (len(keys), self.path))
+        self._conn.executemany("DELETE FROM cache WHERE key = ?", keys)
+
+    def delete(self, key: str):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM cache")
+
+
+def normalize_text(text: str) -> str:
+    """Normalize the unicode form and the whitespaces, so trivially different strings share an entry."""
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFC", text)).strip()
+
+
+class EmbeddingCache:
+    """Content-addressed embedding cache.
+
+    The embeddings are keyed by (model name, pooling mode, sha256 of the normalized text),
+    so a string costs one forward pass no matter which command or file it comes from.
+    """
+
+    def __init__(self, path: Optional[str] = None, max_bytes: Optional[int] = None):
+        """Open (or create) the cache.
+
+        Args:
+            path (str): Path of the SQLite file, defaults to <cache dir>/embeddings.sqlite.
+            max_bytes (int): Size cap, defaults to the TEXT2KNOWLEDGE_EMBEDDING_CACHE_GB environment variable or 10 GB.
+        """
+        path = path or os.path.join(default_cache_dir(), "embeddings.sqlite")
+        max_bytes = max_bytes or env_bytes("TEXT2KNOWLEDGE_EMBEDDING_CACHE_GB", 10)
+        self.cache = DiskCache(path, max_bytes=max_bytes)
+
+    @staticmethod
+    def key(model_name: str, pooling: str, text: str) -> str:
+        digest = hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+        return "%s\x00%s\x00%s" % (model_name, pooling, digest)
+
+    def get_many(self, model_name: str, pooling: str, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """Get the cached embeddings, None for the texts which are not cached."""
+        keys = [self.key(model_name, pooling, text) for text in texts]
+        found = self.cache.get_many(keys)
+        return [
+            np.frombuffer(found[key], dtype=np.float32) if key in found else None
+            for key in keys
+        ]
+
+    def set_many(self, model_name: str, pooling: str, texts: List[str], embeddings: np.ndarray):
+        self.cache.set_many(
+            (self.key(model_name, pooling, text), np.asarray(embedding, dtype=np.float32).tobytes())
+            for text, embedding in zip(texts, embeddings)
+        )
+
+
+_embedding_cache: Optional[EmbeddingCache] = None
+
+
+def get_embedding_cache() -> Optional[EmbeddingCache]:
+    """Get the process-wide embedding cache, None if TEXT2KNOWLEDGE_EMBEDDING_CACHE is set to 0."""
+    global _embedding_cache
+    if not env_flag("TEXT2KNOWLEDGE_EMBEDDING_CACHE"):
+        return None
+
+    if _embedding_cache is None:
+        _embedding_cache = EmbeddingCache()
+
+    return _embedding_cache
@@ -0,0 +1,107 @@
+import re
+import math
+import logging
+from typing import List
+
+logger = logging.getLogger(__name__)
+
+# A sentence ends with a period, a question mark or an exclamation mark followed by a capital letter, a digit
+# or a bracket, so the abbreviations in the middle of a sentence (e.g. "e.g. the") don't split it. Blank
+# lines (the paragraphs of pdf2text) always split.
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+(?=[A-Z0-9(\[])|\n\s*\n")
+
+
+class TokenCounter:
+    """Count the tokens of a text for the target model.
+
+    Ollama doesn't expose the tokenizer of its models, so the tokenizer of the same model family is loaded
+    from Hugging Face (such as mistralai/Mistral-7B-v0.1 for mistral-openorca). Without a tokenizer, the count
+    is estimated from the number of characters, which is conservative for English and biomedical text.
+    """
+
+    def __init__(self, tokenizer_name: str | None = None, chars_per_token: float = 3.0):
+        """Initialize the counter.
+
+        Args:
+            tokenizer_name (str): A Hugging Face tokenizer name, None to estimate the count.
+            chars_per_token (float): Characters per token of the estimate.
+        """
+        self.tokenizer = None
+        self.chars_per_token = chars_per_token
+        if tokenizer_name:
+            from transformers import AutoTokenizer
+
+            self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+
+    def count(self, text: str) -> int:
+        if self.tokenizer is not None:
+            return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+        return math.ceil(len(text) / self.chars_per_token)
+
+
+def split_sentences(text: str) -> List[str]:
+    return [sentence.strip() for sentence in SENTENCE_BOUNDARY.split(text) if sentence and sentence.strip()]
+
+
+def _split_long_sentence(sentence: str, max_tokens: int, counter: TokenCounter) -> List[str]:
+    """Split a sentence which doesn't fit a window on the word boundaries."""
+    pieces, words = [], []
+    for word in sentence.split():
+        if words and counter.count(" ".join(words + [word])) > max_tokens:
+            pieces.append(" ".join(words))
+            words = []
+        words.append(word)
+
+    if words:
+        pieces.append(" ".join(words))
+
+    return pieces
+
+
+def chunk_text(text: str, max_tokens: int = 1024, overlap: int = 1, counter: TokenCounter | None = None) -> List[str]:
+    """Split a text into windows of whole sentences, each window has at most max_tokens tokens.
+
+    The consecutive windows share `overlap` sentences, so an entity or a relation which spans
+    the end of a window is complete in the next one. A text which fits a window is a single
+    window.
+
+    Args:
+        text (str): The text.
+        max_tokens (int): Token budget of the text of a window, without the prompt and the response.
+        overlap (int): Number of sentences shared by consecutive windows.
+        counter (TokenCounter): Token counter of the target model, defaults to the estimate.
+
+    Returns:
+        List[str]: The windows.
+    """
+    counter = counter or TokenCounter()
+    if counter.count(text) <= max_tokens:
+        return [text]
+
+    sentences = []
+    for sentence in split_sentences(text):
+        if counter.count(sentence) > max_tokens:
+            sentences.extend(_split_long_sentence(sentence, max_tokens, counter))
+        else:
+            sentences.append(sentence)
+    counts = [counter.count(sentence) for sentence in sentences]
+
+    windows = []
+    start = 0
+    while start < len(sentences):
+        end, tokens = start, 0
+        # A window has one sentence at least, the long sentences are split above.
+        while end < len(sentences) and (end == start or tokens + counts[end] <= max_tokens):
+            tokens += counts[end]
+            end += 1
+
+        windows.append(" ".join(sentences[start:end]))
+        if end >= len(sentences):
+            break
+
+        # The next window starts `overlap` sentences before the end, and moves forward by one sentence at least.
+        start = max(end - overlap, start + 1)
+
+    logger.info(f"Split the text into {len(windows)} windows of at most {max_tokens} tokens.")
+    return windows
@@ -0,0 +1,294 @@
+import os
+import json
+import asyncio
+import hashlib
+import logging
+from typing import Any, Callable, Dict, Iterable, Iterator, Tuple
+
+from text2knowledge.dedup import is_duplicate
+from text2knowledge.ollama.async_client import AsyncOllamaClient, ordered_map
+from text2knowledge.ollama.json_stream import JsonStreamParser
+
+logger = logging.getLogger(__name__)
+
+# The fields of a JSONL document which identify it, in order of preference.
+ID_FIELDS = ("id", "pmid", "name")
+# The label of the text chunks of `extract.py text-chunks`, a chunk is identified by its name (the chunks of a paper share the pmid).
+CHUNK_LABEL = "pubtext"
+
+
+def document_id(record: Dict, line_number: int) -> str:
+    if record.get("label") == CHUNK_LABEL and record.get("name") not in (None, ""):
+        return str(record["name"])
+
+    return next((str(record[k]) for k in ID_FIELDS if record.get(k) not in (None, "")), str(line_number))
+
+
+def is_corpus(path: str) -> bool:
+    """Whether the input of a command is a corpus (a directory or a JSONL file) instead of a single text file."""
+    return os.path.isdir(path) or path.endswith(".jsonl")
+
+
+def iter_documents(path: str) -> Iterator[Dict]:
+    """Yield the documents of a corpus, each document is a dict with the id, text and metadata fields.
+
+    A directory holds one .txt file per document, such as the output of `extract.py abstract`, and
+    the id is the file name without the extension. A JSONL file holds one JSON object per line,
+    with a text field (or title and abstract fields) and an id, pmid or name field, the other fields
+    are the metadata. The text chunks of `extract.py text-chunks` are identified by their name, and
+    the near-duplicates which are tagged by its --dedup are skipped. The documents are read lazily.
+    """
+    if os.path.isdir(path):
+        for filename in sorted(os.listdir(path)):
+            if not filename.endswith(".txt"):
+                continue
+
+            with open(os.path.join(path, filename), "r") as f:
+                yield {"id": filename[: -len(".txt")], "text": f.read(), "metadata": {"filename": filename}}
+        return
+
+    with open(path, "r") as f:
+        for line_number, line in enumerate(f):
+            if not line.strip():
+                continue
+
+            record = json.loads(line)
+            if is_duplicate(record):
+                logger.info(f"Skip the line {line_number + 1}, it is a near-duplicate of {record['duplicate_of']}.")
+                continue
+
+            doc_id = document_id(record, line_number)
+            text = record.get("text") or "\n".join(
+                str(record[k]) for k in ("title", "abstract") if record.get(k)
+            )
+            metadata = {k: v for k, v in record.items() if k not in ("text", "abstract", "duplicate_of")}
+            yield {"id": doc_id, "text": text, "metadata": metadata}
+
+
+def output_path(output_dir: str, doc_id: str, suffix: str = "") -> str:
+    # The ids become file names, so the path separators are replaced.
+    filename = doc_id.replace(os.sep, "_").replace("/", "_")
+    return os.path.join(output_dir, f"{filename}{suffix}.json")
+
+
+class Manifest:
+    """An append-only log of the processed documents of a corpus run.
+
+    A line is written per document when its output is saved, so an interrupted run resumes from
+    the manifest without opening the outputs. The documents with the done or empty status are
+    skipped, the failed documents are retried.
+    """
+
+    SKIP = ("done", "empty")
+
+    def __init__(self, path: str):
+        self.path = path
+        self.processed = set()
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # The last line of an interrupted run can be cut.
+                        continue
+                    if entry.get("status") in self.SKIP:
+                        self.processed.add(entry["id"])
+
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self.processed
+
+    def record(self, doc_id: str, status: str, output: str | None = None, error: str | None = None):
+        entry = {"id": doc_id, "status": status, "output": output}
+        if error:
+            entry["error"] = error
+
+        with open(self.path, "a") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+        if status in self.SKIP:
+            self.processed.add(doc_id)
+
+
+def run_corpus(
+    input_path: str,
+    output_dir: str,
+    process: Callable[[Dict], Tuple[str, str | None]],
+    concurrency: int = 4,
+    manifest_name: str = "manifest.jsonl",
+) -> Dict[str, int]:
+    """Process the documents of a corpus in one process, through a work queue of `concurrency` workers.
+
+    Args:
+        input_path (str): A directory or a JSONL file, see iter_documents.
+        output_dir (str): The directory of the outputs and of the manifest.
+        process (Callable): Process a document and save its output, it returns the status (done, empty
+            or error) and the output path. It runs in the worker threads.
+        concurrency (int): Number of documents in flight.
+        manifest_name (str): File name of the manifest in the output directory.
+
+    Returns:
+        Dict[str, int]: The number of documents per status, the skipped documents included.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = Manifest(os.path.join(output_dir, manifest_name))
+    counts = {"skipped": 0}
+
+    def todo():
+        for doc in iter_documents(input_path):
+            if doc["id"] in manifest:
+                counts["skipped"] += 1
+                continue
+            yield doc
+
+    async def handle(doc):
+        try:
+            status, output = await aclient.run(process, doc)
+            return doc, status, output, None
+        except Exception as e:
+            logger.warning(f"Failed to process the document {doc['id']}: {e}")
+            return doc, "error", None, str(e)
+
+    async def run():
+        async for doc, status, output, error in ordered_map(handle, todo(), window=concurrency * 2):
+            manifest.record(doc["id"], status, output, error)
+            counts[status] = counts.get(status, 0) + 1
+            logger.info(f"Processed the document {doc['id']}: {status}")
+
+    aclient = AsyncOllamaClient(concurrency=concurrency)
+    try:
+        asyncio.run(run())
+    finally:
+        aclient.close()
+
+    return counts
+
+
+def iter_records(path: str, chunk_size: int = 1 << 20) -> Iterator[Dict]:
+    """Yield the objects of a JSON array file or of a JSONL file, without loading the whole file."""
+    with open(path, "r") as f:
+        if path.endswith(".jsonl"):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
+
+        parser = JsonStreamParser(keep_value=False)
+        while not parser.done:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield from parser.feed(chunk)
+
+
+def _fsync_replace(path: str, data: str):
+    """Replace a file atomically, a crash leaves the old or the new content."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class Journal:
+    """An append-only JSONL output of a run over an input stream, which resumes after an interruption.
+
+    An output line is appended per input item, in the input order. Every `checkpoint_every` items the
+    journal is fsync'd, then the marker file (<path>.ckpt) records the number of input items which
+    are done (the offset), a hash of these items and the size of the journal. A resumed run truncates
+    the lines written after the last marker, checks that the first `offset` items of the input hash
+    to the same value, and skips them, so the checkpoint cost doesn't grow with the size of the run.
+    A non-empty file without a marker is not a journal, opening it raises a ValueError.
+    """
+
+    def __init__(self, path: str, checkpoint_every: int = 100):
+        self.path = path
+        self.marker_path = f"{path}.ckpt"
+        self.checkpoint_every = checkpoint_every
+        self.offset = 0
+        self._size = 0
+        self._expected_hash = None
+        self._hash = hashlib.sha256()
+        self._pending = 0
+
+        if os.path.exists(self.marker_path) and os.path.exists(path):
+            with open(self.marker_path, "r") as f:
+                marker = json.load(f)
+            self.offset, self._size, self._expected_hash = marker["offset"], marker["size"], marker["hash"]
+            if os.path.getsize(path) < self._size:
+                raise ValueError(f"The {path} file is shorter than its checkpoint, it was modified since the last run.")
+        elif os.path.exists(path) and os.path.getsize(path) > 0:
+            # A journal always has a marker, so this file is not a journal, and truncating it would wipe it.
+            raise ValueError(f"The {path} file has no {self.marker_path} checkpoint, it isn't the journal of a run. Remove it to start over.")
+
+        self._file = open(path, "ab")
+        # Drop the lines after the last checkpoint, their items are processed again.
+        self._file.truncate(self._size)
+        self._file.seek(self._size)
+        if not os.path.exists(self.marker_path):
+            # The marker of a new journal, so a run which is interrupted before its first checkpoint can resume.
+            self.checkpoint()
+
+    @staticmethod
+    def _item_bytes(item: Any) -> bytes:
+        return json.dumps(item, sort_keys=True, ensure_ascii=False).encode("utf-8")
+
+    def skip(self, items: Iterable) -> Iterator:
+        """Skip the items which are done, and yield the others.
+
+        Raises:
+            ValueError: If the skipped items are not the items of the last run.
+        """
+        items = iter(items)
+        for _ in range(self.offset):
+            item = next(items, None)
+            if item is None:
+                raise ValueError(f"The input is shorter than the {self.offset} items of the last run.")
+            self._hash.update(self._item_bytes(item))
+
+        if self._expected_hash is not None and self._hash.hexdigest() != self._expected_hash:
+            raise ValueError("The input changed since the last run, remove the output to start over.")
+
+        yield from items
+
+    def append(self, item: Any, record: Any):
+        """Append the output record of an input item."""
+        self._file.write((json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8"))
+        self._hash.update(self._item_bytes(item))
+        self.offset += 1
+        self._pending += 1
+        if self._pending >= self.checkpoint_every:
+            self.checkpoint()
+
+    def checkpoint(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        marker = {"offset": self.offset, "size": self._file.tell(), "hash": self._hash.hexdigest()}
+        _fsync_replace(self.marker_path, json.dumps(marker))
+        self._pending = 0
+
+    def close(self):
+        self.checkpoint()
+        self._file.close()
+
+    def __enter__(self) -> "Journal":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def compact(journal_path: str, output_file: str):
+    """Write the records of a JSONL journal as a JSON array (with indent=4), one record at a time."""
+    tmp_path = f"{output_file}.tmp"
+    with open(journal_path, "r") as journal, open(tmp_path, "w") as f:
+        count = 0
+        for line in journal:
+            if not line.strip():
+                continue
+            record = json.dumps(json.loads(line), indent=4)
+            f.write(("[\n" if count == 0 else ",\n") + "\n".join("    " + l for l in record.split("\n")))
+            count += 1
+        f.write("\n]" if count else "[]")
+    os.replace(tmp_path, output_file)
@@ -0,0 +1,176 @@
+import re
+import json
+import hashlib
+import logging
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# The permutations of MinHash are (a * x + b) mod a Mersenne prime, the hash values are truncated to 32 bits.
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+
+WORD = re.compile(r"[a-z0-9]+")
+
+DEDUP_MODES = ("tag", "drop")
+
+
+def shingles(text: str, size: int = 5) -> set:
+    """The word n-grams of a text, case and punctuation are ignored.
+
+    A text which is shorter than `size` words is a single shingle, so it is only a duplicate of the same text.
+    """
+    words = WORD.findall(text.lower())
+    if len(words) <= size:
+        return {" ".join(words)} if words else set()
+
+    return {" ".join(words[i : i + size]) for i in range(len(words) - size + 1)}
+
+
+def lsh_params(threshold: float, num_perm: int) -> Tuple[int, int]:
+    """The number of bands and rows per band of the LSH index.
+
+    Two chunks with a Jaccard similarity s share a band with the probability 1 - (1 - s^rows)^bands,
+    which rises steeply around (1 / bands)^(1 / rows). The bands and rows which put this point the
+    closest below the threshold are chosen, so few duplicates are missed, then the candidates are
+    checked against the threshold.
+    """
+
+    def point(params):
+        bands, rows = params
+        return (1 / bands) ** (1 / rows)
+
+    candidates = [(bands, num_perm // bands) for bands in range(1, num_perm + 1)]
+    return min(candidates, key=lambda p: (point(p) > threshold, abs(point(p) - threshold)))
+
+
+class NearDuplicateDetector:
+    """Detect the near-duplicate chunks of a chunk stream with MinHash and LSH.
+
+    Each chunk is compared with the canonical chunks seen before it, in the stream order. A chunk
+    whose estimated Jaccard similarity (of the word shingles) to a canonical chunk is `threshold` at
+    least is a duplicate of the most similar one, otherwise it becomes a canonical chunk. Only the
+    signatures of the canonical chunks are kept, so the memory grows with the number of distinct
+    chunks, not with their text.
+    """
+
+    def __init__(self, threshold: float = 0.8, num_perm: int = 128, shingle_size: int = 5, seed: int = 1):
+        """Initialize the detector.
+
+        Args:
+            threshold (float): The lowest Jaccard similarity of a duplicate, in (0, 1].
+            num_perm (int): Number of MinHash permutations, more permutations give a better estimate.
+            shingle_size (int): Number of words per shingle.
+            seed (int): Seed of the permutations, the same seed gives the same signatures.
+        """
+        if not 0 < threshold <= 1:
+            raise ValueError(f"The threshold must be in (0, 1], got {threshold}.")
+
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.bands, self.rows = lsh_params(threshold, num_perm)
+
+        generator = np.random.RandomState(seed)
+        self._a = generator.randint(1, int(MERSENNE_PRIME), size=num_perm, dtype=np.uint64)
+        self._b = generator.randint(0, int(MERSENNE_PRIME), size=num_perm, dtype=np.uint64)
+        self._buckets: List[Dict[bytes, List[int]]] = [{} for _ in range(self.bands)]
+        self._keys: List[str] = []
+        self._signatures: List[np.ndarray] = []
+        self.duplicates: Dict[str, str] = {}
+
+    def signature(self, text: str) -> Optional[np.ndarray]:
+        """The MinHash signature of a text, None for a text without words."""
+        grams = shingles(text, self.shingle_size)
+        if not grams:
+            return None
+
+        values = np.array(
+            [int.from_bytes(hashlib.sha1(g.encode("utf-8")).digest()[:4], "little") for g in grams],
+            dtype=np.uint64,
+        )
+        # The products overflow the 64 bits, it is a hash family all the same.
+        with np.errstate(over="ignore"):
+            hashes = ((values[:, None] * self._a + self._b) % MERSENNE_PRIME) & MAX_HASH
+        return hashes.min(axis=0)
+
+    def _bands(self, signature: np.ndarray) -> Iterator[bytes]:
+        for band in range(self.bands):
+            yield signature[band * self.rows : (band + 1) * self.rows].tobytes()
+
+    def check(self, key: str, text: str | None) -> Optional[str]:
+        """Check a chunk against the canonical chunks, and add it to them if it isn't a duplicate.
+
+        Returns:
+            str | None: The key of the canonical chunk, None if the chunk is canonical. The chunks
+            without words (such as an empty section) are always canonical.
+        """
+        signature = self.signature(text or "")
+        if signature is None:
+            return None
+
+        candidates = set()
+        for band, bucket in zip(self._bands(signature), self._buckets):
+            candidates.update(bucket.get(band, ()))
+
+        best, best_similarity = None, self.threshold
+        for candidate in candidates:
+            similarity = float(np.mean(self._signatures[candidate] == signature))
+            if similarity >= best_similarity:
+                best, best_similarity = candidate, similarity
+
+        if best is not None:
+            self.duplicates[key] = self._keys[best]
+            return self._keys[best]
+
+        position = len(self._keys)
+        self._keys.append(key)
+        self._signatures.append(signature)
+        for band, bucket in zip(self._bands(signature), self._buckets):
+            bucket.setdefault(band, []).append(position)
+        return None
+
+
+def deduplicate(
+    chunks: Iterable[Dict],
+    detector: NearDuplicateDetector,
+    mode: str = "tag",
+    key: str = "name",
+) -> Iterator[Dict]:
+    """Detect the near-duplicates of a chunk stream.
+
+    Args:
+        chunks (Iterable[Dict]): Chunks with a text field and a `key` field, such as the text chunks of `extract.py text-chunks`.
+        detector (NearDuplicateDetector): The detector, its duplicates field maps each duplicate to its canonical chunk.
+        mode (str): tag adds a duplicate_of field (the key of the canonical chunk, or None) to every chunk, drop skips the duplicates.
+        key (str): The field which identifies a chunk.
+
+    Yields:
+        Dict: The chunks.
+    """
+    if mode not in DEDUP_MODES:
+        raise ValueError(f"Unknown dedup mode {mode}, expected one of {DEDUP_MODES}.")
+
+    for chunk in chunks:
+        canonical = detector.check(str(chunk[key]), chunk.get("text"))
+        if mode == "drop" and canonical is not None:
+            continue
+
+        if mode == "tag":
+            chunk = {**chunk, "duplicate_of": canonical}
+        yield chunk
+
+
+def is_duplicate(record: Dict) -> bool:
+    """Whether a tagged chunk is a near-duplicate, the untagged chunks and the canonical chunks are not."""
+    value = record.get("duplicate_of")
+    # pandas reads the missing values of a column as NaN.
+    return isinstance(value, str) and value != ""
+
+
+def save_duplicates(duplicates: Dict[str, str], path: str):
+    """Save the map of the dropped duplicates to their canonical chunks."""
+    with open(path, "w") as f:
+        json.dump(duplicates, f, indent=4, ensure_ascii=False)
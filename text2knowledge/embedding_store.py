@@ -0,0 +1,348 @@
+import os
+import re
+import json
+import pickle
+import logging
+import numpy as np
+import pandas as pd
+import torch
+from typing import List, Dict, Any, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+
+def model_slug(model_name: str) -> str:
+    """Convert a model name to a string which can be used as a file name.
+
+    Args:
+        model_name (str): Model name, such as mistralai/Mistral-7B-v0.1.
+
+    Returns:
+        str: File-safe model name, such as mistralai__Mistral-7B-v0.1.
+    """
+    return re.sub(r"[^A-Za-z0-9._-]+", "__", model_name)
+
+
+class EmbeddingStore:
+    """Append-only embedding store.
+
+    Each model has its own shard in the store directory:
+
+    - <model_slug>.f32: the raw float32 vectors, one row per embedding.
+    - <model_slug>.ids: the ids, one json string per line.
+    - <model_slug>.meta.jsonl: the metadata, one json object per line.
+    - <model_slug>.json: the header, which records the model name and the dimension.
+
+    Appends only write the new rows, and the vectors are loaded with np.memmap, so
+    opening a large store doesn't read the vectors into memory.
+    """
+
+    def __init__(self, root_dir: str, model_name: str):
+        """Open (or create) the shard of a model.
+
+        Args:
+            root_dir (str): Store directory.
+            model_name (str): Model name.
+        """
+        self.root_dir = root_dir
+        self.model_name = model_name
+
+        # The prefix of all files of the shard, the ANN index is saved next to them.
+        self.prefix = os.path.join(root_dir, model_slug(model_name))
+        self.header_file = self.prefix + ".json"
+        self.vectors_file = self.prefix + ".f32"
+        self.ids_file = self.prefix + ".ids"
+        self.metadata_file = self.prefix + ".meta.jsonl"
+
+        self.dim: Optional[int] = None
+        if os.path.exists(self.header_file):
+            with open(self.header_file, "r") as f:
+                self.dim = json.load(f)["dim"]
+
+        self._ids: Optional[List[str]] = None
+        self._id_index: Optional[Dict[str, int]] = None
+        self._metadata: Optional[List[Dict[str, Any]]] = None
+        self._vectors: Optional[np.ndarray] = None
+        self._repaired = False
+
+    def _count_vectors(self) -> int:
+        if not self.dim or not os.path.exists(self.vectors_file):
+            return 0
+
+        return os.path.getsize(self.vectors_file) // (self.dim * 4)
+
+    @staticmethod
+    def _read_lines(filepath: str) -> List[str]:
+        if not os.path.exists(filepath):
+            return []
+
+        with open(filepath, "r") as f:
+            # A partially written line (the writer was killed) has no trailing newline.
+            return [line for line in f.read().split("\n")[:-1]]
+
+    @property
+    def ids(self) -> List[str]:
+        """Ids of the stored embeddings, in row order."""
+        if self._ids is None:
+            lines = self._read_lines(self.ids_file)
+            # Parsing one big json array is much faster than parsing the lines one by one.
+            ids = json.loads("[%s]" % ",".join(lines))
+            self._ids = ids[: self._count_vectors()]
+
+        return self._ids
+
+    @property
+    def id_index(self) -> Dict[str, int]:
+        """Mapping from id to row number."""
+        if self._id_index is None:
+            self._id_index = {id: idx for idx, id in enumerate(self.ids)}
+
+        return self._id_index
+
+    @property
+    def metadata(self) -> List[Dict[str, Any]]:
+        """Metadata of the stored embeddings, in row order."""
+        if self._metadata is None:
+            lines = self._read_lines(self.metadata_file)
+            self._metadata = json.loads("[%s]" % ",".join(lines))[: len(self)]
+
+        return self._metadata
+
+    @property
+    def vectors(self) -> np.ndarray:
+        """Memory-mapped float32 matrix with shape (len(self), dim)."""
+        if self._vectors is None:
+            if len(self) == 0:
+                self._vectors = np.zeros((0, self.dim or 0), dtype=np.float32)
+            else:
+                self._vectors = np.memmap(
+                    self.vectors_file,
+                    dtype=np.float32,
+                    mode="r",
+                    shape=(len(self), self.dim),
+                )
+
+        return self._vectors
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, id: str) -> bool:
+        return id in self.id_index
+
+    def _repair(self):
+        """Drop the rows of an interrupted append, so all files have the same number of rows."""
+        num_rows = len(self)
+        row_size = (self.dim or 0) * 4
+        if os.path.exists(self.vectors_file) and os.path.getsize(self.vectors_file) != num_rows * row_size:
+            logger.warning("Truncate %s to %s rows." % (self.vectors_file, num_rows))
+            with open(self.vectors_file, "r+b") as f:
+                f.truncate(num_rows * row_size)
+
+        for filepath in [self.ids_file, self.metadata_file]:
+            lines = self._read_lines(filepath)
+            with open(filepath, "a+b") as f:
+                f.seek(0, os.SEEK_END)
+                size = f.tell()
+                if size > 0:
+                    f.seek(-1, os.SEEK_END)
+                complete = size == 0 or f.read(1) == b"\n"
+
+            if len(lines) != num_rows or not complete:
+                logger.warning("Truncate %s to %s rows." % (filepath, num_rows))
+                with open(filepath, "w") as f:
+                    f.write("".join(line + "\n" for line in lines[:num_rows]))
+
+        self._repaired = True
+
+    def append(
+        self,
+        ids: List[str],
+        vectors: Union[np.ndarray, torch.Tensor],
+        metadata: Optional[List[Dict[str, Any]]] = None,
+    ):
+        """Append embeddings to the store, only the new rows are written.
+
+        Args:
+            ids (List[str]): Ids of the embeddings.
+            vectors (np.ndarray | torch.Tensor): Embeddings with shape (len(ids), dim).
+            metadata (List[Dict[str, Any]]): Metadata of the embeddings.
+
+        Raises:
+            ValueError: If the shapes don't match the ids or the stored embeddings.
+        """
+        if len(ids) == 0:
+            return
+
+        if isinstance(vectors, torch.Tensor):
+            vectors = vectors.detach().float().cpu().numpy()
+
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        metadata = metadata if metadata is not None else [{} for _ in ids]
+        if vectors.ndim != 2 or vectors.shape[0] != len(ids) or len(metadata) != len(ids):
+            raise ValueError(
+                "Expected %s vectors and metadata, got %s and %s."
+                % (len(ids), vectors.shape, len(metadata))
+            )
+
+        os.makedirs(self.root_dir, exist_ok=True)
+        if self.dim is None:
+            self.dim = int(vectors.shape[1])
+            with open(self.header_file, "w") as f:
+                json.dump({"model_name": self.model_name, "dim": self.dim, "dtype": "float32"}, f)
+        elif vectors.shape[1] != self.dim:
+            raise ValueError(
+                "Expected %s-dimensional vectors, got %s." % (self.dim, vectors.shape[1])
+            )
+
+        if not self._repaired:
+            self._repair()
+
+        # The ids file is written last, a row only exists when its id is written.
+        with open(self.vectors_file, "ab") as f:
+            f.write(vectors.tobytes())
+        with open(self.metadata_file, "a") as f:
+            f.write("".join(json.dumps(m, default=str) + "\n" for m in metadata))
+        with open(self.ids_file, "a") as f:
+            f.write("".join(json.dumps(id) + "\n" for id in ids))
+
+        start = len(self)
+        self.ids.extend(ids)
+        if self._id_index is not None:
+            self._id_index.update({id: start + idx for idx, id in enumerate(ids)})
+        if self._metadata is not None:
+            self._metadata.extend(metadata)
+        self._vectors = None
+
+    @classmethod
+    def from_pickle(cls, pickle_file: str, root_dir: str) -> List["EmbeddingStore"]:
+        """Import a legacy pubtext_embeddings.pkl file, one shard per model.
+
+        Args:
+            pickle_file (str): A pickled Dict[model_name, Dict[id, Embedding]].
+            root_dir (str): Store directory.
+
+        Returns:
+            List[EmbeddingStore]: The stores which are imported.
+        """
+        with open(pickle_file, "rb") as handle:
+            embeddings_dict = pickle.load(handle)
+
+        stores = []
+        for model_name, embeddings in embeddings_dict.items():
+            store = cls(root_dir, model_name)
+            items = [(id, e) for id, e in embeddings.items() if id not in store]
+            if items:
+                logger.info(
+                    "Import %s embeddings of %s from %s." % (len(items), model_name, pickle_file)
+                )
+                store.append(
+                    [id for id, _ in items],
+                    torch.stack([e.embedding for _, e in items]),
+                    [
+                        {k: v for k, v in e.metadata.__dict__.items() if k != "text"}
+                        for _, e in items
+                    ],
+                )
+            stores.append(store)
+
+        return stores
+
+
+def ontology_prefix(filepath: str) -> str:
+    """Path prefix of the binary ontology embedding files, such as ontology for ontology.tsv."""
+    root, ext = os.path.splitext(filepath)
+    return root if ext in (".tsv", ".npy", ".parquet") else filepath
+
+
+def has_ontology_embeddings(filepath: str) -> bool:
+    """Whether the ontology embeddings of a path can be loaded, such as ontology.tsv for the ontology.npy written by generate-embeddings."""
+    return os.path.exists(filepath) or os.path.exists(ontology_prefix(filepath) + ".npy")
+
+
+def save_ontology_embeddings(
+    metadata: pd.DataFrame, vectors: Union[np.ndarray, torch.Tensor], prefix: str
+) -> Tuple[str, str]:
+    """Save ontology embeddings in the binary format.
+
+    Args:
+        metadata (pd.DataFrame): Ontology items, one row per embedding.
+        vectors (np.ndarray | torch.Tensor): Embeddings with shape (len(metadata), dim).
+        prefix (str): Path prefix, the files are <prefix>.npy and <prefix>.parquet.
+
+    Returns:
+        Tuple[str, str]: Paths of the embedding matrix and the metadata.
+    """
+    if isinstance(vectors, torch.Tensor):
+        vectors = vectors.detach().float().cpu().numpy()
+
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    if len(vectors) != len(metadata):
+        raise ValueError(
+            "Expected %s embeddings, got %s." % (len(metadata), len(vectors))
+        )
+
+    vectors_file, metadata_file = prefix + ".npy", prefix + ".parquet"
+    metadata.drop(columns=["embedding"], errors="ignore").reset_index(drop=True).to_parquet(
+        metadata_file, index=False
+    )
+    # The matrix is written last, so a matrix without metadata is never left behind.
+    np.save(vectors_file, vectors)
+
+    return vectors_file, metadata_file
+
+
+def convert_legacy_ontology_embeddings(tsv_file: str, chunksize: int = 10000) -> str:
+    """Convert a TSV file with a "|"-joined embedding column to the binary format.
+
+    Args:
+        tsv_file (str): The TSV file which is generated by the legacy generate-embeddings command.
+        chunksize (int): Number of rows parsed at a time.
+
+    Returns:
+        str: Path prefix of the binary files.
+    """
+    logger.warning("Convert %s to the binary format, it only happens once." % tsv_file)
+    metadata_chunks, vector_chunks = [], []
+    for chunk in pd.read_csv(tsv_file, sep="\t", chunksize=chunksize):
+        vector_chunks.append(
+            np.array([row.split("|") for row in chunk["embedding"]], dtype=np.float32)
+        )
+        metadata_chunks.append(chunk.drop(columns=["embedding"]))
+
+    prefix = ontology_prefix(tsv_file)
+    save_ontology_embeddings(
+        pd.concat(metadata_chunks, ignore_index=True), np.concatenate(vector_chunks), prefix
+    )
+
+    return prefix
+
+
+def load_ontology_embeddings(filepath: str) -> Tuple[pd.DataFrame, np.ndarray]:
+    """Load ontology embeddings, the embedding matrix is memory-mapped.
+
+    Args:
+        filepath (str): One of <prefix>.npy, <prefix>.parquet or a legacy TSV file with an embedding column. A legacy TSV file is converted to the binary format once, the binary files are saved next to it.
+
+    Returns:
+        Tuple[pd.DataFrame, np.ndarray]: Ontology items and the embedding matrix.
+    """
+    prefix = ontology_prefix(filepath)
+    vectors_file, metadata_file = prefix + ".npy", prefix + ".parquet"
+
+    if filepath.endswith(".tsv") and os.path.exists(filepath):
+        converted = os.path.exists(vectors_file) and os.path.getmtime(
+            vectors_file
+        ) >= os.path.getmtime(filepath)
+        if not converted:
+            convert_legacy_ontology_embeddings(filepath)
+
+    metadata = pd.read_parquet(metadata_file)
+    vectors = np.load(vectors_file, mmap_mode="r")
+    if len(vectors) != len(metadata):
+        raise ValueError(
+            "%s has %s rows, but %s has %s rows."
+            % (vectors_file, len(vectors), metadata_file, len(metadata))
+        )
+
+    return metadata, vectors
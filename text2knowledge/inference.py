@@ -0,0 +1,120 @@
+import os
+import logging
+import contextlib
+import torch
+from dataclasses import dataclass, replace
+from typing import Any, Optional
+
+logger = logging.getLogger(__name__)
+
+try:
+    from optimum.onnxruntime import ORTModelForFeatureExtraction
+except ImportError:  # pragma: no cover - optional dependency
+    ORTModelForFeatureExtraction = None
+
+
+def cpu_supports_bf16() -> bool:
+    """Whether the cpu has native bf16 instructions (AVX512-BF16 or AMX), without them bf16 is slower than fp32."""
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = f.read()
+    except OSError:
+        return False
+
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
+@dataclass(frozen=True)
+class InferenceProfile:
+    """How the embedding model runs on the cpu.
+
+    Attributes:
+        name (str): Profile name, one of default, cpu, cpu-int8 and onnx.
+        num_threads (int): Number of intra-op threads, None keeps the torch/onnxruntime default.
+        bf16 (bool): Run the forward pass under bf16 autocast.
+        quantize (bool): Quantize the Linear layers to int8 dynamically.
+        backend (str): torch or onnx.
+    """
+
+    name: str = "default"
+    num_threads: Optional[int] = None
+    bf16: bool = False
+    quantize: bool = False
+    backend: str = "torch"
+
+    @property
+    def key(self) -> str:
+        """Everything which changes the loaded model or the embeddings, used in the registry and cache keys."""
+        return "%s:bf16=%s:int8=%s" % (self.backend, int(self.bf16), int(self.quantize))
+
+    @classmethod
+    def from_name(cls, name: Optional[str] = None, num_threads: Optional[int] = None) -> "InferenceProfile":
+        """Build a named profile.
+
+        Args:
+            name (str): default (the plain fp32 forward pass), cpu (all cores, bf16 autocast if the cpu supports it),
+                cpu-int8 (cpu plus int8 Linear layers) or onnx (ONNX Runtime). Defaults to the
+                TEXT2KNOWLEDGE_INFERENCE_PROFILE environment variable or default.
+            num_threads (int): Number of intra-op threads, defaults to the number of cpus for the cpu profiles.
+        """
+        name = name or os.environ.get("TEXT2KNOWLEDGE_INFERENCE_PROFILE", "default")
+        if name == "default":
+            return cls(name, num_threads=num_threads)
+
+        num_threads = num_threads or os.cpu_count()
+        if name == "cpu":
+            return cls(name, num_threads=num_threads, bf16=cpu_supports_bf16())
+        elif name == "cpu-int8":
+            # The quantized kernels are int8, bf16 autocast doesn't help them.
+            return cls(name, num_threads=num_threads, quantize=True)
+        elif name == "onnx":
+            return cls(name, num_threads=num_threads, backend="onnx")
+        else:
+            raise ValueError("Unknown inference profile: %s" % name)
+
+    def for_device(self, device: torch.device) -> "InferenceProfile":
+        """All options besides the threads only apply to the cpu."""
+        if device.type == "cpu":
+            return self
+
+        return replace(self, bf16=False, quantize=False, backend="torch")
+
+    def apply_threads(self):
+        if self.num_threads and torch.get_num_threads() != self.num_threads:
+            torch.set_num_threads(self.num_threads)
+
+    def load_onnx_model(self, model_name: str) -> Any:
+        if ORTModelForFeatureExtraction is None:
+            raise ImportError(
+                "The onnx inference profile needs optimum and onnxruntime, "
+                "please install them with `pip install optimum[onnxruntime]`."
+            )
+
+        import onnxruntime
+
+        session_options = onnxruntime.SessionOptions()
+        if self.num_threads:
+            session_options.intra_op_num_threads = self.num_threads
+
+        logger.info("Export %s to onnx..." % model_name)
+        return ORTModelForFeatureExtraction.from_pretrained(
+            model_name, export=True, session_options=session_options
+        )
+
+    def optimize(self, model: Any) -> Any:
+        """Quantize the Linear layers of a torch model if the profile asks for it."""
+        if self.quantize and isinstance(model, torch.nn.Module):
+            model = torch.ao.quantization.quantize_dynamic(
+                model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+
+        return model
+
+    def forward_context(self):
+        """Context for the forward pass."""
+        stack = contextlib.ExitStack()
+        stack.enter_context(torch.inference_mode())
+        if self.bf16:
+            stack.enter_context(torch.autocast("cpu", dtype=torch.bfloat16))
+
+        return stack
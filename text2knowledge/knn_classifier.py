@@ -0,0 +1,285 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from text2knowledge.ann import ExactIndex
+from text2knowledge.cache import normalize_text
+from text2knowledge.embedding_store import EmbeddingStore
+from text2knowledge.utils import EmbeddingGenerator
+
+logger = logging.getLogger(__name__)
+
+# The thresholds of a new label store, they are saved to its settings file. The min_similarity is a guess until
+# seed calibrates it on the seed labels (see KnnClassifier.calibrate).
+DEFAULT_SETTINGS = {"k": 5, "min_similarity": 0.9, "min_agreement": 0.8}
+
+# The fraction of the seed labels which calibrate the min_similarity, and the precision of the calibrated threshold.
+HOLDOUT_FRACTION = 0.2
+TARGET_PRECISION = 0.95
+# The fewest held-out articles (with agreeing neighbours) to calibrate on, with fewer the threshold is kept.
+MIN_CALIBRATION_SIZE = 20
+
+
+def text_id(text: str) -> str:
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+class KnnClassifier:
+    """Classify the articles which are similar to already labelled articles without the LLM.
+
+    The labelled articles are an EmbeddingStore shard in the store directory, with the category in
+    the metadata of each row. A text gets the majority category of its k nearest labelled articles
+    when the majority holds `min_agreement` of the neighbours and their mean cosine similarity is
+    `min_similarity` at least, otherwise the prediction is None and the LLM classifies it. The
+    thresholds are saved to <store dir>/knn_classifier.json, so the next runs use them too. Unless it
+    is given, the min_similarity is calibrated on a held-out part of the seed labels.
+    """
+
+    def __init__(
+        self,
+        store_dir: str,
+        embedding_model_name: str = "mistralai/Mistral-7B-v0.1",
+        k: Optional[int] = None,
+        min_similarity: Optional[float] = None,
+        min_agreement: Optional[float] = None,
+        generator: Optional[EmbeddingGenerator] = None,
+    ):
+        """Open (or create) a label store.
+
+        Args:
+            store_dir (str): Store directory.
+            embedding_model_name (str): Embedding model of the store.
+            k (int): Number of neighbours, defaults to the saved value.
+            min_similarity (float): The lowest mean cosine similarity of the agreeing neighbours, defaults to the saved value
+                (or the value calibrated by seed).
+            min_agreement (float): The lowest fraction of the neighbours with the majority category, defaults to the saved value.
+            generator (EmbeddingGenerator): Embedding generator, defaults to a generator of the embedding model.
+        """
+        self.store_dir = store_dir
+        self.settings_file = os.path.join(store_dir, "knn_classifier.json")
+        settings = dict(DEFAULT_SETTINGS)
+        if os.path.exists(self.settings_file):
+            with open(self.settings_file, "r") as f:
+                settings.update(json.load(f))
+
+        given = {"k": k, "min_similarity": min_similarity, "min_agreement": min_agreement}
+        settings.update({key: value for key, value in given.items() if value is not None})
+        self.k = int(settings["k"])
+        self.min_similarity = float(settings["min_similarity"])
+        self.min_agreement = float(settings["min_agreement"])
+        self.calibration: Optional[Dict[str, Any]] = settings.get("calibration")
+        # A given min_similarity is kept, seed doesn't calibrate it.
+        self.min_similarity_given = min_similarity is not None
+
+        os.makedirs(store_dir, exist_ok=True)
+        self._save_settings()
+
+        self.store = EmbeddingStore(store_dir, embedding_model_name)
+        self.generator = generator or EmbeddingGenerator(embedding_model_name)
+        self._lock = threading.Lock()
+        self._index: Optional[ExactIndex] = None
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+    def _save_settings(self):
+        settings = {"k": self.k, "min_similarity": self.min_similarity, "min_agreement": self.min_agreement}
+        if self.calibration is not None:
+            settings["calibration"] = self.calibration
+        with open(self.settings_file, "w") as f:
+            json.dump(settings, f, indent=4)
+
+    def _search(self, vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray, List[Dict[str, Any]]]:
+        with self._lock:
+            # Only the rows which are added since the last search are indexed, not the whole store again.
+            if self._index is None:
+                self._index = ExactIndex(self.store.vectors)
+            elif self._index.ntotal < len(self.store):
+                self._index.extend(self.store.vectors)
+            index, metadata, ntotal = self._index, self.store.metadata, self._index.ntotal
+
+        scores, indexes = index.search(vectors, min(self.k, ntotal))
+        return scores, indexes, metadata
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        return self.generator.gen_text_embeddings(texts).float().numpy()
+
+    def predict(self, text: str) -> Tuple[Optional[Dict[str, Any]], np.ndarray]:
+        """Predict the category of a text.
+
+        Returns:
+            Tuple[dict | None, np.ndarray]: The prediction, which has the category, similarity, agreement and
+            neighbors fields, or None if the neighbours don't pass the thresholds. And the embedding of the
+            text, which is passed to add when the LLM labels the text.
+        """
+        vector = self.embed([text])
+        if len(self.store) == 0:
+            return None, vector[0]
+
+        scores, indexes, metadata = self._search(vector)
+        prediction = self._vote(scores[0], indexes[0], metadata)
+        if prediction is None or prediction["agreement"] < self.min_agreement or prediction["similarity"] < self.min_similarity:
+            return None, vector[0]
+
+        return prediction, vector[0]
+
+    def _vote(self, scores: np.ndarray, indexes: np.ndarray, metadata: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """The majority category of the neighbours of a text, None if it has fewer than k neighbours."""
+        neighbours = [(metadata[i]["category"], float(score), self.store.ids[i]) for i, score in zip(indexes, scores) if i >= 0]
+        if len(neighbours) < self.k:
+            return None
+
+        category, votes = Counter(c for c, _, _ in neighbours).most_common(1)[0]
+        return {
+            "category": category,
+            "similarity": float(np.mean([score for c, score, _ in neighbours if c == category])),
+            "agreement": votes / len(neighbours),
+            "neighbors": [id for c, _, id in neighbours if c == category],
+        }
+
+    def add(self, texts: List[str], categories: List[str], vectors: Optional[np.ndarray] = None, source: str = ""):
+        """Add labelled texts to the store, the texts which are in the store already are skipped.
+
+        Args:
+            texts (List[str]): Texts.
+            categories (List[str]): Their categories.
+            vectors (np.ndarray): Their embeddings, they are computed if None.
+            source (str): Where the labels come from, such as the model or the result file.
+        """
+        items = {}
+        for i, (text, category) in enumerate(zip(texts, categories)):
+            id = text_id(text)
+            if id not in self.store and id not in items:
+                items[id] = (i, category)
+
+        if not items:
+            return
+
+        rows = [i for i, _ in items.values()]
+        vectors = vectors[rows] if vectors is not None else self.embed([texts[i] for i in rows])
+        with self._lock:
+            self.store.append(
+                list(items.keys()),
+                vectors,
+                [{"category": category, "source": source} for _, category in items.values()],
+            )
+
+    def calibrate(self, vectors: np.ndarray, categories: List[str], target_precision: float = TARGET_PRECISION) -> Optional[Dict[str, Any]]:
+        """Set the min_similarity to the lowest threshold whose predictions of held-out labelled texts are precise enough.
+
+        The held-out texts must not be in the store. The predictions are compared with their labels (the labels of the
+        LLM), the threshold is the lowest one at which `target_precision` of the predictions above it are right.
+
+        Args:
+            vectors (np.ndarray): Embeddings of the held-out texts.
+            categories (List[str]): Their categories.
+            target_precision (float): The lowest precision of the kNN predictions.
+
+        Returns:
+            dict | None: The calibration (the threshold, its precision, the fraction of the held-out texts which it labels,
+            and the number of held-out texts), None if there are too few held-out texts with agreeing neighbours.
+        """
+        if len(self.store) == 0 or len(vectors) == 0:
+            return None
+
+        scores, indexes, metadata = self._search(vectors)
+        predictions = []
+        for i, category in enumerate(categories):
+            prediction = self._vote(scores[i], indexes[i], metadata)
+            if prediction is not None and prediction["agreement"] >= self.min_agreement:
+                predictions.append((prediction["similarity"], prediction["category"] == category))
+
+        if len(predictions) < MIN_CALIBRATION_SIZE:
+            logger.info(
+                f"Only {len(predictions)} held-out articles have agreeing neighbours, keep the min_similarity {self.min_similarity}."
+            )
+            return None
+
+        predictions.sort(key=lambda p: -p[0])
+        correct = np.cumsum([right for _, right in predictions])
+        precision = correct / np.arange(1, len(predictions) + 1)
+        passing = np.nonzero(precision >= target_precision)[0]
+        if len(passing):
+            threshold = predictions[int(passing[-1])][0]
+            # The precision is measured again, the threshold also lets in the texts with the same similarity.
+            labelled = sum(similarity >= threshold for similarity, _ in predictions)
+            reached = float(np.mean([right for similarity, right in predictions if similarity >= threshold]))
+        else:
+            threshold, labelled, reached = float(np.nextafter(predictions[0][0], np.inf)), 0, None
+            logger.warning(
+                f"No min_similarity reaches a precision of {target_precision:.0%} on the held-out articles, the kNN pre-classifier is off."
+            )
+
+        self.min_similarity = float(threshold)
+        self.calibration = {
+            "precision": reached,
+            "coverage": labelled / len(categories),
+            "holdout": len(categories),
+            "target_precision": target_precision,
+        }
+        self._save_settings()
+        if reached is not None:
+            logger.info(
+                f"Calibrate the min_similarity to {self.min_similarity:.4f}: {reached:.1%} of its predictions are right, "
+                f"and it labels {self.calibration['coverage']:.1%} of the {len(categories)} held-out articles."
+            )
+        return self.calibration
+
+    def seed(self, result_files: List[str], batch_size: int = 256, holdout: float = HOLDOUT_FRACTION) -> int:
+        """Add the labelled articles of classify-article outputs, such as classfication/results/*.json.
+
+        The articles with the Unknown category or an error are skipped. A text which is in several files
+        keeps the label of the first file. Unless the min_similarity is given, a `holdout` fraction of the new
+        articles is added after the others, and calibrates the min_similarity first (see calibrate).
+
+        Returns:
+            int: The number of labelled articles in the store.
+        """
+        held_texts: List[str] = []
+        held_categories: List[str] = []
+        held_sources: List[str] = []
+        for result_file in result_files:
+            with open(result_file, "r") as f:
+                results = json.load(f)
+
+            labelled = [
+                r for r in results
+                if not r.get("error") and r.get("category") and r.get("category") != "Unknown" and (r.get("text") or r.get("title"))
+            ]
+            texts = [
+                r.get("text") or f"{r.get('title', '')}\n{r.get('abstract') or 'No abstract found.'}" for r in labelled
+            ]
+            categories = [r["category"] for r in labelled]
+            if holdout > 0 and not self.min_similarity_given:
+                # The split depends on the text only, so the same articles are held out by every run.
+                held = [int(text_id(text)[:8], 16) / 0xFFFFFFFF < holdout and text_id(text) not in self.store for text in texts]
+                held_texts += [text for text, h in zip(texts, held) if h]
+                held_categories += [category for category, h in zip(categories, held) if h]
+                held_sources += [os.path.basename(result_file)] * sum(held)
+                texts = [text for text, h in zip(texts, held) if not h]
+                categories = [category for category, h in zip(categories, held) if not h]
+
+            for start in range(0, len(texts), batch_size):
+                self.add(
+                    texts[start : start + batch_size],
+                    categories[start : start + batch_size],
+                    source=os.path.basename(result_file),
+                )
+            logger.info(f"Seed the kNN label store with {len(labelled)} articles of {result_file}.")
+
+        if held_texts:
+            vectors = np.concatenate(
+                [self.embed(held_texts[start : start + batch_size]) for start in range(0, len(held_texts), batch_size)]
+            )
+            self.calibrate(vectors, held_categories)
+            for source in dict.fromkeys(held_sources):
+                rows = [i for i, s in enumerate(held_sources) if s == source]
+                self.add([held_texts[i] for i in rows], [held_categories[i] for i in rows], vectors[rows], source=source)
+
+        return len(self.store)
@@ -0,0 +1,178 @@
+import os
+import gc
+import logging
+import threading
+import torch
+from collections import OrderedDict
+from typing import Any, Callable, Dict, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class ModelKey(NamedTuple):
+    model_name: str
+    word_mode: bool
+    device: str
+    dtype: str
+    profile: str = ""
+
+
+def model_memory(model: Any) -> int:
+    """Number of bytes used by the parameters and buffers of a model."""
+    if not isinstance(model, torch.nn.Module):
+        return 0
+
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+def estimate_model_memory(model_name: str, dtype: torch.dtype) -> int:
+    """Number of bytes of the parameters of a model before it is loaded, 0 if it can't be estimated.
+
+    The parameters are counted on a model built from the config without allocating its weights,
+    and multiplied by the size of the dtype. The buffers are left out, they are small.
+    """
+    try:
+        from accelerate import init_empty_weights
+        from transformers import AutoConfig, AutoModel
+
+        config = AutoConfig.from_pretrained(model_name)
+        with init_empty_weights():
+            model = AutoModel.from_config(config)
+        num_params = sum(p.numel() for p in model.parameters())
+    except Exception as e:
+        logger.debug("Can't estimate the memory of %s: %s" % (model_name, e))
+        return 0
+
+    return num_params * torch.empty((), dtype=dtype).element_size()
+
+
+def default_memory_budget() -> Optional[int]:
+    """Memory budget in bytes.
+
+    It is read from the TEXT2KNOWLEDGE_MODEL_MEMORY_GB environment variable, and defaults
+    to half of the physical memory. None means no limit.
+    """
+    budget = os.environ.get("TEXT2KNOWLEDGE_MODEL_MEMORY_GB")
+    if budget:
+        return int(float(budget) * 1024**3)
+
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 2
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+class ModelRegistry:
+    """Process-wide cache of loaded tokenizer/model pairs.
+
+    The models are keyed by (model name, word_mode, device, dtype, inference profile). When a model
+    wouldn't fit in the memory budget, the least recently used models are evicted before it is loaded,
+    so the evicted models and the new model aren't in memory together. The size of a model is
+    estimated before it is loaded, the size measured at the first load is used for its next loads.
+    """
+
+    def __init__(self, memory_budget: Optional[int] = None):
+        """Initialize the registry.
+
+        Args:
+            memory_budget (int): Memory budget in bytes, None means no limit.
+        """
+        self.memory_budget = memory_budget
+        self._models: "OrderedDict[ModelKey, Tuple[Any, Any, int]]" = OrderedDict()
+        self._sizes: Dict[ModelKey, int] = {}
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._models)
+
+    def __contains__(self, key: ModelKey) -> bool:
+        return key in self._models
+
+    @property
+    def memory_usage(self) -> int:
+        """Number of bytes used by the loaded models."""
+        return sum(size for _, _, size in self._models.values())
+
+    def get(
+        self,
+        key: ModelKey,
+        loader: Callable[[], Tuple[Any, Any]],
+        estimate: Optional[Callable[[], int]] = None,
+    ) -> Tuple[Any, Any]:
+        """Get a loaded tokenizer/model pair, load it with the loader if it is not loaded yet.
+
+        Args:
+            key (ModelKey): Model key.
+            loader (Callable[[], Tuple[Any, Any]]): A function which returns the tokenizer and the model.
+            estimate (Callable[[], int]): A function which returns the number of bytes of the model before it is loaded,
+                such as estimate_model_memory. Without it, a model is only evicted for after it is loaded the first time.
+
+        Returns:
+            Tuple[Any, Any]: Tokenizer and model.
+        """
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                tokenizer, model, _ = self._models[key]
+                return tokenizer, model
+
+            expected = self._sizes.get(key)
+            if expected is None:
+                expected = estimate() if estimate else 0
+            self._evict_for(expected)
+
+            tokenizer, model = loader()
+            size = model_memory(model)
+            if size > expected:
+                self._evict_for(size)
+            self._sizes[key] = size
+            self._models[key] = (tokenizer, model, size)
+            logger.info(
+                "Loaded %s (%.2f GB), %s models in the registry."
+                % (key.model_name, size / 1024**3, len(self._models))
+            )
+            return tokenizer, model
+
+    def _evict_for(self, size: int):
+        if self.memory_budget is None:
+            return
+
+        evicted = False
+        while self._models and self.memory_usage + size > self.memory_budget:
+            key, _ = self._models.popitem(last=False)
+            logger.info("Evict %s from the model registry." % key.model_name)
+            evicted = True
+
+        if size > self.memory_budget:
+            logger.warning(
+                "The model (%.2f GB) is larger than the memory budget (%.2f GB)."
+                % (size / 1024**3, self.memory_budget / 1024**3)
+            )
+
+        if evicted:
+            gc.collect()
+
+    def evict(self, key: ModelKey):
+        """Remove a model from the registry."""
+        with self._lock:
+            self._models.pop(key, None)
+            gc.collect()
+
+    def clear(self):
+        """Remove all models from the registry."""
+        with self._lock:
+            self._models.clear()
+            gc.collect()
+
+
+_registry: Optional[ModelRegistry] = None
+
+
+def get_registry() -> ModelRegistry:
+    """Get the process-wide model registry."""
+    global _registry
+    if _registry is None:
+        _registry = ModelRegistry(default_memory_budget())
+
+    return _registry
@@ -0,0 +1,99 @@
+import asyncio
+import functools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Awaitable, Callable, Iterable, TypeVar
+
+from text2knowledge.ollama.client import OllamaClient, get_client
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class AsyncOllamaClient:
+    """Asyncio front of the Ollama client, with at most `concurrency` requests in flight.
+
+    It is not a non-blocking HTTP client: each request is a blocking `requests` call of the
+    synchronous client, which runs in a worker thread of a thread pool (run_in_executor) and
+    holds it until the response is read. The requests share the pooled session of the
+    synchronous client, so its keep-alive connections, retries, timeouts and errors. A client
+    (and its thread pool) is meant to be shared by all requests of a run.
+    """
+
+    def __init__(self, client: OllamaClient | None = None, concurrency: int = 4):
+        """Initialize the client.
+
+        Args:
+            client (OllamaClient): Synchronous client, defaults to the process-wide client.
+            concurrency (int): Maximum number of requests in flight. Ollama serves OLLAMA_NUM_PARALLEL requests per model at once, the others wait in its queue.
+        """
+        if concurrency < 1:
+            raise ValueError("The concurrency must be at least 1.")
+
+        self.client = client or get_client()
+        self.concurrency = concurrency
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._executor = ThreadPoolExecutor(concurrency, thread_name_prefix="ollama")
+
+    async def run(self, func: Callable[..., R], *args, **kwargs) -> R:
+        """Run a blocking function, which sends Ollama requests, in the worker pool."""
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def generate(self, model_name, prompt, system=None, template=None, context=None, options=None, callback=None, stop_on_json=False, verbose=None, format=None):
+        return await self.run(
+            self.client.generate,
+            model_name,
+            prompt,
+            system=system,
+            template=template,
+            context=context,
+            options=options,
+            callback=callback,
+            stop_on_json=stop_on_json,
+            verbose=verbose,
+            format=format,
+        )
+
+    async def list(self):
+        return await self.run(self.client.list)
+
+    async def show(self, model_name):
+        return await self.run(self.client.show, model_name)
+
+    async def heartbeat(self):
+        return await self.run(self.client.heartbeat)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    async def __aenter__(self) -> "AsyncOllamaClient":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+
+async def ordered_map(
+    func: Callable[[T], Awaitable[R]], items: Iterable[T], window: int
+) -> AsyncIterator[R]:
+    """Yield func(item) for each item in the input order.
+
+    At most `window` calls are scheduled ahead of the next result, so the results of a
+    long input are written as they arrive, while a slow item only holds back the results
+    behind it.
+    """
+    pending: deque = deque()
+    try:
+        for item in items:
+            pending.append(asyncio.ensure_future(func(item)))
+            if len(pending) >= window:
+                yield await pending.popleft()
+
+        while pending:
+            yield await pending.popleft()
+    finally:
+        for task in pending:
+            task.cancel()
+
@@ -0,0 +1,256 @@
+import time
+import logging
+import threading
+
+from text2knowledge.ollama.client import (
+    OllamaClient,
+    OllamaConnectionError,
+    OllamaError,
+    OllamaResponseError,
+    OllamaTimeoutError,
+    parse_hosts,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Endpoint:
+    """An Ollama server of a host pool, with its health and its number of outstanding requests."""
+
+    def __init__(self, client):
+        self.client = client
+        self.outstanding = 0
+        self.down_until = 0.0
+        # The names of the models on the server, None means unknown.
+        self.models = None
+        self.models_checked = float("-inf")
+
+    @property
+    def url(self):
+        return self.client.base_url
+
+    def __repr__(self):
+        return f"Endpoint({self.url}, outstanding={self.outstanding})"
+
+
+class HostPool:
+    """Route the requests to several Ollama servers.
+
+    Each request goes to the server with the fewest outstanding requests among the servers
+    which have the model. A server which fails with a connection error or a timeout is taken
+    out of rotation for `recheck_interval` seconds, then it is checked with `heartbeat` and
+    comes back when it answers. The interface is the same as OllamaClient.
+    """
+
+    def __init__(self, hosts=None, recheck_interval=30, models_ttl=300, **client_kwargs):
+        """Initialize the pool.
+
+        Args:
+            hosts (list | str): Server urls, or a comma-separated string of them. Defaults to the OLLAMA_HOST environment variable.
+            recheck_interval (float): Seconds before a failed server is checked again.
+            models_ttl (float): Seconds before the model list of a server is refreshed.
+            client_kwargs: Passed to the OllamaClient of each server, such as the timeouts and the retries.
+        """
+        if hosts is None or isinstance(hosts, str):
+            hosts = parse_hosts(hosts)
+        if not hosts:
+            raise ValueError("The host pool needs at least one host.")
+
+        self.endpoints = [Endpoint(OllamaClient(host, **client_kwargs)) for host in hosts]
+        self.recheck_interval = recheck_interval
+        self.models_ttl = models_ttl
+        self.verbose = client_kwargs.get("verbose", False)
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return ",".join(endpoint.url for endpoint in self.endpoints)
+
+    def close(self):
+        for endpoint in self.endpoints:
+            endpoint.client.close()
+
+    def _mark_down(self, endpoint, error):
+        logger.warning(f"Take {endpoint.url} out of rotation for {self.recheck_interval}s: {error}")
+        endpoint.down_until = time.monotonic() + self.recheck_interval
+
+    def _is_up(self, endpoint):
+        """Whether the server is in rotation, a failed server is checked again after the recheck interval."""
+        now = time.monotonic()
+        with self._lock:
+            if endpoint.down_until == 0:
+                return True
+            if endpoint.down_until > now:
+                return False
+            # Only one thread checks the server, the others skip it until it is back.
+            endpoint.down_until = now + self.recheck_interval
+
+        if endpoint.client.heartbeat() == "Ollama is running":
+            logger.info(f"{endpoint.url} is back in rotation.")
+            endpoint.down_until = 0.0
+            endpoint.models_checked = float("-inf")
+            return True
+
+        return False
+
+    def _has_model(self, endpoint, model_name):
+        now = time.monotonic()
+        if now - endpoint.models_checked > self.models_ttl:
+            # Set first, so the concurrent requests don't refresh the list too.
+            endpoint.models_checked = now
+            try:
+                endpoint.models = {m.get("name") for m in endpoint.client.list()}
+            except (OllamaConnectionError, OllamaTimeoutError) as e:
+                self._mark_down(endpoint, e)
+                return False
+            except OllamaError:
+                endpoint.models = None
+
+        # Ollama accepts the model names without the tag, which means the latest tag.
+        return (
+            endpoint.models is None
+            or model_name in endpoint.models
+            or f"{model_name}:latest" in endpoint.models
+        )
+
+    def _acquire(self, model_name=None, exclude=()):
+        """Pick the server for a request and count the request as outstanding on it."""
+        candidates = [e for e in self.endpoints if e not in exclude and self._is_up(e)]
+        if model_name is not None:
+            candidates = [e for e in candidates if self._has_model(e, model_name)]
+
+        with self._lock:
+            candidates = [e for e in candidates if e.down_until == 0]
+            if not candidates:
+                return None
+
+            endpoint = min(candidates, key=lambda e: e.outstanding)
+            endpoint.outstanding += 1
+            return endpoint
+
+    def _release(self, endpoint):
+        with self._lock:
+            endpoint.outstanding -= 1
+
+    def _call(self, model_name, method, *args, can_fail_over=None, **kwargs):
+        """Call a client method on the best server, and fail over to the next one on connection errors and timeouts.
+
+        can_fail_over is called after an error, the error is raised instead of failing over when it returns False.
+        """
+        tried = []
+        last_error = None
+        while True:
+            endpoint = self._acquire(model_name, exclude=tried)
+            if endpoint is None:
+                break
+
+            tried.append(endpoint)
+            try:
+                return getattr(endpoint.client, method)(*args, **kwargs)
+            except (OllamaConnectionError, OllamaTimeoutError) as e:
+                self._mark_down(endpoint, e)
+                if can_fail_over is not None and not can_fail_over():
+                    raise
+                last_error = e
+            finally:
+                self._release(endpoint)
+
+        if last_error is not None:
+            raise last_error
+        if all(e.down_until > 0 for e in self.endpoints):
+            raise OllamaConnectionError(f"All hosts are out of rotation: {self.base_url}")
+        if model_name is not None:
+            raise OllamaResponseError(f"No available host has the model {model_name}.")
+        raise OllamaConnectionError(f"No available host: {self.base_url}")
+
+    def generate(self, model_name, prompt, system=None, template=None, context=None, options=None, callback=None, stop_on_json=False, verbose=None, format=None):
+        # Fail over only before the first chunk, the chunks which are passed to the callback (or printed) already
+        # can't be taken back, and the next server would send them again.
+        delivered = False
+
+        def on_chunk(chunk):
+            nonlocal delivered
+            delivered = True
+            if callback:
+                callback(chunk)
+
+        # The context tokens are only valid for the same model, which is the same on every server.
+        return self._call(
+            model_name,
+            "generate",
+            model_name,
+            prompt,
+            system=system,
+            template=template,
+            context=context,
+            options=options,
+            callback=on_chunk,
+            stop_on_json=stop_on_json,
+            verbose=verbose,
+            format=format,
+            can_fail_over=lambda: not delivered,
+        )
+
+    def stream_json(self, model_name, prompt, system=None, template=None, context=None, options=None, format=None):
+        # No fail over, the values which are yielded already can't be taken back.
+        endpoint = self._acquire(model_name)
+        if endpoint is None:
+            raise OllamaConnectionError(f"No available host has the model {model_name}: {self.base_url}")
+
+        try:
+            yield from endpoint.client.stream_json(model_name, prompt, system=system, template=template, context=context, options=options, format=format)
+        except (OllamaConnectionError, OllamaTimeoutError) as e:
+            self._mark_down(endpoint, e)
+            raise
+        finally:
+            self._release(endpoint)
+
+    def show(self, model_name):
+        return self._call(model_name, "show", model_name)
+
+    def list(self):
+        """List the models of all servers in rotation, each model once."""
+        models = {}
+        for endpoint in self.endpoints:
+            if not self._is_up(endpoint):
+                continue
+
+            try:
+                for model in endpoint.client.list():
+                    models.setdefault(model.get("name"), model)
+            except (OllamaConnectionError, OllamaTimeoutError) as e:
+                self._mark_down(endpoint, e)
+
+        return [model for model in models.values()]
+
+    def heartbeat(self):
+        if any(e.client.heartbeat() == "Ollama is running" for e in self.endpoints):
+            return "Ollama is running"
+
+        return "Ollama is not running"
+
+    # The model management requests go to every server.
+    def pull(self, model_name, insecure=False, callback=None):
+        for endpoint in self.endpoints:
+            endpoint.client.pull(model_name, insecure=insecure, callback=callback)
+            endpoint.models_checked = float("-inf")
+
+    def create(self, model_name, model_path, callback=None):
+        for endpoint in self.endpoints:
+            endpoint.client.create(model_name, model_path, callback=callback)
+            endpoint.models_checked = float("-inf")
+
+    def push(self, model_name, insecure=False, callback=None):
+        return self._call(model_name, "push", model_name, insecure=insecure, callback=callback)
+
+    def copy(self, source, destination):
+        for endpoint in self.endpoints:
+            endpoint.client.copy(source, destination)
+            endpoint.models_checked = float("-inf")
+        return "Copy successful"
+
+    def delete(self, model_name):
+        for endpoint in self.endpoints:
+            endpoint.client.delete(model_name)
+            endpoint.models_checked = float("-inf")
+        return "Delete successful"
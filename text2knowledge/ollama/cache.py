@@ -0,0 +1,131 @@
+import os
+import json
+import time
+import hashlib
+import logging
+
+from text2knowledge.cache import DiskCache, default_cache_dir, env_bytes, env_flag
+from text2knowledge.ollama.client import OllamaError
+from text2knowledge.ollama.stats import GenerationStats
+
+logger = logging.getLogger(__name__)
+
+
+def is_deterministic(options):
+    """Only the greedy decoding (temperature 0) gives the same response for the same request."""
+    return (options or {}).get("temperature") == 0
+
+
+class ResponseCache:
+    """Disk-backed cache of the Ollama generate responses.
+
+    The responses are keyed by a hash of the model digest and the request payload (prompt,
+    system, template, options, context...), so a re-pulled model misses the old entries.
+    Each entry holds the raw response, the final context and the Ollama stats.
+    """
+
+    def __init__(self, path=None, max_bytes=None):
+        """Open (or create) the cache.
+
+        Args:
+            path (str): Path of the SQLite file, defaults to <cache dir>/responses.sqlite.
+            max_bytes (int): Size cap, defaults to the TEXT2KNOWLEDGE_RESPONSE_CACHE_GB environment variable or 1 GB.
+        """
+        path = path or os.path.join(default_cache_dir(), "responses.sqlite")
+        max_bytes = max_bytes or env_bytes("TEXT2KNOWLEDGE_RESPONSE_CACHE_GB", 1)
+        self.cache = DiskCache(path, max_bytes=max_bytes)
+        self._digests = {}
+
+    def model_digest(self, client, model_name):
+        """Digest of a model on the server, it is looked up once per process."""
+        if model_name not in self._digests:
+            digests = {m.get("name"): m.get("digest") for m in client.list()}
+            # Ollama accepts the model names without the tag, which means the latest tag.
+            self._digests[model_name] = digests.get(model_name) or digests.get(f"{model_name}:latest")
+
+        return self._digests[model_name]
+
+    @staticmethod
+    def key(digest, payload):
+        data = json.dumps({"digest": digest, **payload}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        value = self.cache.get(key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, record):
+        self.cache.set(key, json.dumps(record, ensure_ascii=False).encode("utf-8"))
+
+
+_response_cache = None
+_enabled = True
+
+
+def get_response_cache():
+    """Get the process-wide response cache, None if it is disabled by configure_response_cache or TEXT2KNOWLEDGE_RESPONSE_CACHE=0."""
+    global _response_cache
+    if not _enabled or not env_flag("TEXT2KNOWLEDGE_RESPONSE_CACHE"):
+        return None
+
+    if _response_cache is None:
+        _response_cache = ResponseCache()
+
+    return _response_cache
+
+
+def configure_response_cache(enabled=True, path=None, max_bytes=None):
+    """Enable (or disable) the process-wide response cache, such as for the --no-cache option."""
+    global _response_cache, _enabled
+    _enabled = enabled
+    _response_cache = ResponseCache(path, max_bytes) if enabled and (path or max_bytes) else None
+
+
+def _replay(record, callback=None, verbose=False):
+    """Feed a cached response to the callback like a stream of one chunk, and print it if verbose."""
+    if callback:
+        callback({"response": record["response"], "done": False})
+        callback({**record["stats"], "context": record["context"], "done": True})
+    if verbose:
+        print(record["response"], end="", flush=True)
+        print("\n\n")
+
+
+def cached_generate(client, cache, model_name, prompt, system=None, template=None, context=None, options=None, callback=None, stop_on_json=False, verbose=None, format=None):
+    """Call client.generate, and serve the deterministic requests (temperature 0) from the cache."""
+    kwargs = dict(system=system, template=template, context=context, options=options, stop_on_json=stop_on_json, verbose=verbose, format=format)
+    if cache is None or not is_deterministic(options):
+        return client.generate(model_name, prompt, callback=callback, **kwargs)
+
+    # The response of stop_on_json is cut after the JSON value, it is another entry.
+    payload = {"model": model_name, "prompt": prompt, "system": system, "template": template, "context": context, "options": options, "format": format, "stop_on_json": stop_on_json}
+    try:
+        key = cache.key(cache.model_digest(client, model_name), payload)
+    except OllamaError as e:
+        logger.warning(f"Skip the response cache, the model digest is unknown: {e}")
+        return client.generate(model_name, prompt, callback=callback, **kwargs)
+
+    started = time.perf_counter()
+    record = cache.get(key)
+    if record is not None:
+        logger.debug(f"Serve the response from the cache: {key}")
+        _replay(record, callback, verbose=client.verbose if verbose is None else verbose)
+        # The server stats of the cached response are kept, the latency is the one of the cache.
+        stats = GenerationStats.from_chunk(
+            record["stats"], model=model_name, wall_time=time.perf_counter() - started, complete=bool(record["stats"]), cached=True
+        )
+        return record["response"], record["context"], stats
+
+    final = {}
+
+    def capture(chunk):
+        if chunk.get("done"):
+            final.update(chunk)
+        if callback:
+            callback(chunk)
+
+    response, final_context, stats = client.generate(model_name, prompt, callback=capture, **kwargs)
+    final_stats = {k: v for k, v in final.items() if k not in ("context", "response", "done")}
+    cache.set(key, {"response": response, "context": final_context, "stats": final_stats})
+
+    return response, final_context, stats
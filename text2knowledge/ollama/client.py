@@ -1,226 +1,429 @@
 import os
 import json
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ReadTimeoutError
+from urllib3.util.retry import Retry
+from text2knowledge.ollama.json_stream import JsonStreamParser
+from text2knowledge.ollama.stats import GenerationStats, get_stats_collector
+
+
+def parse_hosts(hosts=None):
+    """Parse a comma-separated list of Ollama servers, such as the OLLAMA_HOST environment variable."""
+    hosts = hosts or os.environ.get('OLLAMA_HOST', 'http://localhost:11434')
+    urls = []
+    for host in hosts.split(","):
+        host = host.strip().rstrip("/")
+        if host:
+            # Ollama accepts a bare host:port in OLLAMA_HOST.
+            urls.append(host if "://" in host else f"http://{host}")
+    return urls
+
 
 # The following codes are from the repo: https://github.com/rahulnyk/knowledge_graph
-BASE_URL = os.environ.get('OLLAMA_HOST', 'http://localhost:11434')
+# OLLAMA_HOST can hold several comma-separated servers, the requests are balanced between them (see balancer.HostPool).
+HOSTS = parse_hosts()
+BASE_URL = HOSTS[0]
+
+# Seconds to wait for the connection, and for each chunk of a streaming response (a stalled stream times out).
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 300
+# Status codes which are retried, Ollama answers 5xx when a model fails to load or the server is overloaded.
+RETRY_STATUS = (500, 502, 503, 504)
+# Tokens to read after the JSON of stop_on_json is complete, waiting for the final chunk and its stats. A model
+# which stops after the JSON sends the final chunk at once, a model which goes on with prose is cut after them.
+STOP_ON_JSON_GRACE_TOKENS = 32
+
+
+class OllamaError(Exception):
+    """Base class of the errors raised by the Ollama client."""
+
+
+class OllamaConnectionError(OllamaError):
+    """The server can't be reached, after all retries."""
+
+
+class OllamaTimeoutError(OllamaError):
+    """The server didn't answer, or a streaming response stalled, within the read timeout."""
+
+
+class OllamaResponseError(OllamaError):
+    """The server answered with an error status or an error message."""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message if status_code is None else f"{status_code}: {message}")
+        self.message = message
+        self.status_code = status_code
+
+
+def _raise_for_status(response):
+    if response.status_code < 400:
+        return
 
-# Generate a response for a given prompt with a provided model. This is a streaming endpoint, so will be a series of responses.
-# The final response object will include statistics and additional data from the request. Use the callback function to override
-# the default handler.
-# https://github.com/ollama/ollama/blob/main/docs/api.md
-def generate(model_name, prompt, system=None, template=None, context=None, options=None, callback=None):
     try:
-        url = f"{BASE_URL}/api/generate"
+        message = response.json().get("error", response.text)
+    except ValueError:
+        message = response.text
+
+    raise OllamaResponseError(message, status_code=response.status_code)
+
+
+def _translate_error(e):
+    """Convert a requests exception to an Ollama error."""
+    if isinstance(e, requests.exceptions.Timeout):
+        return OllamaTimeoutError(str(e))
+    # requests wraps the read timeouts of a streaming body in a ConnectionError.
+    if isinstance(e, requests.exceptions.ConnectionError) and any(
+        isinstance(arg, ReadTimeoutError) for arg in e.args
+    ):
+        return OllamaTimeoutError(str(e))
+    if isinstance(e, requests.exceptions.ConnectionError):
+        return OllamaConnectionError(str(e))
+
+    return OllamaError(str(e))
+
+
+class OllamaClient:
+    """Ollama client with a pooled keep-alive session.
+
+    The connection errors and the 5xx answers are retried with an exponential backoff,
+    and all failures are raised as OllamaError subclasses.
+    """
+
+    def __init__(
+        self,
+        base_url=None,
+        connect_timeout=CONNECT_TIMEOUT,
+        read_timeout=READ_TIMEOUT,
+        retries=3,
+        backoff_factor=0.5,
+        pool_maxsize=32,
+        verbose=False,
+    ):
+        """Initialize the client.
+
+        Args:
+            base_url (str): Server url, defaults to the OLLAMA_HOST environment variable or http://localhost:11434.
+            connect_timeout (float): Seconds to wait for the connection.
+            read_timeout (float): Seconds to wait for each chunk of the response.
+            retries (int): Number of retries on connection errors and 5xx answers.
+            backoff_factor (float): The n-th retry waits backoff_factor * 2 ** (n - 1) seconds.
+            pool_maxsize (int): Number of keep-alive connections, it should be at least the number of concurrent requests.
+            verbose (bool): Print the tokens of the generated responses as they arrive.
+        """
+        self.base_url = (base_url or BASE_URL).rstrip("/")
+        self.verbose = verbose
+        self.timeout = (connect_timeout, read_timeout)
+
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=0,
+            status=retries,
+            status_forcelist=RETRY_STATUS,
+            # Retry the POST requests too, the generation has no side effects.
+            allowed_methods=None,
+            backoff_factor=backoff_factor,
+            # Return the last answer instead of raising a MaxRetryError, so the error message of the server is kept.
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def close(self):
+        self.session.close()
+
+    def _request(self, method, path, **kwargs):
+        try:
+            response = self.session.request(
+                method, f"{self.base_url}{path}", timeout=self.timeout, **kwargs
+            )
+        except requests.exceptions.RequestException as e:
+            raise _translate_error(e) from e
+
+        _raise_for_status(response)
+        return response
+
+    def _stream(self, path, payload):
+        """Yield the JSON chunks of a streaming endpoint."""
+        with self._request("POST", path, json=payload, stream=True) as response:
+            try:
+                for line in response.iter_lines():
+                    if line:
+                        chunk = json.loads(line)
+                        if "error" in chunk:
+                            raise OllamaResponseError(chunk["error"])
+                        yield chunk
+            except requests.exceptions.RequestException as e:
+                raise _translate_error(e) from e
+
+    @staticmethod
+    def _generate_payload(model_name, prompt, system=None, template=None, context=None, options=None, format=None):
         payload = {
-            "model": model_name, 
-            "prompt": prompt, 
-            "system": system, 
-            "template": template, 
-            "context": context, 
-            "options": options
+            "model": model_name,
+            "prompt": prompt,
+            "system": system,
+            "template": template,
+            "context": context,
+            "options": options,
+            "format": format
         }
 
         # Remove keys with None values
-        payload = {k: v for k, v in payload.items() if v is not None}
+        return {k: v for k, v in payload.items() if v is not None}
+
+    # Generate a response for a given prompt with a provided model. This is a streaming endpoint, so will be a series of responses.
+    # The final response object will include statistics and additional data from the request. Use the callback function to override
+    # the default handler.
+    # https://github.com/ollama/ollama/blob/main/docs/api.md
+    def generate(self, model_name, prompt, system=None, template=None, context=None, options=None, callback=None, stop_on_json=False, verbose=None, format=None):
+        """Generate a response.
+
+        Args:
+            callback (Callable): Called with each chunk of the stream.
+            stop_on_json (bool): Cut the response after the first JSON answer, a non-empty list of objects or a non-empty
+                object (the bracketed values of the prose, such as "[1]", are skipped). The stream is read on for
+                STOP_ON_JSON_GRACE_TOKENS tokens to get the final chunk (the context and the stats), then it is closed,
+                so the server stops generating the prose after the JSON. The final context is None then, and the
+                server stats are unavailable (None).
+            verbose (bool): Print the tokens as they arrive, defaults to the verbose attribute of the client.
+            format (str | dict): "json" or a JSON schema, which constrains the response (the structured output of Ollama).
 
-        with requests.post(url, json=payload, stream=True) as response:
-            response.raise_for_status()
+        Returns:
+            tuple: The response, the final context and the GenerationStats of the request.
+        """
+        verbose = self.verbose if verbose is None else verbose
+        payload = self._generate_payload(model_name, prompt, system, template, context, options, format)
 
-            # Creating a variable to hold the context history of the final chunk
-            final_context = None
+        # Creating a variable to hold the context history of the final chunk
+        final_context = None
+        final_chunk = None
+        started = time.perf_counter()
+        first_token = None
 
-            # Variable to hold concatenated response strings if no callback is provided
-            full_response = ""
+        pieces = []
+        parser = JsonStreamParser() if stop_on_json else None
+        # The tokens which are received after the JSON, they are not part of the response.
+        trailing = 0
+        stream = self._stream("/api/generate", payload)
+        try:
+            for chunk in stream:
+                # If a callback function is provided, call it with the chunk
+                if callback:
+                    callback(chunk)
 
-            # Iterating over the response line by line and displaying the details
-            for line in response.iter_lines():
-                if line:
-                    # Parsing each line (JSON chunk) and extracting the details
-                    chunk = json.loads(line)
+                # Check if it's the last chunk (done is true)
+                if chunk.get("done"):
+                    final_context = chunk.get("context")
+                    final_chunk = chunk
+                    continue
 
-                    # If a callback function is provided, call it with the chunk
-                    if callback:
-                        callback(chunk)
-                    else:
-                        # If this is not the last chunk, add the "response" field value to full_response and print it
-                        if not chunk.get("done"):
-                            response_piece = chunk.get("response", "")
-                            full_response += response_piece
-                            print(response_piece, end="", flush=True)
+                response_piece = chunk.get("response", "")
+                if parser is not None and parser.done:
+                    trailing += 1
+                    if trailing > STOP_ON_JSON_GRACE_TOKENS:
+                        break
+                    continue
 
-                    # Check if it's the last chunk (done is true)
-                    if chunk.get("done"):
-                        final_context = chunk.get("context")
+                if first_token is None and response_piece:
+                    first_token = time.perf_counter() - started
+                pieces.append(response_piece)
+                if verbose:
+                    print(response_piece, end="", flush=True)
 
+                if parser is not None:
+                    parser.feed(response_piece)
+        finally:
+            # Closing the stream early drops the connection, which makes the server stop the generation.
+            stream.close()
+
+        if verbose:
             print("\n\n")
-            # Return the full response and the final context
-            return full_response, final_context
-    except requests.exceptions.RequestException as e:
-        print(f"An error occurred: {e}")
-        return None, None
 
-# Create a model from a Modelfile. Use the callback function to override the default handler.
-def create(model_name, model_path, callback=None):
-    try:
-        url = f"{BASE_URL}/api/create"
+        stats = GenerationStats.from_chunk(
+            final_chunk,
+            model=model_name,
+            wall_time=time.perf_counter() - started,
+            time_to_first_token=first_token,
+            complete=final_chunk is not None,
+        )
+        if final_chunk is None:
+            # The server stats are unavailable, each received chunk of the stream is one generated token.
+            stats.eval_count = len(pieces) + trailing
+
+        # Return the full response, the final context and the stats
+        return "".join(pieces), final_context, stats
+
+    def stream_json(self, model_name, prompt, system=None, template=None, context=None, options=None, format=None):
+        """Yield the JSON values of the response as soon as they are complete (see JsonStreamParser.feed).
+
+        The stream is closed after the first top-level JSON value which is accepted by the parser, a non-empty
+        list of objects or a non-empty object.
+        """
+        payload = self._generate_payload(model_name, prompt, system, template, context, options, format)
+        parser = JsonStreamParser()
+        stream = self._stream("/api/generate", payload)
+        try:
+            for chunk in stream:
+                yield from parser.feed(chunk.get("response", ""))
+                if parser.done:
+                    return
+        finally:
+            stream.close()
+
+    # Create a model from a Modelfile. Use the callback function to override the default handler.
+    def create(self, model_name, model_path, callback=None):
         payload = {"name": model_name, "path": model_path}
-        
-        # Making a POST request with the stream parameter set to True to handle streaming responses
-        with requests.post(url, json=payload, stream=True) as response:
-            response.raise_for_status()
-
-            # Iterating over the response line by line and displaying the status
-            for line in response.iter_lines():
-                if line:
-                    # Parsing each line (JSON chunk) and extracting the status
-                    chunk = json.loads(line)
-
-                    if callback:
-                        callback(chunk)
-                    else:
-                        print(f"Status: {chunk.get('status')}")
-    except requests.exceptions.RequestException as e:
-        print(f"An error occurred: {e}")
-
-# Pull a model from a the model registry. Cancelled pulls are resumed from where they left off, and multiple
-# calls to will share the same download progress. Use the callback function to override the default handler.
+        for chunk in self._stream("/api/create", payload):
+            if callback:
+                callback(chunk)
+            else:
+                print(f"Status: {chunk.get('status')}")
+
+    # Pull a model from a the model registry. Cancelled pulls are resumed from where they left off, and multiple
+    # calls to will share the same download progress. Use the callback function to override the default handler.
+    def pull(self, model_name, insecure=False, callback=None):
+        payload = {"name": model_name, "insecure": insecure}
+        for chunk in self._stream("/api/pull", payload):
+            _print_progress(chunk, callback)
+
+    # Push a model to the model registry. Use the callback function to override the default handler.
+    def push(self, model_name, insecure=False, callback=None):
+        payload = {"name": model_name, "insecure": insecure}
+        for chunk in self._stream("/api/push", payload):
+            _print_progress(chunk, callback)
+
+    # List models that are available locally.
+    def list(self):
+        data = self._request("GET", "/api/tags").json()
+        return data.get('models', [])
+
+    # Copy a model. Creates a model with another name from an existing model.
+    def copy(self, source, destination):
+        payload = {"source": source, "destination": destination}
+        self._request("POST", "/api/copy", json=payload)
+        return "Copy successful"
+
+    # Delete a model and its data.
+    def delete(self, model_name):
+        self._request("DELETE", "/api/delete", json={"name": model_name})
+        return "Delete successful"
+
+    # Show info about a model.
+    def show(self, model_name):
+        return self._request("POST", "/api/show", json={"name": model_name}).json()
+
+    def heartbeat(self):
+        try:
+            self._request("HEAD", "/")
+            return "Ollama is running"
+        except OllamaError:
+            return "Ollama is not running"
+
+
+def _print_progress(chunk, callback=None):
+    # If a callback function is provided, call it with the chunk
+    if callback:
+        callback(chunk)
+    else:
+        # Print the status message directly to the console
+        print(chunk.get('status', ''), end='', flush=True)
+
+    # If there's layer data, you might also want to print that (adjust as necessary)
+    if 'digest' in chunk:
+        print(f" - Digest: {chunk['digest']}", end='', flush=True)
+        print(f" - Total: {chunk['total']}", end='', flush=True)
+        print(f" - Completed: {chunk['completed']}", end='\n', flush=True)
+    else:
+        print()
+
+
+_default_client = None
+
+
+def get_client():
+    """Get the process-wide client, which is used by the module-level functions.
+
+    It is a balancer.HostPool if OLLAMA_HOST holds several servers.
+    """
+    global _default_client
+    if _default_client is None:
+        _default_client = configure()
+
+    return _default_client
+
+
+def configure(hosts=None, **kwargs):
+    """Replace the process-wide client.
+
+    Args:
+        hosts (list | str): Server urls, or a comma-separated string of them. Defaults to the OLLAMA_HOST environment variable.
+        kwargs: Passed to OllamaClient, or to balancer.HostPool if there are several servers.
+    """
+    global _default_client
+    # Imported here, the balancer module imports this module.
+    from text2knowledge.ollama.balancer import HostPool
+
+    hosts = parse_hosts(hosts) if hosts is None or isinstance(hosts, str) else hosts
+    if _default_client is not None:
+        _default_client.close()
+    if len(hosts) > 1:
+        _default_client = HostPool(hosts, **kwargs)
+    else:
+        _default_client = OllamaClient(hosts[0], **kwargs)
+    return _default_client
+
+
+def generate(model_name, prompt, system=None, template=None, context=None, options=None, callback=None, use_cache=True, stop_on_json=False, verbose=None, format=None):
+    """Generate with the process-wide client, see OllamaClient.generate.
+
+    The requests with temperature 0 are served from the response cache (see cache.ResponseCache),
+    use_cache=False bypasses it. The stats of each request are added to the process-wide
+    stats.StatsCollector.
+    """
+    # Imported here, the cache module imports this module.
+    from text2knowledge.ollama.cache import cached_generate, get_response_cache
+
+    cache = get_response_cache() if use_cache else None
+    response, final_context, stats = cached_generate(get_client(), cache, model_name, prompt, system=system, template=template, context=context, options=options, callback=callback, stop_on_json=stop_on_json, verbose=verbose, format=format)
+    get_stats_collector().add(stats)
+    return response, final_context, stats
+
+
+def stream_json(model_name, prompt, system=None, template=None, context=None, options=None, format=None):
+    return get_client().stream_json(model_name, prompt, system=system, template=template, context=context, options=options, format=format)
+
+
+def create(model_name, model_path, callback=None):
+    return get_client().create(model_name, model_path, callback=callback)
+
+
 def pull(model_name, insecure=False, callback=None):
-    try:
-        url = f"{BASE_URL}/api/pull"
-        payload = {
-            "name": model_name,
-            "insecure": insecure
-        }
+    return get_client().pull(model_name, insecure=insecure, callback=callback)
+
 
-        # Making a POST request with the stream parameter set to True to handle streaming responses
-        with requests.post(url, json=payload, stream=True) as response:
-            response.raise_for_status()
-
-            # Iterating over the response line by line and displaying the details
-            for line in response.iter_lines():
-                if line:
-                    # Parsing each line (JSON chunk) and extracting the details
-                    chunk = json.loads(line)
-
-                    # If a callback function is provided, call it with the chunk
-                    if callback:
-                        callback(chunk)
-                    else:
-                        # Print the status message directly to the console
-                        print(chunk.get('status', ''), end='', flush=True)
-                    
-                    # If there's layer data, you might also want to print that (adjust as necessary)
-                    if 'digest' in chunk:
-                        print(f" - Digest: {chunk['digest']}", end='', flush=True)
-                        print(f" - Total: {chunk['total']}", end='', flush=True)
-                        print(f" - Completed: {chunk['completed']}", end='\n', flush=True)
-                    else:
-                        print()
-    except requests.exceptions.RequestException as e:
-        print(f"An error occurred: {e}")
-
-# Push a model to the model registry. Use the callback function to override the default handler.
 def push(model_name, insecure=False, callback=None):
-    try:
-        url = f"{BASE_URL}/api/push"
-        payload = {
-            "name": model_name,
-            "insecure": insecure
-        }
+    return get_client().push(model_name, insecure=insecure, callback=callback)
+
 
-        # Making a POST request with the stream parameter set to True to handle streaming responses
-        with requests.post(url, json=payload, stream=True) as response:
-            response.raise_for_status()
-
-            # Iterating over the response line by line and displaying the details
-            for line in response.iter_lines():
-                if line:
-                    # Parsing each line (JSON chunk) and extracting the details
-                    chunk = json.loads(line)
-
-                    # If a callback function is provided, call it with the chunk
-                    if callback:
-                        callback(chunk)
-                    else:
-                        # Print the status message directly to the console
-                        print(chunk.get('status', ''), end='', flush=True)
-                    
-                    # If there's layer data, you might also want to print that (adjust as necessary)
-                    if 'digest' in chunk:
-                        print(f" - Digest: {chunk['digest']}", end='', flush=True)
-                        print(f" - Total: {chunk['total']}", end='', flush=True)
-                        print(f" - Completed: {chunk['completed']}", end='\n', flush=True)
-                    else:
-                        print()
-    except requests.exceptions.RequestException as e:
-        print(f"An error occurred: {e}")
-
-# List models that are available locally.
 def list():
-    try:
-        response = requests.get(f"{BASE_URL}/api/tags")
-        response.raise_for_status()
-        data = response.json()
-        models = data.get('models', [])
-        return models
+    return get_client().list()
 
-    except requests.exceptions.RequestException as e:
-        print(f"An error occurred: {e}")
-        return None
 
-# Copy a model. Creates a model with another name from an existing model.
 def copy(source, destination):
-    try:
-        # Create the JSON payload
-        payload = {
-            "source": source,
-            "destination": destination
-        }
-        
-        response = requests.post(f"{BASE_URL}/api/copy", json=payload)
-        response.raise_for_status()
-        
-        # If the request was successful, return a message indicating that the copy was successful
-        return "Copy successful"
+    return get_client().copy(source, destination)
 
-    except requests.exceptions.RequestException as e:
-        print(f"An error occurred: {e}")
-        return None
 
-# Delete a model and its data.
 def delete(model_name):
-    try:
-        url = f"{BASE_URL}/api/delete"
-        payload = {"name": model_name}
-        response = requests.delete(url, json=payload)
-        response.raise_for_status()
-        return "Delete successful"
-    except requests.exceptions.RequestException as e:
-        print(f"An error occurred: {e}")
-        return None
+    return get_client().delete(model_name)
+
 
-# Show info about a model.
 def show(model_name):
-    try:
-        url = f"{BASE_URL}/api/show"
-        payload = {"name": model_name}
-        response = requests.post(url, json=payload)
-        response.raise_for_status()
-        
-        # Parse the JSON response and return it
-        data = response.json()
-        return data
-    except requests.exceptions.RequestException as e:
-        print(f"An error occurred: {e}")
-        return None
+    return get_client().show(model_name)
+
 
 def heartbeat():
-    try:
-        url = f"{BASE_URL}/"
-        response = requests.head(url)
-        response.raise_for_status()
-        return "Ollama is running"
-    except requests.exceptions.RequestException as e:
-        print(f"An error occurred: {e}")
-        return "Ollama is not running"
+    return get_client().heartbeat()
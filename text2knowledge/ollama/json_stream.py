@@ -0,0 +1,126 @@
+import json
+
+PAIRS = {"]": "[", "}": "{"}
+
+
+def is_answer(value):
+    """Whether a JSON value has the shape of a task answer: a non-empty list of objects, or a non-empty object.
+
+    The bracketed values in prose, such as the citation "[1]" or an empty "{}", are not answers.
+    """
+    if isinstance(value, dict):
+        return bool(value)
+    if isinstance(value, list):
+        return bool(value) and all(isinstance(item, dict) for item in value)
+    return False
+
+
+class JsonStreamParser:
+    """Incremental parser of the first JSON array or object in a stream of text chunks.
+
+    The prose before the JSON value is skipped. The brackets are balanced outside of the
+    strings (with their escapes), so the parser knows when the top-level value is complete
+    without waiting for the end of the stream. A candidate which is not valid JSON, or which
+    `accept` rejects (by default, anything but a non-empty list of objects or a non-empty
+    object, such as the citation "[1]" or "{}" in prose), is dropped and the scan goes on.
+    The elements of a top-level array are returned by feed as they complete, before the
+    array itself is accepted.
+
+    Example:
+        parser = JsonStreamParser()
+        for piece in pieces:
+            for item in parser.feed(piece):
+                ...
+            if parser.done:
+                break
+    """
+
+    def __init__(self, keep_value=True, accept=is_answer):
+        """Initialize the parser.
+
+        Args:
+            keep_value (bool): Keep the text of the top-level value, so `value` is set when it is complete.
+                Without it, the text of each array element is dropped once the element is returned, so a
+                large array (such as an input file) is read in constant memory, and `value` stays None.
+            accept (Callable): Whether a complete top-level value is the one to return, the scan goes on
+                after a rejected value. It is only used with keep_value, None accepts any value.
+        """
+        self.value = None
+        self.done = False
+        self.keep_value = keep_value
+        self.accept = accept
+        self._reset()
+
+    def _reset(self):
+        self._buffer = []
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._element_start = None
+
+    def feed(self, text):
+        """Consume a chunk of text.
+
+        Returns:
+            list: The values which are complete after this chunk, which are the object or
+            array elements of a top-level array, or the top-level object itself.
+        """
+        found = []
+        for char in text:
+            if self.done:
+                break
+
+            if not self._stack:
+                # Skip the prose until a JSON value starts.
+                if char in "[{":
+                    self._buffer = [char]
+                    self._stack = [char]
+                continue
+
+            self._buffer.append(char)
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in "[{":
+                self._stack.append(char)
+                if len(self._stack) == 2 and self._stack[0] == "[":
+                    self._element_start = len(self._buffer) - 1
+            elif char in "]}":
+                if PAIRS[char] != self._stack[-1]:
+                    self._reset()
+                    continue
+
+                self._stack.pop()
+                if len(self._stack) == 1 and self._element_start is not None:
+                    element = self._loads(self._buffer[self._element_start :])
+                    self._element_start = None
+                    if element is not None:
+                        found.append(element)
+                    if not self.keep_value:
+                        self._buffer = self._buffer[:1]
+                elif not self._stack and not self.keep_value:
+                    self._reset()
+                    self.done = True
+                elif not self._stack:
+                    value = self._loads(self._buffer)
+                    self._reset()
+                    if value is not None and (self.accept is None or self.accept(value)):
+                        self.value = value
+                        self.done = True
+                        if isinstance(value, dict):
+                            found.append(value)
+
+        return found
+
+    @staticmethod
+    def _loads(chars):
+        try:
+            return json.loads("".join(chars))
+        except json.JSONDecodeError:
+            return None
@@ -0,0 +1,203 @@
+import json
+import math
+import threading
+from dataclasses import asdict, dataclass
+
+# The timing fields of the final chunk of a generate stream, the durations are in nanoseconds.
+SERVER_FIELDS = (
+    "total_duration",
+    "load_duration",
+    "prompt_eval_count",
+    "prompt_eval_duration",
+    "eval_count",
+    "eval_duration",
+)
+
+
+@dataclass
+class GenerationStats:
+    """The statistics of a generate request.
+
+    The server fields come from the final chunk of the stream. They are unavailable (None) when the
+    stream is closed before the end, such as by stop_on_json after its grace tokens, then eval_count is
+    the number of received chunks (one token each) and complete is False. The client fields are measured by the
+    client: wall_time is the latency of the request and time_to_first_token the latency of the
+    first response token, both in seconds.
+    """
+
+    model: str = ""
+    total_duration: int | None = None
+    load_duration: int | None = None
+    prompt_eval_count: int | None = None
+    prompt_eval_duration: int | None = None
+    eval_count: int | None = None
+    eval_duration: int | None = None
+    wall_time: float = 0.0
+    time_to_first_token: float | None = None
+    complete: bool = True
+    cached: bool = False
+
+    @classmethod
+    def from_chunk(cls, chunk, model="", **kwargs):
+        """Build the stats from the final chunk of a stream (or the stats of a cached response)."""
+        chunk = chunk or {}
+        values = {name: None if chunk.get(name) is None else int(chunk[name]) for name in SERVER_FIELDS}
+        return cls(model=model, **{**values, **kwargs})
+
+    @property
+    def tokens_per_second(self):
+        """Generation speed, it is measured by the server."""
+        return self.eval_count / self.eval_duration * 1e9 if self.eval_duration else None
+
+    @property
+    def prompt_tokens_per_second(self):
+        """Prompt evaluation speed, it is measured by the server."""
+        return self.prompt_eval_count / self.prompt_eval_duration * 1e9 if self.prompt_eval_duration else None
+
+    def server_fields(self):
+        return {name: getattr(self, name) for name in SERVER_FIELDS}
+
+    def to_dict(self):
+        return {
+            **asdict(self),
+            "tokens_per_second": self.tokens_per_second,
+            "prompt_tokens_per_second": self.prompt_tokens_per_second,
+        }
+
+
+def percentile(values, q):
+    """The q-th percentile (0-100) of the values with the nearest-rank method, None for no values."""
+    if not values:
+        return None
+
+    values = sorted(values)
+    rank = max(math.ceil(q / 100 * len(values)), 1)
+    return values[rank - 1]
+
+
+class StatsCollector:
+    """Collect the stats of the generate requests of a run, and summarize or export them.
+
+    The module-level client.generate adds the stats of each request to the process-wide collector
+    (see get_stats_collector). It is thread-safe, the async client calls generate from its workers.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.records = []
+
+    def add(self, stats: GenerationStats):
+        with self._lock:
+            self.records.append(stats)
+
+    def clear(self):
+        with self._lock:
+            self.records = []
+
+    def __len__(self):
+        return len(self.records)
+
+    def summary(self):
+        """Aggregate the stats of the requests.
+
+        The latencies only cover the requests which were sent to the server, not the cached ones. The speeds are
+        the total tokens over the total server durations, so the long requests weigh more than the short ones.
+        """
+        with self._lock:
+            stats = list(self.records)
+
+        sent = [s for s in stats if not s.cached]
+        complete = [s for s in sent if s.complete]
+        wall_times = [s.wall_time for s in sent]
+        ttfts = [s.time_to_first_token for s in sent if s.time_to_first_token is not None]
+        loads = [(s.load_duration or 0) / 1e9 for s in complete]
+        eval_count = sum(s.eval_count or 0 for s in complete)
+        eval_duration = sum(s.eval_duration or 0 for s in complete)
+        prompt_eval_count = sum(s.prompt_eval_count or 0 for s in complete)
+        prompt_eval_duration = sum(s.prompt_eval_duration or 0 for s in complete)
+
+        return {
+            "requests": len(stats),
+            "cached": len(stats) - len(sent),
+            "incomplete": sum(1 for s in sent if not s.complete),
+            # The prompt tokens of the incomplete requests are unknown, their generated tokens are counted by the client.
+            "prompt_tokens": prompt_eval_count,
+            "generated_tokens": sum(s.eval_count or 0 for s in sent),
+            "tokens_per_second": eval_count / eval_duration * 1e9 if eval_duration else None,
+            "prompt_tokens_per_second": prompt_eval_count / prompt_eval_duration * 1e9 if prompt_eval_duration else None,
+            "time_to_first_token_p50": percentile(ttfts, 50),
+            "time_to_first_token_p95": percentile(ttfts, 95),
+            "load_time_total": sum(loads),
+            "load_time_max": max(loads) if loads else None,
+            "latency_p50": percentile(wall_times, 50),
+            "latency_p95": percentile(wall_times, 95),
+            "latency_total": sum(wall_times),
+        }
+
+    def format_summary(self):
+        """The summary as a short human readable text."""
+        summary = self.summary()
+
+        def fmt(value, unit="s"):
+            return "-" if value is None else f"{value:.2f}{unit}"
+
+        return "\n".join(
+            [
+                f"Requests: {summary['requests']} ({summary['cached']} cached, {summary['incomplete']} stopped early)",
+                f"Tokens: {summary['prompt_tokens']} prompt, {summary['generated_tokens']} generated",
+                f"Speed: {fmt(summary['prompt_tokens_per_second'], ' tokens/s')} prompt, {fmt(summary['tokens_per_second'], ' tokens/s')} generation",
+                f"Time to first token: p50 {fmt(summary['time_to_first_token_p50'])}, p95 {fmt(summary['time_to_first_token_p95'])}",
+                f"Model load: {fmt(summary['load_time_total'])} total, {fmt(summary['load_time_max'])} max",
+                f"Latency: p50 {fmt(summary['latency_p50'])}, p95 {fmt(summary['latency_p95'])}, {fmt(summary['latency_total'])} total",
+            ]
+        )
+
+    def write_jsonl(self, path):
+        """Write one line per request."""
+        with self._lock:
+            records = list(self.records)
+
+        with open(path, "w") as f:
+            for stats in records:
+                f.write(json.dumps(stats.to_dict()) + "\n")
+
+    def write_prometheus(self, path, prefix="text2knowledge_ollama"):
+        """Write the summary in the Prometheus text format, such as for the textfile collector of the node exporter."""
+        summary = self.summary()
+        metrics = [
+            ("requests_total", summary["requests"]),
+            ("cached_requests_total", summary["cached"]),
+            ("incomplete_requests_total", summary["incomplete"]),
+            ("prompt_tokens_total", summary["prompt_tokens"]),
+            ("generated_tokens_total", summary["generated_tokens"]),
+            ("prompt_tokens_per_second", summary["prompt_tokens_per_second"]),
+            ("generated_tokens_per_second", summary["tokens_per_second"]),
+            ('time_to_first_token_seconds{quantile="0.5"}', summary["time_to_first_token_p50"]),
+            ('time_to_first_token_seconds{quantile="0.95"}', summary["time_to_first_token_p95"]),
+            ("load_seconds_total", summary["load_time_total"]),
+            ("load_seconds_max", summary["load_time_max"]),
+            ('latency_seconds{quantile="0.5"}', summary["latency_p50"]),
+            ('latency_seconds{quantile="0.95"}', summary["latency_p95"]),
+            ("latency_seconds_sum", summary["latency_total"]),
+            ("latency_seconds_count", summary["requests"] - summary["cached"]),
+        ]
+
+        with open(path, "w") as f:
+            for name, value in metrics:
+                if value is not None:
+                    f.write(f"{prefix}_{name} {value}\n")
+
+    def export(self, path):
+        """Write the stats to a file, in the Prometheus text format for a .prom file, otherwise in JSONL."""
+        if path.endswith(".prom"):
+            self.write_prometheus(path)
+        else:
+            self.write_jsonl(path)
+
+
+_collector = StatsCollector()
+
+
+def get_stats_collector():
+    """Get the process-wide collector of the module-level client.generate."""
+    return _collector
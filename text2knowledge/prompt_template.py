@@ -1,5 +1,113 @@
 from typing import List, Dict
 
+# The categories and the types which the prompts ask for, the JSON schemas of the structured output are built from them.
+ENTITY_CATEGORIES = ["Disease", "Gene", "Compound", "Metabolite", "Symptom", "Protein", "Pathway", "Unknown"]
+
+CONCEPT_TYPES = ["Gene", "Compound", "Disease", "Symptom", "Pathway", "Anatomy", "Metabolite", "MolecularFunction", "BiologicalProcess", "CellularComponent"]
+
+RELATION_TYPES = [
+    "BioMedGPS::AssociatedWith::Gene:Disease",
+    "BioMedGPS::Modulator::Compound:Gene",
+    "BioMedGPS::Interaction::Gene:Gene",
+    "BioMedGPS::VirGeneHumGene::Gene:Gene",
+    "BioMedGPS::Activator::Compound:Gene",
+    "BioMedGPS::Agonist::Compound:Gene",
+    "BioMedGPS::AllostericModulator::Compound:Gene",
+    "BioMedGPS::Antagonist::Compound:Gene",
+    "BioMedGPS::Antibody::Compound:Gene",
+    "BioMedGPS::Binder::Compound:Gene",
+    "BioMedGPS::Blocker::Compound:Gene",
+    "BioMedGPS::Inhibitor::Compound:Gene",
+    "BioMedGPS::AssociatedWith::Compound:Gene",
+    "BioMedGPS::Carrier::Compound:Gene",
+    "BioMedGPS::Interaction::Compound:Compound",
+    "BioMedGPS::Treatment::Compound:Disease",
+    "BioMedGPS::AtcClassification::Compound:Atc",
+    "BioMedGPS::Binder::Gene:Gene",
+    "BioMedGPS::Target::Gene:Disease",
+    "BioMedGPS::E+::Compound:Gene",
+    "BioMedGPS::E-::Compound:Gene",
+    "BioMedGPS::E::Compound:Gene",
+    "BioMedGPS::E+::Gene:Gene",
+    "BioMedGPS::E::Gene:Gene",
+    "BioMedGPS::Promotor::Gene:Disease",
+    "BioMedGPS::InComplex::Gene:Gene",
+    "BioMedGPS::InPathway::Gene:Gene",
+    "BioMedGPS::InTax::Gene:Tax",
+    "BioMedGPS::Causer::Compound:Disease",
+    "BioMedGPS::Causer::Gene:Disease",
+    "BioMedGPS::PharmacoKinetics::Compound:Gene",
+    "BioMedGPS::Biomarker::Gene:Disease",
+    "BioMedGPS::Biomarker::Compound:Disease",
+    "BioMedGPS::Influencer::Gene:Gene",
+    "BioMedGPS::SideEffect::Compound:Disease",
+    "BioMedGPS::Activator::Gene:Gene",
+    "BioMedGPS::Risky::Gene:Disease",
+    "BioMedGPS::E-::Anatomy:Gene",
+    "BioMedGPS::E::Anatomy:Gene",
+    "BioMedGPS::E+::Anatomy:Gene",
+    "BioMedGPS::SimilarWith::Compound:Compound",
+    "BioMedGPS::E-::Disease:Gene",
+    "BioMedGPS::LocatedIn::Disease:Anatomy",
+    "BioMedGPS::Present::Disease:Symptom",
+    "BioMedGPS::SimilarWith::Disease:Disease",
+    "BioMedGPS::E+::Disease:Gene",
+    "BioMedGPS::Covary::Gene:Gene",
+    "BioMedGPS::InBP::Gene:BiologicalProcess",
+    "BioMedGPS::InCC::Gene:CellularComponent",
+    "BioMedGPS::InMF::Gene:MolecularFunction",
+    "BioMedGPS::InPathway::Gene:Pathway",
+    "BioMedGPS::InPC::Compound:PharmacologicClass",
+    "BioMedGPS::AdpRibosylationReaction::Gene:Gene",
+    "BioMedGPS::AssociatedWith::Gene:Gene",
+    "BioMedGPS::CleavageReaction::Gene:Gene",
+    "BioMedGPS::InLocation::Gene:Gene",
+    "BioMedGPS::DePhosphorylationReaction::Gene:Gene",
+    "BioMedGPS::Interaction::Compound:Gene",
+    "BioMedGPS::PhosphorylationReaction::Gene:Gene",
+    "BioMedGPS::ProteinCleavage::Gene:Gene",
+    "BioMedGPS::UbiquitinationReaction::Gene:Gene",
+    "BioMedGPS::Inbitor::Gene:Gene",
+    "BioMedGPS::PostTranslationalMod::Gene:Gene",
+    "BioMedGPS::AssociatedWith::Pathway:Disease",
+    "BioMedGPS::AssociatedWith::Gene:Symptom",
+    "BioMedGPS::Contraindication::Disease:Compound",
+    "BioMedGPS::NE::Anatomy:Gene",
+    "BioMedGPS::AssociatedWith::BiologicalProcess:Gene",
+    "BioMedGPS::AssociatedWith::BiologicalProcess:Exposure",
+    "BioMedGPS::AssociatedWith::CellularComponent:Gene",
+    "BioMedGPS::AssociatedWith::CellularComponent:Exposure",
+    "BioMedGPS::AssociatedWith::MolecularFunction:Gene",
+    "BioMedGPS::AssociatedWith::Gene:Pathway",
+    "BioMedGPS::AssociatedWith::Gene:Exposure",
+    "BioMedGPS::AssociatedWith::MolecularFunction:Exposure",
+    "BioMedGPS::AssociatedWith::Exposure:Disease",
+    "BioMedGPS::ParentChild::Anatomy:Anatomy",
+    "BioMedGPS::ParentChild::BiologicalProcess:BiologicalProcess",
+    "BioMedGPS::ParentChild::CellularComponent:CellularComponent",
+    "BioMedGPS::ParentChild::Disease:Disease",
+    "BioMedGPS::ParentChild::MolecularFunction:MolecularFunction",
+    "BioMedGPS::ParentChild::Pathway:Pathway",
+    "BioMedGPS::ParentChild::Symptom:Symptom",
+    "BioMedGPS::ParentChild::Exposure:Exposure",
+    "BioMedGPS::Absent::Disease:Symptom",
+    "BioMedGPS::SideEffect::Compound:Symptom",
+    "BioMedGPS::Target::Gene:Compound",
+    "BioMedGPS::Transporter::Gene:Compound",
+]
+
+ARTICLE_CATEGORIES = [
+    "Molecular Mechanism Study",
+    "Review",
+    "Clinical Trial",
+    "Epidemiological Study",
+    "Retrospective Study",
+    "Clinical Test Index Study",
+    "Case Report",
+    "Meta-Analysis",
+    "Unknown",
+]
+
 LEGACY_ENTITY_EXTRACTION_PROMPT_TEMPLATE = """
 To ensure the analysis is both comprehensive and accurate, it is crucial to identify and categorize biomedical entities from the text strictly according to the provided categories. Your output should only include entities that fit into the following categories: 'Gene', 'Protein', 'Compound', 'Disease', 'Symptom', 'Pathway', 'Anatomy', 'Metabolite', 'MolecularFunction', 'BiologicalProcess', 'CellularComponent'. Any entities that do not align with these categories must be omitted.
 
@@ -145,6 +253,8 @@ def make_entity_extraction_prompt(text: str | None) -> str:
 
 
 def make_entity_extraction_review_prompt(text: str | None, entities: List[Dict]) -> str:
+    # Without the text, the review continues from the context of the extraction request, which holds the text already.
+    text = text if text else "The raw text is the user input of the extraction above."
     prompt = f"""
     Raw text is provided for entity extraction. The extracted entities are categorized into Disease, Gene, Compound, Metabolite, Symptom, Protein, Pathway, or Unknown. The confidence scores are assigned based on the relevance and accuracy of the entities to their respective categories. The entities are extracted based on the context provided in the text.
     {text}
@@ -165,6 +275,11 @@ def make_entity_extraction_review_prompt(text: str | None, entities: List[Dict])
     return prompt
 
 
+def make_user_prompt(text: str) -> str:
+    """The variable part of a request, the static instructions of the make_*_prompt(None) functions are the system prompt."""
+    return f"User Input:\n```{text}```"
+
+
 def make_relation_extraction_prompt(text: str | None) -> str:
     prompt = """
     You are a network graph maker who extracts terms and their relations from a given context. 
@@ -186,19 +301,61 @@ def make_relation_extraction_prompt(text: str | None) -> str:
     [
         {
             "source_name": "A concept from extracted ontology",
-            "source_type": "The type of the concept, one of Gene, Compound, Disease, Symptom, Pathway, Anatomy, Metabolite, MolecularFunction, BiologicalProcess, CellularComponent.",
+            "source_type": "The type of the concept, one of %(concept_types)s.",
             "target_name": "A related concept from extracted ontology",
-            "target_type": "The type of the concept, one of Gene, Compound, Disease, Symptom, Pathway, Anatomy, Metabolite, MolecularFunction, BiologicalProcess, CellularComponent.",
-            "relation_type": "The type of relation between the two concepts, one of BioMedGPS::AssociatedWith::Gene:Disease, BioMedGPS::Modulator::Compound:Gene, BioMedGPS::Interaction::Gene:Gene, BioMedGPS::VirGeneHumGene::Gene:Gene, BioMedGPS::Activator::Compound:Gene, BioMedGPS::Agonist::Compound:Gene, BioMedGPS::AllostericModulator::Compound:Gene, BioMedGPS::Antagonist::Compound:Gene, BioMedGPS::Antibody::Compound:Gene, BioMedGPS::Binder::Compound:Gene, BioMedGPS::Blocker::Compound:Gene, BioMedGPS::Inhibitor::Compound:Gene, BioMedGPS::AssociatedWith::Compound:Gene, BioMedGPS::Carrier::Compound:Gene, BioMedGPS::Interaction::Compound:Compound, BioMedGPS::Treatment::Compound:Disease, BioMedGPS::AtcClassification::Compound:Atc, BioMedGPS::Binder::Gene:Gene, BioMedGPS::Target::Gene:Disease, BioMedGPS::E+::Compound:Gene, BioMedGPS::E-::Compound:Gene, BioMedGPS::E::Compound:Gene, BioMedGPS::E+::Gene:Gene, BioMedGPS::E::Gene:Gene, BioMedGPS::Promotor::Gene:Disease, BioMedGPS::InComplex::Gene:Gene, BioMedGPS::InPathway::Gene:Gene, BioMedGPS::InTax::Gene:Tax, BioMedGPS::Causer::Compound:Disease, BioMedGPS::Causer::Gene:Disease, BioMedGPS::PharmacoKinetics::Compound:Gene, BioMedGPS::Biomarker::Gene:Disease, BioMedGPS::Biomarker::Compound:Disease, BioMedGPS::Influencer::Gene:Gene, BioMedGPS::SideEffect::Compound:Disease, BioMedGPS::Activator::Gene:Gene, BioMedGPS::Risky::Gene:Disease, BioMedGPS::E-::Anatomy:Gene, BioMedGPS::E::Anatomy:Gene, BioMedGPS::E+::Anatomy:Gene, BioMedGPS::SimilarWith::Compound:Compound, BioMedGPS::E-::Disease:Gene, BioMedGPS::LocatedIn::Disease:Anatomy, BioMedGPS::Present::Disease:Symptom, BioMedGPS::SimilarWith::Disease:Disease, BioMedGPS::E+::Disease:Gene, BioMedGPS::Covary::Gene:Gene, BioMedGPS::InBP::Gene:BiologicalProcess, BioMedGPS::InCC::Gene:CellularComponent, BioMedGPS::InMF::Gene:MolecularFunction, BioMedGPS::InPathway::Gene:Pathway, BioMedGPS::InPC::Compound:PharmacologicClass, BioMedGPS::AdpRibosylationReaction::Gene:Gene, BioMedGPS::AssociatedWith::Gene:Gene, BioMedGPS::CleavageReaction::Gene:Gene, BioMedGPS::InLocation::Gene:Gene, BioMedGPS::DePhosphorylationReaction::Gene:Gene, BioMedGPS::Interaction::Compound:Gene, BioMedGPS::PhosphorylationReaction::Gene:Gene, BioMedGPS::ProteinCleavage::Gene:Gene, BioMedGPS::UbiquitinationReaction::Gene:Gene, BioMedGPS::Inbitor::Gene:Gene, BioMedGPS::PostTranslationalMod::Gene:Gene, BioMedGPS::AssociatedWith::Pathway:Disease, BioMedGPS::AssociatedWith::Gene:Symptom, BioMedGPS::Contraindication::Disease:Compound, BioMedGPS::NE::Anatomy:Gene, BioMedGPS::AssociatedWith::BiologicalProcess:Gene, BioMedGPS::AssociatedWith::BiologicalProcess:Exposure, BioMedGPS::AssociatedWith::CellularComponent:Gene, BioMedGPS::AssociatedWith::CellularComponent:Exposure, BioMedGPS::AssociatedWith::MolecularFunction:Gene, BioMedGPS::AssociatedWith::Gene:Pathway, BioMedGPS::AssociatedWith::Gene:Exposure, BioMedGPS::AssociatedWith::MolecularFunction:Exposure, BioMedGPS::AssociatedWith::Exposure:Disease, BioMedGPS::ParentChild::Anatomy:Anatomy, BioMedGPS::ParentChild::BiologicalProcess:BiologicalProcess, BioMedGPS::ParentChild::CellularComponent:CellularComponent, BioMedGPS::ParentChild::Disease:Disease, BioMedGPS::ParentChild::MolecularFunction:MolecularFunction, BioMedGPS::ParentChild::Pathway:Pathway, BioMedGPS::ParentChild::Symptom:Symptom, BioMedGPS::ParentChild::Exposure:Exposure, BioMedGPS::Absent::Disease:Symptom, BioMedGPS::SideEffect::Compound:Symptom, BioMedGPS::Target::Gene:Compound, BioMedGPS::Transporter::Gene:Compound."
+            "target_type": "The type of the concept, one of %(concept_types)s.",
+            "relation_type": "The type of relation between the two concepts, one of %(relation_types)s."
             "key_sentence": "relationship between the two concepts, node_1 and node_2 in one or two sentences"
         }, {...}
     ]
-    """
+    """ % {"concept_types": ", ".join(CONCEPT_TYPES), "relation_types": ", ".join(RELATION_TYPES)}
 
     text = f"\n\nUser Input:\n```{text}```" if text else ""
     return prompt + text
 
-def make_classification_prompt(text: str | None) -> str:
+def make_knowledge_extraction_prompt(text: str | None) -> str:
+    """Extract the entities and the relations between them in one response, the relations reference the entities by id."""
+    prompt = """
+    The Biomedical Knowledge Extractor reads a biomedical text and extracts, in a single pass, the biomedical entities it mentions and the relations between them. The text is provided as the user input, enclosed in triple backticks (```).
+
+    Output Structure:
+    The output is a JSON object with two fields:
+    - entities: A list of the biomedical entities found in the text, each entity has the following fields:
+        - id: A short unique id of the entity, such as e1, e2, e3...
+        - concept: The biomedical entity found in the text.
+        - category: The category of the entity, one of %(categories)s.
+        - score: A confidence score from 1 to 5, with 5 being the highest.
+        - reason: A short explanation of why the concept was identified as the category.
+    - relations: A list of the relations between the entities, each relation has the following fields:
+        - source: The id of the source entity.
+        - target: The id of the target entity.
+        - relation_type: The type of the relation, one of %(relation_types)s.
+        - key_sentence: The relation between the two entities in one or two sentences.
+
+    Extraction Guidelines:
+    - Phrases representing complete concepts are not split into individual words.
+    - Every relation must reference the ids of entities in the entities list, add the entity first if it is missing.
+    - Entities which are mentioned in the same sentence or the same paragraph are typically related to each other.
+
+    Example Output:
+    {
+        "entities": [
+            {"id": "e1", "concept": "BRCA1", "category": "Gene", "score": 5, "reason": "Identified as a gene from HGNC."},
+            {"id": "e2", "concept": "Breast Cancer", "category": "Disease", "score": 5, "reason": "Referenced from MESH and DOID."},
+            {"id": "e3", "concept": "Tamoxifen", "category": "Compound", "score": 4, "reason": "Listed in DrugBank as a therapeutic compound."}
+        ],
+        "relations": [
+            {"source": "e1", "target": "e2", "relation_type": "BioMedGPS::AssociatedWith::Gene:Disease", "key_sentence": "Mutations of BRCA1 increase the risk of breast cancer."},
+            {"source": "e3", "target": "e2", "relation_type": "BioMedGPS::Treatment::Compound:Disease", "key_sentence": "Tamoxifen is used to treat breast cancer."}
+        ]
+    }
+    """ % {"categories": ", ".join(ENTITY_CATEGORIES), "relation_types": ", ".join(RELATION_TYPES)}
+
+    text = f"\n\nUser Input:\n```{text}```" if text else ""
+    return prompt + text
+
+
+def make_classification_prompt(text: str | None, confidence: bool = False) -> str:
     prompt = """
     This GPT will help users identify the categories of biomedical literature, such as molecular mechanism studies, reviews, clinical trials, epidemiological studies, retrospective studies, clinical test index studies, case reports, and meta-analyses. It will read and analyze the content of the provided texts and categorize them accordingly. If a document does not fit any of the given categories, it will output 'Unknown.' For each provided paper title and abstract, which will be enclosed in triple backticks (```), it will give its judgment in JSON format, including 'category' and 'reason' fields.
 
@@ -254,5 +411,121 @@ def make_classification_prompt(text: str | None) -> str:
     ]
     """
 
+    if confidence:
+        prompt += """
+    Also add a 'confidence' field to the JSON object, an integer from 1 to 5 which tells how confident you are in the category, with 5 being the highest. Give a low confidence when the abstract is short, ambiguous or fits several categories.
+    """
+
     text = f"\n\nUser Input:\n```{text}```" if text else ""
     return prompt + text
+
+
+# JSON schemas of the structured output (the Ollama `format` parameter). Ollama constrains the top-level value
+# to an object, so the lists are wrapped in an object with a single field.
+def _list_schema(key: str, item_schema: Dict) -> Dict:
+    return {
+        "type": "object",
+        "properties": {key: {"type": "array", "items": item_schema}},
+        "required": [key],
+    }
+
+
+ENTITY_SCHEMA = _list_schema(
+    "entities",
+    {
+        "type": "object",
+        "properties": {
+            "concept": {"type": "string"},
+            "category": {"type": "string", "enum": ENTITY_CATEGORIES},
+            "score": {"type": "integer", "minimum": 1, "maximum": 5},
+            "reason": {"type": "string"},
+        },
+        "required": ["concept", "category", "score", "reason"],
+    },
+)
+
+RELATION_SCHEMA = _list_schema(
+    "relations",
+    {
+        "type": "object",
+        "properties": {
+            "source_name": {"type": "string"},
+            "source_type": {"type": "string", "enum": CONCEPT_TYPES},
+            "target_name": {"type": "string"},
+            "target_type": {"type": "string", "enum": CONCEPT_TYPES},
+            "relation_type": {"type": "string", "enum": RELATION_TYPES},
+            "key_sentence": {"type": "string"},
+        },
+        "required": ["source_name", "source_type", "target_name", "target_type", "relation_type", "key_sentence"],
+    },
+)
+
+KNOWLEDGE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "entities": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "id": {"type": "string"},
+                    "concept": {"type": "string"},
+                    "category": {"type": "string", "enum": ENTITY_CATEGORIES},
+                    "score": {"type": "integer", "minimum": 1, "maximum": 5},
+                    "reason": {"type": "string"},
+                },
+                "required": ["id", "concept", "category", "score", "reason"],
+            },
+        },
+        "relations": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "source": {"type": "string"},
+                    "target": {"type": "string"},
+                    "relation_type": {"type": "string", "enum": RELATION_TYPES},
+                    "key_sentence": {"type": "string"},
+                },
+                "required": ["source", "target", "relation_type", "key_sentence"],
+            },
+        },
+    },
+    "required": ["entities", "relations"],
+}
+
+CLASSIFICATION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "category": {"type": "string", "enum": ARTICLE_CATEGORIES},
+        "reason": {"type": "string"},
+    },
+    "required": ["category", "reason"],
+}
+
+# The classification with the self-reported confidence of the model, see make_classification_prompt.
+CLASSIFICATION_CONFIDENCE_SCHEMA = {
+    **CLASSIFICATION_SCHEMA,
+    "properties": {
+        **CLASSIFICATION_SCHEMA["properties"],
+        "confidence": {"type": "integer", "minimum": 1, "maximum": 5},
+    },
+    "required": CLASSIFICATION_SCHEMA["required"] + ["confidence"],
+}
+
+# Generation caps of the structured output, a runaway generation stops at num_predict tokens,
+# and the model can't start a new turn after the answer.
+TASK_OPTIONS = {
+    "entities": {"num_predict": 2048, "stop": ["User Input:"]},
+    "relations": {"num_predict": 3072, "stop": ["User Input:"]},
+    "knowledge": {"num_predict": 4096, "stop": ["User Input:"]},
+    "classification": {"num_predict": 512, "stop": ["User Input:"]},
+}
+
+
+def make_structured_output_prompt(prompt: str, key: str | None = None) -> str:
+    """Tell the model how the structured output wraps the list of the prompt examples."""
+    if key is None:
+        return prompt
+
+    return prompt + f'\n\nWrap the list in a JSON object with a single "{key}" field, such as {{"{key}": [...]}}.'
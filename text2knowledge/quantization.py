@@ -0,0 +1,169 @@
+import numpy as np
+from typing import Optional
+
+
+def _sample(vectors: np.ndarray, sample_size: int, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    sample_ids = np.sort(rng.choice(len(vectors), min(sample_size, len(vectors)), replace=False))
+    return np.asarray(vectors[sample_ids], dtype=np.float32)
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def kmeans(vectors: np.ndarray, k: int, niter: int = 10, seed: int = 0) -> np.ndarray:
+    """Euclidean k-means, returns the centroids with shape (k, dim)."""
+    rng = np.random.default_rng(seed)
+    k = min(k, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    for _ in range(niter):
+        # argmin ||x - c||^2 == argmin ||c||^2 - 2 x.c
+        distances = (centroids**2).sum(axis=1) - 2 * vectors @ centroids.T
+        assignments = np.argmin(distances, axis=1)
+        counts = np.bincount(assignments, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        non_empty = counts > 0
+        # Keep the previous centroid of an empty cluster.
+        centroids[non_empty] = sums[non_empty] / counts[non_empty, None]
+
+    return centroids
+
+
+class ScalarQuantizer:
+    """8-bit scalar quantization of L2-normalized vectors, one byte per dimension.
+
+    Each dimension is mapped linearly from [vmin, vmax] to [0, 255], so the inner product
+    with a query is codes @ (query * scale) + query @ vmin.
+    """
+
+    method = "sq8"
+
+    def __init__(self, vmin: np.ndarray, scale: np.ndarray):
+        self.vmin = vmin.astype(np.float32)
+        self.scale = scale.astype(np.float32)
+
+    @property
+    def code_size(self) -> int:
+        """Number of bytes per vector."""
+        return len(self.vmin)
+
+    @classmethod
+    def train(cls, vectors: np.ndarray, sample_size: int = 65536) -> "ScalarQuantizer":
+        sample = _normalize(_sample(vectors, sample_size))
+        vmin, vmax = sample.min(axis=0), sample.max(axis=0)
+        return cls(vmin, np.maximum(vmax - vmin, 1e-12) / 255)
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        codes = np.rint((_normalize(vectors) - self.vmin) / self.scale)
+        return np.clip(codes, 0, 255).astype(np.uint8)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return codes.astype(np.float32) * self.scale + self.vmin
+
+    def scores(self, codes: np.ndarray, queries: np.ndarray) -> np.ndarray:
+        """Approximate inner products between normalized queries and the encoded vectors, with shape (num_queries, len(codes))."""
+        return (queries * self.scale) @ codes.T.astype(np.float32) + (queries @ self.vmin)[:, None]
+
+    def state(self) -> dict:
+        return {"method": np.array(self.method), "vmin": self.vmin, "scale": self.scale}
+
+    @classmethod
+    def from_state(cls, state) -> "ScalarQuantizer":
+        return cls(state["vmin"], state["scale"])
+
+
+class ProductQuantizer:
+    """Product quantization of L2-normalized vectors.
+
+    The vectors are split into m sub-vectors, and each sub-vector is replaced with the id
+    of the nearest of 256 centroids, so a vector takes m bytes. The inner product with a
+    query is a sum of m lookups in per-query tables (asymmetric distance computation).
+    """
+
+    method = "pq"
+
+    def __init__(self, centroids: np.ndarray):
+        # (m, 256, dim // m)
+        self.centroids = centroids.astype(np.float32)
+
+    @property
+    def m(self) -> int:
+        return self.centroids.shape[0]
+
+    @property
+    def code_size(self) -> int:
+        """Number of bytes per vector."""
+        return self.m
+
+    @staticmethod
+    def default_m(dim: int, subvector_dim: int = 16) -> int:
+        """The largest number of sub-vectors which divides dim and has at least subvector_dim dimensions per sub-vector."""
+        m = max(1, dim // subvector_dim)
+        while dim % m != 0:
+            m -= 1
+
+        return m
+
+    @classmethod
+    def train(
+        cls,
+        vectors: np.ndarray,
+        m: Optional[int] = None,
+        niter: int = 10,
+        sample_size: int = 65536,
+    ) -> "ProductQuantizer":
+        dim = vectors.shape[1]
+        m = m or cls.default_m(dim)
+        if dim % m != 0:
+            raise ValueError("The dimension (%s) must be divisible by m (%s)." % (dim, m))
+
+        sample = _normalize(_sample(vectors, sample_size))
+        subvectors = sample.reshape(len(sample), m, dim // m)
+        centroids = np.zeros((m, 256, dim // m), dtype=np.float32)
+        for j in range(m):
+            trained = kmeans(subvectors[:, j, :], 256, niter=niter, seed=j)
+            centroids[j, : len(trained)] = trained
+
+        return cls(centroids)
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        vectors = _normalize(vectors)
+        subvectors = vectors.reshape(len(vectors), self.m, -1)
+        codes = np.empty((len(vectors), self.m), dtype=np.uint8)
+        for j in range(self.m):
+            c = self.centroids[j]
+            distances = (c**2).sum(axis=1) - 2 * subvectors[:, j, :] @ c.T
+            codes[:, j] = np.argmin(distances, axis=1)
+
+        return codes
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return self.centroids[np.arange(self.m), codes].reshape(len(codes), -1)
+
+    def scores(self, codes: np.ndarray, queries: np.ndarray) -> np.ndarray:
+        """Approximate inner products between normalized queries and the encoded vectors, with shape (num_queries, len(codes))."""
+        subqueries = queries.reshape(len(queries), self.m, -1)
+        # (num_queries, m, 256)
+        tables = np.einsum("qmd,mkd->qmk", subqueries, self.centroids)
+        scores = np.zeros((len(queries), len(codes)), dtype=np.float32)
+        for j in range(self.m):
+            scores += tables[:, j, codes[:, j]]
+
+        return scores
+
+    def state(self) -> dict:
+        return {"method": np.array(self.method), "centroids": self.centroids}
+
+    @classmethod
+    def from_state(cls, state) -> "ProductQuantizer":
+        return cls(state["centroids"])
+
+
+QUANTIZERS = {
+    ScalarQuantizer.method: ScalarQuantizer,
+    ProductQuantizer.method: ProductQuantizer,
+}
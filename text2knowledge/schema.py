@@ -0,0 +1,67 @@
+from typing import Any, Dict, List
+
+# The subset of JSON schema which is used by the structured output of the prompt templates.
+TYPES = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "integer": int,
+    "number": (int, float),
+    "boolean": bool,
+    "null": type(None),
+}
+
+
+class SchemaValidationError(ValueError):
+    """The instance doesn't match the JSON schema."""
+
+    def __init__(self, errors: List[str]):
+        super().__init__("; ".join(errors))
+        self.errors = errors
+
+
+def iter_errors(instance: Any, schema: Dict, path: str = "$") -> List[str]:
+    """Validate an instance against a JSON schema.
+
+    Only type, enum, properties, required, items, minimum and maximum are supported.
+
+    Returns:
+        List[str]: Error messages, an empty list means the instance is valid.
+    """
+    errors: List[str] = []
+    expected = schema.get("type")
+    if expected is not None:
+        types = TYPES[expected]
+        # bool is a subclass of int, but true isn't a valid integer in JSON schema.
+        if not isinstance(instance, types) or (isinstance(instance, bool) and expected != "boolean"):
+            return [f"{path}: expected {expected}, got {type(instance).__name__}"]
+
+    if "enum" in schema and instance not in schema["enum"]:
+        errors.append(f"{path}: {instance!r} is not one of the allowed values")
+
+    if isinstance(instance, (int, float)) and not isinstance(instance, bool):
+        if "minimum" in schema and instance < schema["minimum"]:
+            errors.append(f"{path}: {instance} is less than {schema['minimum']}")
+        if "maximum" in schema and instance > schema["maximum"]:
+            errors.append(f"{path}: {instance} is greater than {schema['maximum']}")
+
+    if isinstance(instance, dict):
+        for key in schema.get("required", []):
+            if key not in instance:
+                errors.append(f"{path}: missing required field {key!r}")
+        for key, subschema in schema.get("properties", {}).items():
+            if key in instance:
+                errors.extend(iter_errors(instance[key], subschema, f"{path}.{key}"))
+
+    if isinstance(instance, list) and "items" in schema:
+        for i, item in enumerate(instance):
+            errors.extend(iter_errors(item, schema["items"], f"{path}[{i}]"))
+
+    return errors
+
+
+def validate(instance: Any, schema: Dict):
+    """Raise a SchemaValidationError if the instance doesn't match the JSON schema."""
+    errors = iter_errors(instance, schema)
+    if errors:
+        raise SchemaValidationError(errors)
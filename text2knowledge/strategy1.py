@@ -1,51 +1,78 @@
 import re
 import json
+import asyncio
 import logging
+import functools
+import numpy as np
 import pandas as pd
-import torch
+from typing import List, Tuple
 import text2knowledge.ollama.client as client
+from text2knowledge.ollama.client import OllamaError
+from text2knowledge.ollama.async_client import AsyncOllamaClient
+from text2knowledge.ollama.json_stream import JsonStreamParser
 from text2knowledge.prompt_template import (
     make_entity_extraction_prompt,
     make_relation_extraction_prompt,
     make_classification_prompt,
     make_entity_extraction_review_prompt,
+    make_knowledge_extraction_prompt,
+    make_structured_output_prompt,
+    make_user_prompt,
+    ENTITY_SCHEMA,
+    RELATION_SCHEMA,
+    KNOWLEDGE_SCHEMA,
+    CLASSIFICATION_SCHEMA,
+    CLASSIFICATION_CONFIDENCE_SCHEMA,
+    TASK_OPTIONS,
+    ARTICLE_CATEGORIES,
 )
+from text2knowledge.schema import validate
 from text2knowledge.utils import init_logger, EmbeddingGenerator
+from text2knowledge.ann import ExactIndex
 
 logger = init_logger(__name__)
 
 
 def get_mapped_entities(
-    entities: list, embeddings: pd.DataFrame, model_name: str
+    entities: list,
+    embeddings: pd.DataFrame,
+    model_name: str,
+    index=None,
+    topk: int = 5,
 ) -> list:
-    embedding_lst = embeddings["embedding"].tolist()
-    embedding_tensor_lst = [torch.tensor(embedding) for embedding in embedding_lst]
-    mapped_entities = []
-    all_labels = embeddings["label"].tolist()
+    """Map the extracted entities to the ontology items with the most similar embeddings.
 
-    for entity in entities:
-        category = entity.get("category", "")
-        entity_name = entity.get("concept", "")
-        embedding_generator = EmbeddingGenerator(model_name)
-        entity_name_embedding = embedding_generator.gen_text_embedding(entity_name)
+    Args:
+        entities (list): Extracted entities, each entity has a concept field.
+        embeddings (pd.DataFrame): Ontology items, in the same order as the rows of the index. It needs an embedding column if index is None.
+        model_name (str): Embedding model name, it must be the model which generated the ontology embeddings.
+        index: An index built from the ontology embeddings, see text2knowledge.ann.open_index. A brute-force search over the embedding column is used if it is None.
+        topk (int): Number of potential references for each entity.
 
-        scores = embedding_generator.vectorized_similarity(
-            entity_name_embedding, embedding_tensor_lst
-        )
-        index_scores = list(enumerate(scores))
-        index_scores.sort(key=lambda x: x[1], reverse=True)
+    Returns:
+        list: Entities with the potential_references field.
+    """
+    if not entities:
+        return []
 
-        # TODO: How to use the category information to filter the potential references?
-        top_5_index_scores = index_scores[:5]
-        top_5_indexes = [index for index, _ in top_5_index_scores]
-        mapped_entities = embeddings.iloc[top_5_indexes].to_dict(orient="records")
-        mapped_entities_with_scores = []
-        for i, entity in enumerate(mapped_entities):
-            entity["score"] = top_5_index_scores[i][1]
-            mapped_entities_with_scores.append(entity)
+    if index is None:
+        index = ExactIndex(np.array(embeddings["embedding"].tolist(), dtype=np.float32))
+
+    embedding_generator = EmbeddingGenerator(model_name)
+    entity_names = [entity.get("concept", "") for entity in entities]
+    name_embeddings = embedding_generator.gen_text_embeddings(entity_names)
+    scores, indexes = index.search(name_embeddings.float().numpy(), topk)
 
-        entity["potential_references"] = mapped_entities_with_scores
+    references = embeddings.drop(columns=["embedding"], errors="ignore")
+    mapped_entities = []
+    for entity, entity_scores, entity_indexes in zip(entities, scores, indexes):
+        # TODO: How to use the category information to filter the potential references?
+        valid = entity_indexes >= 0
+        potential_references = references.iloc[entity_indexes[valid]].to_dict(orient="records")
+        for reference, score in zip(potential_references, entity_scores[valid]):
+            reference["score"] = float(score)
 
+        entity["potential_references"] = potential_references
         mapped_entities.append(entity)
 
     return mapped_entities
@@ -77,6 +104,79 @@ def extract_json(text: str, is_list: bool = False) -> dict | list | None:
     return None
 
 
+# The schema of the structured output of each task, and the field which wraps the list.
+STRUCTURED_OUTPUTS = {
+    "entities": (ENTITY_SCHEMA, "entities"),
+    "relations": (RELATION_SCHEMA, "relations"),
+    "knowledge": (KNOWLEDGE_SCHEMA, None),
+    "classification": (CLASSIFICATION_SCHEMA, None),
+}
+
+
+def make_task_prompt(prompt: str, task: str, structured_output: bool = False) -> str:
+    if not structured_output:
+        return prompt
+
+    return make_structured_output_prompt(prompt, STRUCTURED_OUTPUTS[task][1])
+
+
+def make_task_request(make_prompt, text: str, task: str, use_system: bool = False, structured_output: bool = False) -> Tuple[str | None, str]:
+    """The system prompt and the prompt of a task request.
+
+    With use_system, the static instructions and examples are the system prompt and only the user input is the prompt,
+    so the requests of all documents start with the same tokens, which the server reuses from its prompt cache.
+    Otherwise, they are a single prompt.
+    """
+    if use_system:
+        return make_task_prompt(make_prompt(None), task, structured_output), make_user_prompt(text)
+
+    return None, make_task_prompt(make_prompt(text), task, structured_output)
+
+
+def generation_kwargs(task: str, options: dict, structured_output: bool = False) -> dict:
+    """The options of the generate request of a task, the structured output adds its schema and the task caps."""
+    if not structured_output:
+        return {"options": options}
+
+    return {
+        "options": {**TASK_OPTIONS[task], **(options or {})},
+        "format": STRUCTURED_OUTPUTS[task][0],
+    }
+
+
+def parse_output(response: str | None, task: str, structured_output: bool = False, is_list: bool | None = None):
+    """Parse the response of a task.
+
+    The structured output is validated against the schema of the task, the free text is searched for JSON by extract_json.
+
+    Raises:
+        ValueError: If the response is not valid.
+    """
+    if not structured_output and task == "knowledge":
+        # The joint output is a nested object, which the regular expressions of extract_json can't match.
+        parser = JsonStreamParser(accept=lambda value: isinstance(value, dict) and ("entities" in value or "relations" in value))
+        parser.feed(str(response))
+        if not isinstance(parser.value, dict):
+            raise ValueError("The response is not a JSON object.")
+        return parser.value
+
+    if not structured_output:
+        is_list = task != "classification" if is_list is None else is_list
+        data = extract_json(str(response), is_list=is_list)
+        if data is None or (task == "classification" and type(data) != dict):
+            raise ValueError("The response is not a JSON object.")
+        return data
+
+    schema, key = STRUCTURED_OUTPUTS[task]
+    try:
+        data = json.loads(str(response))
+    except json.JSONDecodeError as e:
+        raise ValueError(f"The response is not valid JSON: {e}")
+
+    validate(data, schema)
+    return data[key] if key else data
+
+
 def correct_extracted_entities(
     text: str,
     metadata={},
@@ -84,25 +184,51 @@ def correct_extracted_entities(
     options={},
     is_list=False,
     entities=[],
+    structured_output=False,
+    context=None,
 ):
-    prompt = make_entity_extraction_review_prompt(text, entities)
-    response, _ = client.generate(model_name=model, prompt=prompt, options=options)
+    """Review the extracted entities.
+
+    If the context of the extraction request is given (see extract_entities with keep_context), the
+    review continues from it, so the text isn't sent and encoded again.
+    """
+    if context:
+        prompt = make_task_prompt(make_entity_extraction_review_prompt(None, entities), "entities", structured_output)
+    else:
+        prompt = make_task_prompt(make_entity_extraction_review_prompt(text, entities), "entities", structured_output)
 
     try:
-        data = extract_json(str(response), is_list=is_list)
-        if data is None:
-            raise Exception("The response is not a JSON object.")
-        else:
-            return {
-                "entities": data,
-                "metadata": metadata,
-                "response": response,
-            }
+        response, _, stats = client.generate(
+            model_name=model,
+            prompt=prompt,
+            context=context or None,
+            stop_on_json=True,
+            **generation_kwargs("entities", options, structured_output),
+        )
+    except OllamaError as e:
+        logger.warning(f"ERROR ### The request failed: {e}")
+        return {
+            "response": None,
+            "metadata": metadata,
+            "entities": [],
+            "error": True,
+            "error_message": str(e),
+        }
+
+    try:
+        data = parse_output(response, "entities", structured_output, is_list=is_list)
+        return {
+            "entities": data,
+            "metadata": metadata,
+            "response": response,
+            "stats": stats.to_dict(),
+        }
     except:
         msg = f"ERROR ### Here is the buggy response: {response}"
         logger.info(msg)
         return {
             "response": msg,
+            "stats": stats.to_dict(),
             "metadata": metadata,
             "entities": [],
             "error": True,
@@ -117,41 +243,56 @@ def extract_entities(
     options={},
     embeddings: pd.DataFrame | None = None,
     embedding_model_name: str = "mistralai/Mistral-7B-v0.1",
+    index=None,
+    structured_output=False,
+    keep_context=False,
 ):
-    if use_system:
-        response, _ = client.generate(
-            model_name=model,
-            system=make_entity_extraction_prompt(None),
-            prompt=text,
-            options=options,
+    """Extract the entities of a text.
+
+    With keep_context, the response is read to the end (instead of stopping after the JSON) and
+    the model context is kept in the result, so correct_extracted_entities can continue from it.
+    """
+    kwargs = generation_kwargs("entities", options, structured_output)
+    system, prompt = make_task_request(make_entity_extraction_prompt, text, "entities", use_system, structured_output)
+    try:
+        response, context, stats = client.generate(
+            model_name=model, system=system, prompt=prompt, stop_on_json=not keep_context, **kwargs
         )
-    else:
-        prompt = make_entity_extraction_prompt(text)
-        response, _ = client.generate(model_name=model, prompt=prompt, options=options)
+    except OllamaError as e:
+        logger.warning(f"ERROR ### The request failed: {e}")
+        return {
+            "response": None,
+            "metadata": metadata,
+            "entities": [],
+            "text": text,
+            "prompt": prompt,
+            "error": True,
+            "error_message": str(e),
+        }
 
     try:
-        data = extract_json(str(response), is_list=True)
-        if data is None:
-            raise Exception("The response is not a JSON object.")
-        else:
-            return {
-                # entities_with_potential_references or entities_without_potential_references
-                "entities": (
-                    # TODO: Pick up a better model for the embeddings
-                    get_mapped_entities(data, embeddings, embedding_model_name)  # type: ignore
-                    if embeddings is not None
-                    else data
-                ),
-                "metadata": metadata,
-                "response": response,
-                "text": text,
-                "prompt": prompt,
-            }
+        data = parse_output(response, "entities", structured_output)
+        return {
+            # entities_with_potential_references or entities_without_potential_references
+            "entities": (
+                # TODO: Pick up a better model for the embeddings
+                get_mapped_entities(data, embeddings, embedding_model_name, index=index)  # type: ignore
+                if embeddings is not None
+                else data
+            ),
+            "metadata": metadata,
+            "response": response,
+            "stats": stats.to_dict(),
+            "text": text,
+            "prompt": prompt,
+            **({"model": model, "context": context} if keep_context else {}),
+        }
     except:
         msg = f"ERROR ### Here is the buggy response: {response}"
         logger.info(msg)
         return {
             "response": msg,
+            "stats": stats.to_dict(),
             "metadata": metadata,
             "entities": [],
             "text": text,
@@ -166,33 +307,39 @@ def extract_relations(
     model="mistral-openorca:latest",
     use_system=False,
     options={},
+    structured_output=False,
 ):
     if model == None:
         model = "mistral-openorca:latest"
 
-    if use_system:
-        response, _ = client.generate(
-            model_name=model,
-            system=make_relation_extraction_prompt(None),
-            prompt=text,
-            options=options,
+    kwargs = generation_kwargs("relations", options, structured_output)
+    system, PROMPT = make_task_request(make_relation_extraction_prompt, text, "relations", use_system, structured_output)
+    try:
+        response, _, stats = client.generate(
+            model_name=model, system=system, prompt=PROMPT, stop_on_json=True, **kwargs
         )
-    else:
-        PROMPT = make_relation_extraction_prompt(text)
-        response, _ = client.generate(model_name=model, prompt=PROMPT, options=options)
+    except OllamaError as e:
+        logger.warning(f"ERROR ### The request failed: {e}")
+        return {
+            "error": True,
+            "error_message": str(e),
+            "metadata": metadata,
+            "relations": [],
+            "text": text,
+            "prompt": PROMPT,
+            "response": None,
+        }
 
     try:
-        data = extract_json(str(response), is_list=True)
-        if data is None:
-            raise Exception("The response is not a JSON object.")
-        else:
-            return {
-                "relations": data,
-                "metadata": metadata,
-                "response": response,
-                "text": text,
-                "prompt": PROMPT,
-            }
+        data = parse_output(response, "relations", structured_output)
+        return {
+            "relations": data,
+            "metadata": metadata,
+            "response": response,
+            "stats": stats.to_dict(),
+            "text": text,
+            "prompt": PROMPT,
+        }
     except:
         msg = f"ERROR ### Here is the buggy response: {response}"
         logger.warning(msg)
@@ -203,49 +350,438 @@ def extract_relations(
             "text": text,
             "prompt": PROMPT,
             "response": response,
+            "stats": stats.to_dict(),
         }
 
 
 def classify_article(
-    text: str, model="mistral-openorca:latest", use_system=False, options={}
+    text: str, model="mistral-openorca:latest", use_system=False, options={}, structured_output=False, confidence=False
 ):
+    """Classify an article.
+
+    With confidence, the model also reports its confidence in the category (1 to 5), which is in
+    the confidence field of the result (None if the model didn't give a valid one).
+    """
     if model == None:
         model = "mistral-openorca:latest"
 
-    if use_system:
-        response, _ = client.generate(
-            model_name=model,
-            system=make_classification_prompt(None),
-            prompt=text,
-            options=options,
+    kwargs = generation_kwargs("classification", options, structured_output)
+    if confidence and structured_output:
+        kwargs["format"] = CLASSIFICATION_CONFIDENCE_SCHEMA
+    make_prompt = functools.partial(make_classification_prompt, confidence=confidence)
+    system, prompt = make_task_request(make_prompt, text, "classification", use_system, structured_output)
+    try:
+        response, _, stats = client.generate(
+            model_name=model, system=system, prompt=prompt, stop_on_json=True, **kwargs
         )
-    else:
-        prompt = make_classification_prompt(text)
-        response, _ = client.generate(model_name=model, prompt=prompt, options=options)
+    except OllamaError as e:
+        logger.warning(f"ERROR ### The request failed: {e}")
+        return {
+            "response": None,
+            "category": "Unknown",
+            "text": text,
+            "prompt": prompt,
+            "error": True,
+            "error_message": str(e),
+        }
 
     logger.debug(f"{input}\n")
 
     try:
-        data = extract_json(str(response))
         # We assume that the data is a dictionary.
-        if data is None or type(data) != dict:
-            raise Exception("The response is not a JSON object.")
-        else:
-            return {
-                "category": data.get("category", ""),
-                "text": text,
-                "reason": data.get("reason", ""),
-                "response": response,
-                "prompt": prompt,
-            }
+        data = parse_output(response, "classification", structured_output)
+        return {
+            "category": data.get("category", ""),
+            "text": text,
+            "reason": data.get("reason", ""),
+            "response": response,
+            "stats": stats.to_dict(),
+            "prompt": prompt,
+            **({"confidence": parse_confidence(data.get("confidence"))} if confidence else {}),
+        }
     except Exception as e:
         msg = f"\n\nERROR ### Here is the buggy response: {response}"
         logger.info(msg)
 
         return {
             "response": msg,
+            "stats": stats.to_dict(),
             "category": "Unknown",
             "text": text,
             "prompt": prompt,
             "error": True,
         }
+
+
+def align_knowledge(data: dict) -> Tuple[list, list]:
+    """Resolve the entity ids of the relations of a joint extraction.
+
+    The relations get the source_name, source_type, target_name and target_type fields of
+    extract_relations, so both outputs can be loaded the same way. The relations which reference
+    a missing entity are dropped.
+
+    Returns:
+        Tuple[list, list]: The entities and the aligned relations.
+    """
+    entities = [entity for entity in data.get("entities") or [] if isinstance(entity, dict)]
+    by_id = {str(entity.get("id")): entity for entity in entities if entity.get("id") is not None}
+
+    relations = []
+    for relation in data.get("relations") or []:
+        if not isinstance(relation, dict):
+            continue
+
+        source = by_id.get(str(relation.get("source")))
+        target = by_id.get(str(relation.get("target")))
+        if source is None or target is None:
+            logger.debug(f"Drop the relation with an unknown entity id: {relation}")
+            continue
+
+        relations.append(
+            {
+                "source_id": relation["source"],
+                "source_name": source.get("concept", ""),
+                "source_type": source.get("category", ""),
+                "target_id": relation["target"],
+                "target_name": target.get("concept", ""),
+                "target_type": target.get("category", ""),
+                "relation_type": relation.get("relation_type", ""),
+                "key_sentence": relation.get("key_sentence", ""),
+            }
+        )
+
+    return entities, relations
+
+
+def extract_knowledge(
+    text: str,
+    metadata={},
+    model="mistral-openorca:latest",
+    use_system=False,
+    options={},
+    embeddings: pd.DataFrame | None = None,
+    embedding_model_name: str = "mistralai/Mistral-7B-v0.1",
+    index=None,
+    structured_output=False,
+):
+    """Extract the entities and the relations of a text in a single request.
+
+    It replaces extract_entities and extract_relations (and the review) when the prompt tokens are
+    the main cost, the text is encoded once instead of two or three times.
+    """
+    if model == None:
+        model = "mistral-openorca:latest"
+
+    kwargs = generation_kwargs("knowledge", options, structured_output)
+    system, prompt = make_task_request(make_knowledge_extraction_prompt, text, "knowledge", use_system, structured_output)
+    try:
+        response, _, stats = client.generate(
+            model_name=model, system=system, prompt=prompt, stop_on_json=True, **kwargs
+        )
+    except OllamaError as e:
+        logger.warning(f"ERROR ### The request failed: {e}")
+        return {
+            "response": None,
+            "metadata": metadata,
+            "entities": [],
+            "relations": [],
+            "text": text,
+            "prompt": prompt,
+            "error": True,
+            "error_message": str(e),
+        }
+
+    try:
+        entities, relations = align_knowledge(parse_output(response, "knowledge", structured_output))
+        return {
+            "entities": (
+                get_mapped_entities(entities, embeddings, embedding_model_name, index=index)  # type: ignore
+                if embeddings is not None
+                else entities
+            ),
+            "relations": relations,
+            "metadata": metadata,
+            "response": response,
+            "stats": stats.to_dict(),
+            "text": text,
+            "prompt": prompt,
+        }
+    except:
+        msg = f"ERROR ### Here is the buggy response: {response}"
+        logger.info(msg)
+        return {
+            "response": msg,
+            "stats": stats.to_dict(),
+            "metadata": metadata,
+            "entities": [],
+            "relations": [],
+            "text": text,
+            "prompt": prompt,
+            "error": True,
+        }
+
+
+def _entity_key(entity: dict) -> tuple:
+    return str(entity.get("concept", "")).strip().lower(), entity.get("category", "")
+
+
+def merge_entities(entity_lists: List[list]) -> list:
+    """Merge the entities of several windows, the same concept and category is kept once with its highest score."""
+    merged = {}
+    for entities in entity_lists:
+        for entity in entities:
+            key = _entity_key(entity)
+            if key not in merged or (entity.get("score") or 0) > (merged[key].get("score") or 0):
+                merged[key] = entity
+
+    return list(merged.values())
+
+
+def merge_relations(relation_lists: List[list]) -> list:
+    """Merge the relations of several windows, the same source, target and relation type is kept once."""
+    merged = {}
+    for relations in relation_lists:
+        for relation in relations:
+            key = (
+                str(relation.get("source_name", "")).strip().lower(),
+                str(relation.get("target_name", "")).strip().lower(),
+                relation.get("relation_type", ""),
+            )
+            merged.setdefault(key, relation)
+
+    return list(merged.values())
+
+
+def merge_window_results(results: List[dict], text: str, metadata={}) -> dict:
+    """Merge the results of the windows of a text (see chunking.chunk_text) into the result of the whole text.
+
+    The ids of the joint extraction (see extract_knowledge) are local to a window, so the merged entities are
+    numbered again and the relations point to the new ids.
+    """
+    merged = {"metadata": metadata, "text": text}
+    if any("entities" in result for result in results):
+        merged["entities"] = merge_entities([result.get("entities") or [] for result in results])
+    if any("relations" in result for result in results):
+        merged["relations"] = merge_relations([result.get("relations") or [] for result in results])
+
+    if any("id" in entity for entity in merged.get("entities", [])):
+        ids = {}
+        for i, entity in enumerate(merged["entities"]):
+            entity["id"] = f"e{i + 1}"
+            ids[_entity_key(entity)] = entity["id"]
+        for relation in merged.get("relations", []):
+            relation["source_id"] = ids.get((relation["source_name"].strip().lower(), relation["source_type"]))
+            relation["target_id"] = ids.get((relation["target_name"].strip().lower(), relation["target_type"]))
+
+    # The responses and the stats of each window, the text and the prompt are in the windows already.
+    merged["windows"] = [
+        {k: v for k, v in result.items() if k not in ("entities", "relations", "metadata", "prompt")}
+        for result in results
+    ]
+    if all(result.get("error") for result in results):
+        merged["error"] = True
+
+    return merged
+
+
+async def aextract_from_windows(aclient: AsyncOllamaClient, func, windows: List[str], **kwargs) -> List[dict]:
+    """Run an extraction function (such as extract_entities) on each window, in the worker pool of the client.
+
+    Returns:
+        List[dict]: The results, in the order of the windows.
+    """
+    return list(await asyncio.gather(*[aclient.run(func, window, **kwargs) for window in windows]))
+
+
+def extract_from_windows(func, windows: List[str], concurrency: int = 4, **kwargs) -> List[dict]:
+    """Run an extraction function (such as extract_entities) on each window, for the synchronous callers.
+
+    The windows are sent one by one with a concurrency of 1, such as from the workers of a corpus run,
+    otherwise through a temporary async client. The callers which run an event loop use
+    aextract_from_windows with their own client instead.
+
+    Returns:
+        List[dict]: The results, in the order of the windows.
+
+    Raises:
+        RuntimeError: If it is called with a concurrency above 1 from a running event loop.
+    """
+    if concurrency <= 1 or len(windows) <= 1:
+        return [func(window, **kwargs) for window in windows]
+
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    else:
+        raise RuntimeError("extract_from_windows can't run in an event loop, await aextract_from_windows instead.")
+
+    async def run():
+        aclient = AsyncOllamaClient(concurrency=concurrency)
+        try:
+            return await aextract_from_windows(aclient, func, windows, **kwargs)
+        finally:
+            aclient.close()
+
+    return asyncio.run(run())
+
+
+def _finish_windows(results: List[dict], text: str, metadata, mapping: dict) -> dict:
+    merged = merge_window_results(results, text, metadata)
+    if mapping and merged.get("entities"):
+        merged["entities"] = get_mapped_entities(  # type: ignore
+            merged["entities"], mapping["embeddings"], mapping["embedding_model_name"], index=mapping["index"]
+        )
+
+    return merged
+
+
+def extract_in_windows(
+    func,
+    text: str,
+    windows: List[str],
+    concurrency: int = 4,
+    metadata={},
+    embeddings: pd.DataFrame | None = None,
+    embedding_model_name: str = "mistralai/Mistral-7B-v0.1",
+    index=None,
+    **kwargs,
+) -> dict:
+    """Extract from a text which is split into windows, and merge the results of the windows.
+
+    A single window is a plain call of func. With several windows, the entities are mapped to the
+    ontology embeddings once after the merge, instead of once per window.
+
+    Args:
+        func: extract_entities, extract_relations or extract_knowledge.
+        windows (List[str]): The windows of the text, see chunking.chunk_text.
+        concurrency (int): Number of windows in flight, see extract_from_windows.
+        kwargs: Passed to func, such as the model and the options.
+    """
+    mapping = {"embeddings": embeddings, "embedding_model_name": embedding_model_name, "index": index} if embeddings is not None else {}
+    if len(windows) <= 1:
+        return func(text, metadata=metadata, **mapping, **kwargs)
+
+    results = extract_from_windows(func, windows, concurrency, metadata=metadata, **kwargs)
+    return _finish_windows(results, text, metadata, mapping)
+
+
+async def aextract_in_windows(
+    aclient: AsyncOllamaClient,
+    func,
+    text: str,
+    windows: List[str],
+    metadata={},
+    embeddings: pd.DataFrame | None = None,
+    embedding_model_name: str = "mistralai/Mistral-7B-v0.1",
+    index=None,
+    **kwargs,
+) -> dict:
+    """The async variant of extract_in_windows, the windows share the worker pool of the client."""
+    mapping = {"embeddings": embeddings, "embedding_model_name": embedding_model_name, "index": index} if embeddings is not None else {}
+    if len(windows) <= 1:
+        return await aclient.run(func, text, metadata=metadata, **mapping, **kwargs)
+
+    results = await aextract_from_windows(aclient, func, windows, metadata=metadata, **kwargs)
+    # The mapping embeds the entity names, it runs in the worker pool too.
+    return await aclient.run(_finish_windows, results, text, metadata, mapping)
+
+
+def parse_confidence(value) -> int | None:
+    """The self-reported confidence of a classification, None if it isn't an integer from 1 to 5."""
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return None
+
+    return value if 1 <= value <= 5 else None
+
+
+def escalation_reason(result: dict, min_confidence: int = 4, escalate_unknown: bool = True) -> str | None:
+    """Why a classification should be sent to a larger model, None if it is accepted.
+
+    A missing confidence doesn't escalate, the models which don't follow the confidence
+    instruction are only checked for the parse failures and the Unknown category.
+    """
+    if result.get("error"):
+        return "parse failure" if result.get("response") is not None else "request failure"
+    if escalate_unknown and result.get("category") == "Unknown":
+        return "unknown category"
+    if result.get("category") not in ARTICLE_CATEGORIES:
+        return "invalid category"
+    if result.get("confidence") is not None and result["confidence"] < min_confidence:
+        return "low confidence"
+
+    return None
+
+
+def classify_article_cascade(
+    text: str,
+    models: List[str],
+    use_system=False,
+    options={},
+    structured_output=False,
+    min_confidence: int = 4,
+    escalate_unknown: bool = True,
+):
+    """Classify an article with a cascade of models, from the smallest to the largest.
+
+    A model answers first, and the article is sent to the next model only if the answer is
+    doubtful (see escalation_reason). The answer of the last model is final. Ollama doesn't return
+    the token log probabilities, so the doubt is measured with the self-reported confidence.
+
+    Args:
+        models (List[str]): The models, the cheapest first.
+        min_confidence (int): The lowest confidence (1 to 5) which is accepted without escalation.
+        escalate_unknown (bool): Escalate the Unknown category.
+
+    Returns:
+        dict: The result of the model which answered, with the model field, the escalated field and
+        the cascade field, which holds the model, category, confidence and escalation reason of each step.
+    """
+    cascade = []
+    for i, model in enumerate(models):
+        result = classify_article(
+            text, model=model, use_system=use_system, options=options, structured_output=structured_output, confidence=True
+        )
+        reason = escalation_reason(result, min_confidence, escalate_unknown) if i < len(models) - 1 else None
+        cascade.append(
+            {
+                "model": model,
+                "category": result.get("category"),
+                "confidence": result.get("confidence"),
+                "escalation_reason": reason,
+            }
+        )
+        if reason is None:
+            break
+
+        logger.info(f"Escalate the classification from {model} to {models[i + 1]}: {reason}")
+
+    return {**result, "model": model, "escalated": len(cascade) > 1, "cascade": cascade}
+
+
+# Async variants for the batch commands. Each call runs the synchronous function in the worker
+# pool of the async client, so at most `aclient.concurrency` requests are in flight.
+async def acorrect_extracted_entities(aclient: AsyncOllamaClient, text: str, **kwargs):
+    return await aclient.run(correct_extracted_entities, text, **kwargs)
+
+
+async def aextract_entities(aclient: AsyncOllamaClient, text: str, **kwargs):
+    return await aclient.run(extract_entities, text, **kwargs)
+
+
+async def aextract_relations(aclient: AsyncOllamaClient, text: str, **kwargs):
+    return await aclient.run(extract_relations, text, **kwargs)
+
+
+async def aextract_knowledge(aclient: AsyncOllamaClient, text: str, **kwargs):
+    return await aclient.run(extract_knowledge, text, **kwargs)
+
+
+async def aclassify_article(aclient: AsyncOllamaClient, text: str, **kwargs):
+    return await aclient.run(classify_article, text, **kwargs)
+
+
+async def aclassify_article_cascade(aclient: AsyncOllamaClient, text: str, **kwargs):
+    return await aclient.run(classify_article_cascade, text, **kwargs)
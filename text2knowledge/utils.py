@@ -5,14 +5,22 @@ from transformers import PreTrainedModel
 import transformers_embedder as tre
 from pathlib import Path
 import pandas as pd
+import numpy as np
 import torch
 import os
+import heapq
+import warnings
 import logging
 import torch.nn.functional as F
-import pickle
 from typing import List, Dict, Any, Tuple, Optional, Union
 from dataclasses import dataclass
 import cohere
+from text2knowledge.embedding_store import EmbeddingStore
+from text2knowledge.ann import open_index
+from text2knowledge.model_registry import ModelKey, ModelRegistry, estimate_model_memory, get_registry
+from text2knowledge.cache import EmbeddingCache, get_embedding_cache
+from text2knowledge.inference import InferenceProfile
+from text2knowledge.dedup import is_duplicate
 
 
 def init_logger(name: str) -> logging.Logger:
@@ -29,39 +37,102 @@ def init_logger(name: str) -> logging.Logger:
 
 logger = init_logger(__name__)
 
+
+def default_device() -> torch.device:
+    return torch.device("mps" if torch.backends.mps.is_available() else "cpu")
+
+
 class EmbeddingGenerator:
     """Embedding generator."""
 
-    def __init__(self, model_name: str, word_mode: bool = False):
+    def __init__(
+        self,
+        model_name: str,
+        word_mode: bool = False,
+        device: Optional[Union[str, torch.device]] = None,
+        dtype: Optional[torch.dtype] = None,
+        registry: Optional[ModelRegistry] = None,
+        cache: Optional[Union[EmbeddingCache, bool]] = None,
+        profile: Optional[Union[InferenceProfile, str]] = None,
+    ):
         """Initialize the embedding generator.
 
+        The tokenizer and the model are shared by all generators in the process through the
+        model registry, so creating a generator for a loaded model is cheap.
+
         Args:
             model_name (str): Model name.
+            word_mode (bool): Use the transformers-embedder word embeddings.
+            device (str | torch.device): Device, defaults to mps if it is available, otherwise cpu. The word mode always runs on cpu.
+            dtype (torch.dtype): Model weights dtype, defaults to torch.float32.
+            registry (ModelRegistry): Model registry, defaults to the process-wide registry.
+            cache (EmbeddingCache | bool): Embedding cache, defaults to the process-wide cache. False disables the cache.
+            profile (InferenceProfile | str): Inference profile or its name (default, cpu, cpu-int8 or onnx), see InferenceProfile.from_name.
         """
         self.model_name = model_name
         self.word_mode = word_mode
+        self.device = torch.device("cpu") if word_mode else torch.device(device or default_device())
+        self.dtype = dtype or torch.float32
+        if not isinstance(profile, InferenceProfile):
+            profile = InferenceProfile.from_name(profile)
+        self.profile = profile.for_device(self.device)
+        if self.word_mode and self.profile.backend == "onnx":
+            raise ValueError("The word mode doesn't support the onnx backend.")
+        self.profile.apply_threads()
+
+        registry = registry or get_registry()
+        key = ModelKey(model_name, word_mode, str(self.device), str(self.dtype), self.profile.key)
+        self.tokenizer, self.model = registry.get(key, self._load, self._estimate_memory)
+
+        if cache is None or cache is True:
+            self.cache = get_embedding_cache()
+        else:
+            self.cache = cache or None
+
+    @property
+    def pooling_key(self) -> str:
+        """Everything besides the model name and the text which changes the embedding, used as part of the cache key."""
+        pooling = "word" if self.word_mode else "mean"
+        return "%s:%s:%s" % (pooling, str(self.dtype).replace("torch.", ""), self.profile.key)
+
+    def _estimate_memory(self) -> int:
+        if self.word_mode or self.profile.backend == "onnx":
+            return 0
+
+        return estimate_model_memory(self.model_name, self.dtype)
+
+    def _load(self) -> Tuple[Any, Any]:
         if self.word_mode:
-            self.tokenizer, self.model = self.load_tokenizer_and_model(model_name)
+            tokenizer, model = self.load_tokenizer_and_model(self.model_name)
+        elif self.profile.backend == "onnx":
+            model = self.profile.load_onnx_model(self.model_name)
+            tokenizer = self.load_tokenizer(self.model_name, use_fast=True)
         else:
-            self.model = self.load_model(model_name)
-            self.tokenizer = self.load_tokenizer(model_name, use_fast=True)
+            model = self.load_model(self.model_name, device=self.device, dtype=self.dtype)
+            tokenizer = self.load_tokenizer(self.model_name, use_fast=True)
+
+        return tokenizer, self.profile.optimize(model)
 
     @staticmethod
-    def load_model(model_name: Union[str, Path]) -> PreTrainedModel:
+    def load_model(
+        model_name: Union[str, Path],
+        device: Optional[Union[str, torch.device]] = None,
+        dtype: Optional[torch.dtype] = None,
+    ) -> PreTrainedModel:
         """Load model from HuggingFace.
 
         Args:
             model_name (str | Path): Model name or path.
+            device (str | torch.device): Device, defaults to mps if it is available, otherwise cpu.
+            dtype (torch.dtype): Model weights dtype, defaults to torch.float32.
 
         Returns:
             AutoModel: Model.
         """
-        print(
-            "Loading model into the %s..."
-            % ("mps" if torch.backends.mps.is_available() else "cpu")
-        )
-        device = torch.device("mps" if torch.backends.mps.is_available() else "cpu")
-        model = AutoModel.from_pretrained(model_name).to(device)
+        device = torch.device(device or default_device())
+        print("Loading model into the %s..." % device)
+        model = AutoModel.from_pretrained(model_name, torch_dtype=dtype or torch.float32).to(device)
+        model.eval()
 
         return model
 
@@ -78,6 +149,10 @@ class EmbeddingGenerator:
             AutoTokenizer: Tokenizer.
         """
         tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=use_fast)
+        # Decoder-only models (e.g. Mistral, Llama) don't have a pad token, but we need
+        # one for batching. The padded positions are masked out when pooling.
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
 
         return tokenizer  # type: ignore
 
@@ -118,23 +193,89 @@ class EmbeddingGenerator:
             ValueError: If model or tokenizer is None.
         """
         logger.info("Generate embedding for text: %s" % text)
+        return self.gen_text_embeddings([text], batch_size=1)[0]
+
+    def gen_text_embeddings(self, texts: List[str], batch_size: int = 32, use_cache: bool = True) -> torch.Tensor:
+        """Convert a list of texts to embeddings, one forward pass per batch.
+
+        The texts which are in the embedding cache skip the model, and the new embeddings
+        are added to the cache.
+
+        Args:
+            texts (List[str]): Texts.
+            batch_size (int): Number of texts per forward pass.
+            use_cache (bool): Use the embedding cache, False for the texts whose embeddings are persisted elsewhere (such as in an EmbeddingStore).
+
+        Returns:
+            torch.Tensor: Embeddings with shape (len(texts), hidden_size).
+
+        Raises:
+            ValueError: If model or tokenizer is None.
+        """
+        texts = list(texts)
+        if self.cache is None or not use_cache or not texts:
+            return self._gen_text_embeddings(texts, batch_size)
+
+        cached = self.cache.get_many(self.model_name, self.pooling_key, texts)
+        # Compute each missing text only once, even if it appears several times.
+        missing = list(dict.fromkeys(text for text, e in zip(texts, cached) if e is None))
+        logger.debug("%s of %s embeddings are cached." % (len(texts) - len(missing), len(texts)))
+        if missing:
+            computed = self._gen_text_embeddings(missing, batch_size).float().numpy()
+            self.cache.set_many(self.model_name, self.pooling_key, missing, computed)
+            computed_map = dict(zip(missing, computed))
+            cached = [computed_map[text] if e is None else e for text, e in zip(texts, cached)]
+
+        return torch.from_numpy(np.stack(cached).astype(np.float32))
+
+    def _gen_text_embeddings(self, texts: List[str], batch_size: int) -> torch.Tensor:
         if not self.tokenizer or not self.model:
             raise ValueError("Failed to load model or tokenizer.")
 
-        if self.word_mode:
-            inputs = self.tokenizer(text, return_tensors="pt")
-            outputs = self.model(**inputs)
-            # Remove [CLS] and [SEP]
-            return outputs.word_embeddings[0, 1, :]
-        else:
-            # print("Device: ", self.model.device)
-            inputs = self.tokenizer(text, return_tensors="pt").to(self.model.device)
-            # print(text, inputs)
-            with torch.no_grad():
-                outputs = self.model(**inputs)
-                embeddings = outputs.last_hidden_state.mean(dim=1)
-                # print(embeddings.shape)
-                return embeddings[0]
+        batches: List[torch.Tensor] = []
+        for start in range(0, len(texts), batch_size):
+            batch = list(texts[start : start + batch_size])
+            logger.debug("Generate embeddings for texts %s-%s" % (start, start + len(batch)))
+
+            if self.word_mode:
+                inputs = self.tokenizer(batch, padding=True, return_tensors="pt")
+                with self.profile.forward_context():
+                    outputs = self.model(**inputs)
+                # Remove [CLS] and [SEP]
+                batches.append(outputs.word_embeddings[:, 1, :].float().cpu())
+            else:
+                inputs = self.tokenizer(
+                    batch, padding=True, truncation=True, return_tensors="pt"
+                ).to(self.model.device)
+                with self.profile.forward_context():
+                    outputs = self.model(**inputs)
+                    embeddings = self.mean_pooling(
+                        outputs.last_hidden_state.float(), inputs["attention_mask"]
+                    )
+                batches.append(embeddings.cpu())
+
+        if not batches:
+            return torch.empty(0)
+
+        return torch.cat(batches, dim=0)
+
+    @staticmethod
+    def mean_pooling(
+        last_hidden_state: torch.Tensor, attention_mask: torch.Tensor
+    ) -> torch.Tensor:
+        """Average the token embeddings, ignoring the padded positions.
+
+        Args:
+            last_hidden_state (torch.Tensor): Token embeddings, (batch, seq_len, hidden_size).
+            attention_mask (torch.Tensor): Attention mask, (batch, seq_len).
+
+        Returns:
+            torch.Tensor: Sentence embeddings, (batch, hidden_size).
+        """
+        mask = attention_mask.unsqueeze(-1).to(last_hidden_state.dtype)
+        summed = (last_hidden_state * mask).sum(dim=1)
+        counts = mask.sum(dim=1).clamp(min=1e-9)
+        return summed / counts
 
     @staticmethod
     def similarity(query_embedding: torch.Tensor, embeddings: List[torch.Tensor]):
@@ -207,53 +348,187 @@ class Embedding:
     metadata: Metadata
 
 
+class SimilarityIndex:
+    """Pre-normalized embedding matrix for repeated cosine similarity queries.
+
+    The matrix is stacked and normalized once, so a query costs one matrix-vector
+    product and a top-k selection.
+    """
+
+    def __init__(self, matrix: torch.Tensor, ids: List[str], metadata: List[Metadata]):
+        """Initialize the similarity index.
+
+        Args:
+            matrix (torch.Tensor): Embeddings with shape (num_items, hidden_size).
+            ids (List[str]): Ids of the embeddings, in row order.
+            metadata (List[Metadata]): Metadata of the embeddings, in row order.
+        """
+        if len(ids) != len(matrix) or len(metadata) != len(matrix):
+            raise ValueError(
+                "Expected %s ids and metadata, got %s and %s."
+                % (len(matrix), len(ids), len(metadata))
+            )
+
+        self.matrix = F.normalize(matrix.float(), p=2, dim=1).contiguous()
+        self.ids = ids
+        self.metadata = metadata
+
+    @classmethod
+    def from_embeddings(cls, embeddings_dict: Dict[str, Embedding]) -> "SimilarityIndex":
+        """Build the index from the embeddings which are generated by gen_embeddings4ontology."""
+        items = list(embeddings_dict.values())
+        matrix = torch.stack([item.embedding for item in items]) if items else torch.empty(0, 0)
+        return cls(matrix, list(embeddings_dict.keys()), [item.metadata for item in items])
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def scores(self, query_embedding: torch.Tensor) -> torch.Tensor:
+        """Cosine similarities between the query and all items, in row order."""
+        query = F.normalize(query_embedding.float().reshape(-1), p=2, dim=0)
+        return self.matrix @ query.to(self.matrix.device)
+
+    def to_score(self, query: str, idx: int, score: float) -> Score:
+        metadata = self.metadata[idx]
+        return Score(
+            score=score,
+            category=metadata.label,
+            name=metadata.name,
+            target_text=metadata.text if metadata.text else metadata.name,
+            query=query,
+        )
+
+    def search(
+        self,
+        query: str,
+        query_embedding: torch.Tensor,
+        k: int = 3,
+        min_score: float = 0.5,
+    ) -> List[Score]:
+        """Get the top k items which are more similar than min_score.
+
+        Args:
+            query (str): Query text.
+            query_embedding (torch.Tensor): Query embedding.
+            k (int): Number of top items.
+            min_score (float): Minimum similarity score.
+
+        Returns:
+            List[Score]: Top k items, sorted by score in descending order.
+        """
+        k = min(k, len(self))
+        if k <= 0:
+            return []
+
+        top_scores, top_indexes = torch.topk(self.scores(query_embedding), k)
+        keep = top_scores > min_score
+        return [
+            self.to_score(query, idx, score)
+            for idx, score in zip(top_indexes[keep].tolist(), top_scores[keep].tolist())
+        ]
+
+    def search_batch(
+        self,
+        queries: List[str],
+        query_embeddings: torch.Tensor,
+        k: int = 3,
+        min_score: float = 0.5,
+        block_size: int = 65536,
+        query_block_size: int = 1024,
+    ) -> List[List[Score]]:
+        """Get the top k items of many queries with matrix-matrix products.
+
+        The items are scanned in blocks, and the running top k of each query is merged
+        with the top k of each block, so the memory is bounded by
+        query_block_size * block_size scores no matter how large both sides are.
+
+        Args:
+            queries (List[str]): Query texts.
+            query_embeddings (torch.Tensor): Query embeddings with shape (len(queries), hidden_size).
+            k (int): Number of top items.
+            min_score (float): Minimum similarity score.
+            block_size (int): Number of items scored at a time.
+            query_block_size (int): Number of queries scored at a time.
+
+        Returns:
+            List[List[Score]]: Top k items of each query, sorted by score in descending order.
+        """
+        k = min(k, len(self))
+        if k <= 0:
+            return [[] for _ in queries]
+
+        all_queries = F.normalize(query_embeddings.float(), p=2, dim=1).to(self.matrix.device)
+        results: List[List[Score]] = []
+        for q_start in range(0, len(queries), query_block_size):
+            q = all_queries[q_start : q_start + query_block_size]
+            top_scores = torch.full((len(q), k), float("-inf"), device=q.device)
+            top_indexes = torch.full((len(q), k), -1, dtype=torch.long, device=q.device)
+
+            for start in range(0, len(self), block_size):
+                block_scores = q @ self.matrix[start : start + block_size].t()
+                block_top_scores, block_top_indexes = torch.topk(
+                    block_scores, min(k, block_scores.shape[1]), dim=1
+                )
+                merged_scores = torch.cat([top_scores, block_top_scores], dim=1)
+                merged_indexes = torch.cat([top_indexes, block_top_indexes + start], dim=1)
+                top_scores, positions = torch.topk(merged_scores, k, dim=1)
+                top_indexes = torch.gather(merged_indexes, 1, positions)
+
+            keep = top_scores > min_score
+            for i, query in enumerate(queries[q_start : q_start + query_block_size]):
+                results.append(
+                    [
+                        self.to_score(query, idx, score)
+                        for idx, score in zip(
+                            top_indexes[i][keep[i]].tolist(), top_scores[i][keep[i]].tolist()
+                        )
+                    ]
+                )
+
+        return results
+
+
 def batch_similarity(
     query_embedding: Tuple[str, torch.Tensor],
-    embeddings_dict: Dict[str, Embedding],
-    use_vectorized: bool = False,
+    embeddings_dict: Union[Dict[str, Embedding], SimilarityIndex],
+    use_vectorized: bool | None = None,
+    k: int | None = None,
+    min_score: float = float("-inf"),
 ) -> List[Score]:
-    """Batch similarity between query and passage embeddings.
+    """Similarities between query and passage embeddings.
 
     Args:
         query_embedding (str): Query item.
-        embeddings_dict (Dict[str, Dict[str, Any]]): Passage embeddings.
-        use_vectorized (bool): Use vectorized operations.
+        embeddings_dict (Dict[str, Dict[str, Any]] | SimilarityIndex): Passage embeddings, pass a SimilarityIndex to avoid rebuilding it for each query.
+        use_vectorized (bool): Deprecated, the scores are always computed with one matrix-vector product.
+        k (int): Number of top items, all the passages by default. With k, only the top k items become Score objects.
+        min_score (float): Minimum similarity score, no minimum by default.
 
     Returns:
-        List[Score]: Similarity scores.
+        List[Score]: The similarity scores of all the passages in their order, or the top k scores sorted by score in descending order.
     """
-    all_results: List[Score] = []
-    embeddings = [m.embedding for m in embeddings_dict.values()]
-    metadata = pd.DataFrame([m.metadata for m in embeddings_dict.values()])
-
-    print("Query: ", query_embedding[0], query_embedding[1])
-
-    if use_vectorized:
-        results = EmbeddingGenerator.vectorized_similarity(
-            query_embedding[1], embeddings
-        )
-    else:
-        results = EmbeddingGenerator.similarity(query_embedding[1], embeddings)
-
-    for embedding in embeddings_dict.values():
-        print("Embedding: ", embedding.metadata.name, embedding.embedding)
-
-    for i, result in enumerate(results):
-        label = metadata.iloc[i]["label"]
-        name = metadata.iloc[i]["name"]
-        text = metadata.iloc[i]["text"]
-        r = Score(
-            score=result,
-            category=label,
-            name=name,
-            target_text=text if text else name,
-            query=query_embedding[0],
+    if use_vectorized is not None:
+        warnings.warn(
+            "use_vectorized is deprecated and ignored, the scores are always vectorized.",
+            DeprecationWarning,
+            stacklevel=2,
         )
-        all_results.append(r)
 
-        # print("Batch similarity done. %s, %s" % (query_item, r))
+    index = (
+        embeddings_dict
+        if isinstance(embeddings_dict, SimilarityIndex)
+        else SimilarityIndex.from_embeddings(embeddings_dict)
+    )
+
+    if k is not None:
+        return index.search(query_embedding[0], query_embedding[1], k=k, min_score=min_score)
 
-    return all_results
+    scores = index.scores(query_embedding[1]).tolist()
+    return [
+        index.to_score(query_embedding[0], idx, score)
+        for idx, score in enumerate(scores)
+        if score > min_score
+    ]
 
 
 def get_topk_items(
@@ -269,9 +544,9 @@ def get_topk_items(
     Returns:
         List[Score]: Top k items.
     """
-    results.sort(key=lambda x: x.score, reverse=True)
-    results = [r for r in results if r.score > min_score]
-    return results[:k]
+    return heapq.nlargest(
+        k, (r for r in results if r.score > min_score), key=lambda x: x.score
+    )
 
 
 def read_ontology(filepath, sep="\t") -> pd.DataFrame:
@@ -291,24 +566,25 @@ def read_ontology(filepath, sep="\t") -> pd.DataFrame:
 def gen_embeddings4ontology(
     ontology: pd.DataFrame,
     model_name: str,
+    batch_size: int = 32,
 ) -> Dict[str, Embedding]:
     """Generate embeddings for ontology.
 
     Args:
         ontology (pd.DataFrame): Ontology.
         model_name (str): Model name.
-        tokenizer (Optional[tre.Tokenizer]): Tokenizer.
-        model (Optional[tre.TransformersEmbedder]): Model.
+        batch_size (int): Number of names per forward pass.
 
     Returns:
         Dict[str, Dict[str, Any]]: Embeddings.
     """
     embeddings: Dict[str, Embedding] = {}
     embedding_generator = EmbeddingGenerator(model_name, word_mode=True)
-    for item in ontology.iterrows():
-        name = item[1]["name"]
-        embedding = embedding_generator.gen_text_embedding(name)
-        metadata = item[1].to_dict()
+    names = ontology["name"].tolist()
+    name_embeddings = embedding_generator.gen_text_embeddings(names, batch_size=batch_size)
+    for (_, row), embedding in zip(ontology.iterrows(), name_embeddings):
+        name = row["name"]
+        metadata = row.to_dict()
         metadata.update({"model_name": model_name})
         metadata = Metadata(**metadata)
         embeddings[name] = Embedding(embedding=embedding, metadata=metadata)
@@ -319,17 +595,19 @@ def gen_embeddings4ontology(
 def gen_embeddings4pubtext(
     pubtext: pd.DataFrame,
     embedding_generator: EmbeddingGenerator,
-    save_file: str | None = None,
-) -> Dict[str, Embedding]:
+    store_dir: str,
+    batch_size: int = 32,
+) -> EmbeddingStore:
     """Generate embeddings for pubtext.
 
     Args:
         pubtext (pd.DataFrame): Pubtext.
         embedding_generator (EmbeddingGenerator): Embedding generator.
-        save_file (str): Save file.
+        store_dir (str): Directory of the embedding store, only the text chunks which are not in the store are embedded.
+        batch_size (int): Number of text chunks per forward pass, the embeddings are appended to the store after each batch.
 
     Returns:
-        Dict[str, Metadata]: Embeddings.
+        EmbeddingStore: Embeddings.
     """
     expected_columns = ["label", "name", "text"]
     # name is an id, like <pubmed_id>:<title>
@@ -340,43 +618,41 @@ def gen_embeddings4pubtext(
             "Pubtext columns are not valid, expected columns: %s" % expected_columns
         )
 
-    embeddings_dict: Dict[str, Dict[str, Embedding]] = {}
-    if save_file and os.path.exists(save_file):
-        with open(save_file, "rb") as handle:
-            embeddings_dict = pickle.load(handle)
-
-    embeddings = embeddings_dict[embedding_generator.model_name] if embeddings_dict else {}
+    store = EmbeddingStore(store_dir, embedding_generator.model_name)
 
+    rows = []
     for idx, (_, row) in enumerate(pubtext.iterrows()):
-        id = row["name"]
-        text = row["text"]
-
-        if id in embeddings:
-            print("%s. Embedding for %s already exists." % (idx, id))
+        if is_duplicate(row):
+            # The near-duplicates which are tagged by `extract.py text-chunks --dedup` share the embedding of their canonical chunk.
             continue
 
-        print("%s. Generate embedding for %s..." % (idx, id))
-        embedding = embedding_generator.gen_text_embedding(text)
-        metadata = row.to_dict()
-        metadata.update({"model_name": embedding_generator.model_name})
-        metadata = Metadata(**metadata)
-        embeddings[id] = Embedding(embedding=embedding, metadata=metadata)
+        if row["name"] in store:
+            print("%s. Embedding for %s already exists." % (idx, row["name"]))
+            continue
 
-        # 每10个数据项保存一次，但跳过第0个数据项
-        if save_file and idx % 10 == 0 and idx != 0:
-            embeddings_dict[embedding_generator.model_name] = embeddings
-            save(embeddings_dict, save_file)
+        rows.append(row)
 
-    if save_file:
-        embeddings_dict[embedding_generator.model_name] = embeddings
-        save(embeddings_dict, save_file)
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start : start + batch_size]
+        print(
+            "Generate embeddings for %s-%s of %s text chunks..."
+            % (start, start + len(batch), len(rows))
+        )
+        # The store keeps the embeddings, a copy in the embedding cache would double the disk usage.
+        batch_embeddings = embedding_generator.gen_text_embeddings(
+            [row["text"] for row in batch], batch_size=batch_size, use_cache=False
+        )
 
-    return embeddings
+        metadata = []
+        for row in batch:
+            # The text is kept in the text chunks file, the store only keeps the small fields.
+            m = {k: v for k, v in row.to_dict().items() if k not in ("text", "duplicate_of")}
+            m.update({"model_name": embedding_generator.model_name})
+            metadata.append(m)
 
+        store.append([row["name"] for row in batch], batch_embeddings, metadata)
 
-def save(obj, filepath):
-    with open(filepath, "wb") as handle:
-        pickle.dump(obj, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    return store
 
 
 def get_valid_entities(
@@ -392,29 +668,24 @@ def get_valid_entities(
     Args:
         items (List[str]): Items.
         model_name (str): Model name.
-        embeddings: Embeddings.
+        embeddings (Dict[str, Embedding] | SimilarityIndex): Embeddings.
         topk (int): Number of top items.
         min_score (float): Minimum similarity score.
-        use_vectorized (bool): Use vectorized operations.
+        use_vectorized (bool): Use vectorized operations. Kept for compatibility, the search is always vectorized.
 
     Returns:
         List[List[Score]]: Valid entities.
     """
     print("Load passage embeddings...")
+    index = (
+        embeddings
+        if isinstance(embeddings, SimilarityIndex)
+        else SimilarityIndex.from_embeddings(embeddings)
+    )
     embedding_generator = EmbeddingGenerator(model_name, word_mode=True)
+    query_embeddings = embedding_generator.gen_text_embeddings(items)
 
-    final_results: List[List[Score]] = []
-    for item in items:
-        query_embedding = embedding_generator.gen_text_embedding(item)
-        results = batch_similarity(
-            (item, query_embedding),
-            embeddings,
-            use_vectorized=use_vectorized,
-        )
-
-        final_results.append(get_topk_items(results, topk, min_score=min_score))
-
-    return final_results
+    return index.search_batch(items, query_embeddings, topk, min_score=min_score)
 
 
 def find_topn_text_chunks(
@@ -425,6 +696,9 @@ def find_topn_text_chunks(
     min_score: float = 0.5,
     use_vectorized: bool = False,
     use_cohere: bool = False,
+    index_backend: str = "auto",
+    nprobe: int = 16,
+    rescore: int = 100,
 ) -> List[Dict[str, Any]]:
     """Find top n text chunks.
 
@@ -435,34 +709,59 @@ def find_topn_text_chunks(
         topn (int): Number of top items.
         min_score (float): Minimum similarity score.
         use_vectorized (bool): Use vectorized operations.
+        use_cohere (bool): Rerank the results with cohere.
+        index_backend (str): ANN index backend, one of auto, faiss, ivf, sq8, pq and exact.
+        nprobe (int): Number of index clusters scanned per query, a larger value gives a higher recall.
+        rescore (int): Number of candidates re-scored with the full-precision embeddings by the sq8 and pq indexes.
 
     Returns:
         List[List[Score]]: Top n text chunks.
     """
-    pubtext = pd.read_json(text_chunks_file, lines=False)
+    pubtext = pd.read_json(text_chunks_file, lines=text_chunks_file.endswith(".jsonl"))
     print(f"Number of text chunks: {len(pubtext)}")
     print("Generate embeddings for pubtext...", pubtext.shape)
     embedding_generator = EmbeddingGenerator(model_name, word_mode=False)
 
-    pubtext_embeddings_file = os.path.join(
-        os.path.dirname(text_chunks_file), "pubtext_embeddings.pkl"
+    pubtext_embeddings_dir = os.path.join(
+        os.path.dirname(text_chunks_file), "pubtext_embeddings"
     )
-    embeddings = gen_embeddings4pubtext(
-        pubtext, embedding_generator, save_file=pubtext_embeddings_file
+    legacy_embeddings_file = os.path.join(
+        os.path.dirname(text_chunks_file), "pubtext_embeddings.pkl"
     )
+    if os.path.exists(legacy_embeddings_file) and not os.path.exists(pubtext_embeddings_dir):
+        print("Import the legacy embeddings from %s..." % legacy_embeddings_file)
+        EmbeddingStore.from_pickle(legacy_embeddings_file, pubtext_embeddings_dir)
 
-    # print(
-    #     "Embeddings are generated for pubtext: %s"
-    #     % [len(embedding.embedding) for embedding in embeddings.values()]
-    # )
+    store = gen_embeddings4pubtext(
+        pubtext, embedding_generator, store_dir=pubtext_embeddings_dir
+    )
 
     print("Get top n text chunks...")
-    results = batch_similarity(
-        (query_text, embedding_generator.gen_text_embedding(query_text)),
-        embeddings,
-        use_vectorized=use_vectorized,
+    index = open_index(
+        store.prefix, store.vectors, backend=index_backend, nprobe=nprobe, rescore=rescore
+    )
+    # A store which was built before the chunks were tagged can hold the near-duplicates too, they are
+    # filtered from the results, so the search asks for as many more candidates as there are in the store.
+    duplicates = {row["name"] for _, row in pubtext.iterrows() if is_duplicate(row)} if "duplicate_of" in pubtext.columns else set()
+    stored_duplicates = sum(1 for name in duplicates if name in store)
+    query_embedding = embedding_generator.gen_text_embedding(query_text)
+    scores, indexes = index.search(
+        query_embedding.float().numpy(), (topn * 5 if use_cohere else topn) + stored_duplicates
     )
 
+    texts = dict(zip(pubtext["name"], pubtext["text"]))
+    results = [
+        Score(
+            score=float(score),
+            category=store.metadata[idx].get("label"),
+            name=store.ids[idx],
+            target_text=texts.get(store.ids[idx]) or store.ids[idx],
+            query=query_text,
+        )
+        for idx, score in zip(indexes[0], scores[0])
+        if idx >= 0 and store.ids[idx] not in duplicates
+    ]
+
     if use_cohere:
         print("Get top %s items with min score %s..." % (topn * 5, min_score))
         topk_items = get_topk_items(results, topn * 5, min_score=min_score)